@@ -0,0 +1,193 @@
+"""
+Inference of the distribution of fitness effects (DFE) of new mutations.
+
+The spectrum of a DFE is the average of the spectra of each selection
+coefficient, weighted by the DFE. For a fixed demographic model, the
+spectra are precomputed once over a grid of gammas (Cache) and any DFE is
+then evaluated as a weighted sum of these spectra, without integration.
+
+    def model(params, ns, gamma):
+        nu, T = params
+        fs = moments.Spectrum(moments.LinearSystem_1D.steady_state_1D(ns[0],
+                                                                     gamma=gamma))
+        fs.integrate([nu], T, gamma=gamma)
+        return fs
+
+    cache = moments.DFE.Cache([2., 0.1], [20], model, processes=4)
+    cache.to_file('cache.npz')
+    fs = cache.integrate([0.2, 500.], moments.DFE.gamma_pdf, theta=1000.)
+
+Following the usual convention, the DFE is given as a density over the
+positive values -gamma (strength of purifying selection).
+"""
+import multiprocessing
+
+import numpy
+import scipy.integrate
+import scipy.special
+
+import moments
+
+
+def _spectrum(args):
+    """
+    Spectrum of the model for one gamma (module level to be picklable).
+    """
+    func, params, ns, gamma = args
+    return func(params, ns, gamma)
+
+
+class Cache(object):
+    """
+    Spectra of a demographic model over a grid of selection coefficients.
+
+    params: Parameters of the demographic model.
+    ns: Sample sizes.
+    demo_sel_func: Model function, called as demo_sel_func(params, ns, gamma).
+    gamma_bounds: Smallest and largest values of -gamma of the grid.
+    gamma_pts: Number of log-spaced values of the grid.
+    additional_gammas: Other values of -gamma to include in the grid.
+    processes: Number of processes computing the spectra (the model function
+               must then be defined at the top level of a module).
+    dtype: Storage type of the spectra (numpy.float32 halves the memory and
+           the file size).
+    """
+    def __init__(self, params, ns, demo_sel_func, gamma_bounds=(1e-4, 2000.),
+                 gamma_pts=100, additional_gammas=[], processes=1,
+                 dtype=numpy.float64):
+        self.params = numpy.array(params, dtype=float)
+        self.ns = numpy.array(ns, dtype=int)
+        # positive values -gamma, sorted
+        self.gammas = numpy.logspace(numpy.log10(gamma_bounds[0]),
+                                     numpy.log10(gamma_bounds[1]), gamma_pts)
+        self.gammas = numpy.unique(numpy.concatenate([self.gammas,
+                                                      additional_gammas]))
+        args = [(demo_sel_func, params, ns, g)
+                for g in numpy.concatenate([[0.], -self.gammas])]
+        if processes > 1:
+            pool = multiprocessing.Pool(processes)
+            try:
+                spectra = pool.map(_spectrum, args)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            spectra = [_spectrum(a) for a in args]
+        self.mask = numpy.ma.getmaskarray(spectra[0])
+        self.folded = bool(getattr(spectra[0], 'folded', False))
+        self.neutral = numpy.array(numpy.ma.getdata(spectra[0]), dtype=dtype)
+        # one flattened spectrum per row
+        self.spectra = numpy.array([numpy.ma.getdata(fs).ravel()
+                                    for fs in spectra[1:]], dtype=dtype)
+
+    def to_file(self, fid):
+        """
+        Writes the cache to a (compressed) npz file.
+
+        fid: File name or open file object.
+        """
+        numpy.savez_compressed(fid, params=self.params, ns=self.ns,
+                               gammas=self.gammas, neutral=self.neutral,
+                               spectra=self.spectra, mask=self.mask,
+                               folded=self.folded)
+
+    @staticmethod
+    def from_file(fid):
+        """
+        Reads a cache written by to_file.
+
+        fid: File name or open file object.
+        """
+        cache = Cache.__new__(Cache)
+        with numpy.load(fid) as data:
+            for key in ['params', 'ns', 'gammas', 'neutral', 'spectra', 'mask']:
+                setattr(cache, key, data[key])
+            cache.folded = bool(data['folded'])
+        return cache
+
+    def weights(self, params, sel_dist):
+        """
+        Quadrature weights of the spectra of the grid for the DFE.
+
+        The density is integrated with the trapezoid rule in log(-gamma)
+        between the values of the grid (which are log-spaced). The
+        probability mass below the smallest value (resp. above the largest)
+        is given to the spectrum of the smallest (resp. largest) value.
+        """
+        x = self.gammas
+        # pdf(x) dx = x pdf(x) dlog(x)
+        dx = numpy.diff(numpy.log(x))
+        w = numpy.zeros(len(x))
+        w[:-1] += 0.5 * dx
+        w[1:] += 0.5 * dx
+        w *= x * sel_dist(x, *params)
+        w[0] += scipy.integrate.quad(sel_dist, 0, x[0], args=tuple(params))[0]
+        w[-1] += scipy.integrate.quad(sel_dist, x[-1], numpy.inf,
+                                      args=tuple(params))[0]
+        return w
+
+    def integrate(self, params, sel_dist, theta, neutral=0.):
+        """
+        Spectrum of the DFE.
+
+        params: Parameters of the DFE.
+        sel_dist: Density of the DFE, called as sel_dist(-gammas, *params)
+                  (see gamma_pdf, lognormal_pdf and mixture_pdf).
+        theta: Population-scaled mutation rate of the selected sites.
+        neutral: Fraction of the new mutations that are neutral (point mass
+                 at gamma = 0), the DFE covers the other ones.
+        """
+        w = (1. - neutral) * self.weights(params, sel_dist)
+        data = numpy.dot(w, self.spectra).reshape(self.neutral.shape)
+        data = data + neutral * self.neutral
+        return moments.Spectrum(theta * data, mask=self.mask, mask_corners=False,
+                                data_folded=self.folded)
+
+
+def gamma_pdf(xx, alpha, beta):
+    """
+    Gamma distribution.
+
+    alpha: Shape parameter.
+    beta: Scale parameter.
+    """
+    xx = numpy.asarray(xx, dtype=float)
+    return xx**(alpha - 1) * numpy.exp(-xx / beta) \
+        / (scipy.special.gamma(alpha) * beta**alpha)
+
+
+def lognormal_pdf(xx, mu, sigma):
+    """
+    Lognormal distribution.
+
+    mu: Mean of the log of the values.
+    sigma: Standard deviation of the log of the values.
+    """
+    xx = numpy.asarray(xx, dtype=float)
+    return numpy.exp(-(numpy.log(xx) - mu)**2 / (2 * sigma**2)) \
+        / (xx * sigma * numpy.sqrt(2 * numpy.pi))
+
+
+def mixture_pdf(pdfs, nparams):
+    """
+    Mixture of distributions.
+
+    pdfs: Densities of the components.
+    nparams: Number of parameters of each component.
+
+    Returns the density of the mixture, whose parameters are the weights of
+    all the components but the last one, then the parameters of each
+    component, e.g. (p, alpha, beta, mu, sigma) for
+    mixture_pdf([gamma_pdf, lognormal_pdf], [2, 2]).
+    """
+    k = len(pdfs)
+    def pdf(xx, *params):
+        p = list(params[:k - 1])
+        p.append(1. - sum(p))
+        res = 0
+        start = k - 1
+        for i in range(k):
+            res = res + p[i] * pdfs[i](xx, *params[start:start + nparams[i]])
+            start += nparams[i]
+        return res
+    return pdf
@@ -151,7 +151,7 @@ def get_grad(func, p0, eps, args=()):
     return grad
 
 def get_godambe(func_ex, all_boot, p0, data, eps, log=False,
-                just_hess=False):
+                just_hess=False, jackknife=False):
     """
     Godambe information and Hessian matrices
 
@@ -164,6 +164,8 @@ def get_godambe(func_ex, all_boot, p0, data, eps, log=False,
     eps: Fractional stepsize to use when taking finite-difference derivatives
     log: If True, calculate derivatives in terms of log-parameters
     just_hess: If True, only evaluate and return the Hessian matrix
+    jackknife: If True, all_boot are delete-one-block jackknife spectra (see
+               Misc.jackknife) rather than bootstrap spectra.
     """
     ns = data.sample_sizes
 
@@ -192,6 +194,7 @@ def get_godambe(func_ex, all_boot, p0, data, eps, log=False,
     J = numpy.zeros((len(p0), len(p0)))
     # cU is a column vector
     cU = numpy.zeros((len(p0), 1))
+    all_grad = []
     for ii, boot in enumerate(all_boot):
         boot = Spectrum(boot)
         if not log:
@@ -202,8 +205,25 @@ def get_godambe(func_ex, all_boot, p0, data, eps, log=False,
         J_temp = numpy.outer(grad_temp, grad_temp)
         J = J + J_temp
         cU = cU + grad_temp
-    J = J / len(all_boot)
-    cU = cU / len(all_boot)
+        all_grad.append(grad_temp[:, 0])
+    J = J / len(all_grad)
+    cU = cU / len(all_grad)
+
+    if jackknife:
+        # The score is linear in the data, so the score of the data minus
+        # unit k differs from their mean by minus the deviation of the score
+        # of unit k. The variance of the score of the data (the sum of the
+        # n units) is then estimated by n/(n-1) times the sum of the squared
+        # deviations of the jackknife scores.
+        n = len(all_grad)
+        deviations = numpy.array(all_grad) - numpy.mean(all_grad, axis=0)
+        J = n / (n - 1.) * numpy.dot(deviations.T, deviations)
+        # Jackknife spectra are smaller than the data, so the mean score is
+        # evaluated on the data itself.
+        if not log:
+            cU = get_grad(func, p0, eps, args=[data])
+        else:
+            cU = get_grad(log_func, numpy.log(p0), eps, args=[data])
 
     # G = H*J^-1*H
     J_inv = numpy.linalg.inv(J)
@@ -211,7 +231,7 @@ def get_godambe(func_ex, all_boot, p0, data, eps, log=False,
     return godambe, hess, J, cU
 
 def GIM_uncert(func_ex, all_boot, p0, data, log=False,
-               multinom=True, eps=0.01, return_GIM=False):
+               multinom=True, eps=0.01, return_GIM=False, jackknife=False):
     """
     Parameter uncertainties from Godambe Information Matrix (GIM)
 
@@ -232,6 +252,8 @@ def GIM_uncert(func_ex, all_boot, p0, data, log=False,
               final entry of the returned uncertainties will correspond to
               theta.
     return_GIM: If true, also return the full GIM.
+    jackknife: If True, all_boot are delete-one-block jackknife spectra (see
+               Misc.jackknife) rather than bootstrap spectra.
     """
     if multinom:
         func_multi = func_ex
@@ -239,7 +261,8 @@ def GIM_uncert(func_ex, all_boot, p0, data, log=False,
         theta_opt = Inference.optimal_sfs_scaling(model, data)
         p0 = list(p0) + [theta_opt]
         func_ex = lambda p, ns: p[-1]*func_multi(p[:-1], ns)
-    GIM, H, J, cU = get_godambe(func_ex, all_boot, p0, data, eps, log)
+    GIM, H, J, cU = get_godambe(func_ex, all_boot, p0, data, eps, log,
+                                jackknife=jackknife)
     uncerts = numpy.sqrt(numpy.diag(numpy.linalg.inv(GIM)))
     if not return_GIM:
         return uncerts
@@ -277,7 +300,7 @@ def FIM_uncert(func_ex, p0, data, log=False, multinom=True, eps=0.01):
     return numpy.sqrt(numpy.diag(numpy.linalg.inv(H)))
 
 def LRT_adjust(func_ex, all_boot, p0, data, nested_indices,
-               multinom=True, eps=0.01):
+               multinom=True, eps=0.01, jackknife=False):
     """
     First-order moment matching adjustment factor for likelihood ratio test
 
@@ -296,6 +319,8 @@ def LRT_adjust(func_ex, all_boot, p0, data, nested_indices,
               correct uncertainties for other parameters, this function will
               automatically consider theta if multinom=True.
     eps: Fractional stepsize to use when taking finite-difference derivatives
+    jackknife: If True, all_boot are delete-one-block jackknife spectra (see
+               Misc.jackknife) rather than bootstrap spectra.
     """
     if multinom:
         func_multi = func_ex
@@ -316,7 +341,7 @@ def LRT_adjust(func_ex, all_boot, p0, data, nested_indices,
 
     p_nested = numpy.asarray(p0)[nested_indices]
     GIM, H, J, cU = get_godambe(diff_func, all_boot, p_nested, data,
-                                eps, log=False)
+                                eps, log=False, jackknife=jackknife)
 
     adjust = len(nested_indices)/numpy.trace(numpy.dot(J, numpy.linalg.inv(H)))
     return adjust
@@ -359,7 +384,8 @@ def sum_chi2_ppf(x, weights=(0,1)):
         return ppf
 
 def Wald_stat(func_ex, all_boot, p0, data, nested_indices,
-              full_params, multinom=True, eps=0.01, adj_and_org=False):
+              full_params, multinom=True, eps=0.01, adj_and_org=False,
+              jackknife=False):
     """
     Calculate test stastic from wald test
              
@@ -384,6 +410,8 @@ def Wald_stat(func_ex, all_boot, p0, data, nested_indices,
     eps: Fractional stepsize to use when taking finite-difference derivatives
     adj_and_org: If False, return only adjusted Wald statistic. If True, also
                  return unadjusted statistic as second return value.
+    jackknife: If True, all_boot are delete-one-block jackknife spectra (see
+               Misc.jackknife) rather than bootstrap spectra.
     """
     if multinom:
          func_multi = func_ex
@@ -414,7 +442,7 @@ def Wald_stat(func_ex, all_boot, p0, data, nested_indices,
 
     p_nested = numpy.asarray(p0)[nested_indices]
     GIM, H, J, cU = get_godambe(diff_func, all_boot, p_nested, data,
-                                eps, log=False)
+                                eps, log=False, jackknife=jackknife)
     param_diff = full_params-p_nested
 
     wald_adj = numpy.dot(numpy.dot(numpy.transpose(param_diff), GIM), param_diff)
@@ -425,7 +453,7 @@ def Wald_stat(func_ex, all_boot, p0, data, nested_indices,
     return wald_adj
 
 def score_stat(func_ex, all_boot, p0, data, nested_indices,
-               multinom=True, eps=0.01, adj_and_org=False):
+               multinom=True, eps=0.01, adj_and_org=False, jackknife=False):
     """
     Calculate test stastic from score test
         
@@ -445,6 +473,8 @@ def score_stat(func_ex, all_boot, p0, data, nested_indices,
               automatically consider theta if multinom=True.
     adj_and_org: If False, return only adjusted score statistic. If True, also
                  return unadjusted statistic as second return value.
+    jackknife: If True, all_boot are delete-one-block jackknife spectra (see
+               Misc.jackknife) rather than bootstrap spectra.
     """
     if multinom:
         func_multi = func_ex
@@ -465,7 +495,7 @@ def score_stat(func_ex, all_boot, p0, data, nested_indices,
 
     p_nested = numpy.asarray(p0)[nested_indices]
     GIM, H, J, cU = get_godambe(diff_func, all_boot, p_nested, data,
-                                eps, log=False)
+                                eps, log=False, jackknife=jackknife)
     
     score_org = numpy.dot(numpy.dot(numpy.transpose(cU),
                                     numpy.linalg.inv(H)), cU)[0,0]
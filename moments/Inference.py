@@ -309,8 +309,78 @@ def ll(model, data):
     Note: If either the model or the data is a masked array, the return ll will
           ignore any elements that are masked in *either* the model or the data.
     """
-    ll_arr = ll_per_bin(model, data)
-    return ll_arr.sum()
+    if data.folded and not model.folded:
+        model = model.fold()
+    model_data, model_mask = _arrays(model)
+    data_data, data_mask = _arrays(data)
+    result, valid = _ll_per_bin_arrays(model_data, model_mask,
+                                       data_data, data_mask)
+    if not numpy.array_equal(valid, logical_not(data_mask)):
+        # Let ll_per_bin warn about the entries that cannot be computed.
+        ll_per_bin(model, data)
+    return result.sum()
+
+def _arrays(fs):
+    """
+    The entries and the mask of fs, as plain ndarrays.
+    """
+    return numpy.ma.getdata(fs), numpy.ma.getmaskarray(fs)
+
+def _ll_per_bin_arrays(model, model_mask, data, data_mask, out=None):
+    """
+    Fast path of ll_per_bin, working on plain ndarrays.
+
+    model, data: Entries of the model and data spectra.
+    model_mask, data_mask: Masks of the model and data spectra (True where
+                           masked).
+    out: Optional array receiving the result (it cannot be model).
+
+    Hot code (e.g. objective functions) can keep the (entries, mask) pairs
+    and preallocated arrays to avoid building masked arrays at each call.
+
+    Returns (result, valid). valid is False for the entries that are masked
+    in model or data, or where the log of the model is not finite (i.e. the
+    entries masked in the result of ll_per_bin), and result is 0 there.
+    """
+    valid = logical_not(numpy.logical_or(model_mask, data_mask))
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        result = numpy.log(model, out=out)
+        valid &= numpy.isfinite(result)
+        result *= data
+        result -= model
+        result -= gammaln(data + 1.)
+    result[logical_not(valid)] = 0
+    return result, valid
+
+def _optimal_sfs_scaling_arrays(model, model_mask, data, data_mask, work=None):
+    """
+    Fast path of optimal_sfs_scaling, working on plain ndarrays.
+
+    See _ll_per_bin_arrays for the arguments. work: Optional array used for
+    the intermediate results.
+    """
+    mask = numpy.logical_or(model_mask, data_mask)
+    if work is None:
+        work = numpy.empty(model.shape)
+    numpy.copyto(work, data)
+    work[mask] = 0
+    data_sum = work.sum()
+    numpy.copyto(work, model)
+    work[mask] = 0
+    return data_sum/work.sum()
+
+def _ll_multinom_per_bin_arrays(model, model_mask, data, data_mask, out=None,
+                                work=None):
+    """
+    Fast path of ll_multinom_per_bin, working on plain ndarrays.
+
+    See _ll_per_bin_arrays for the arguments and the returned values. work:
+    Optional array receiving the optimally scaled model.
+    """
+    theta_opt = _optimal_sfs_scaling_arrays(model, model_mask, data, data_mask,
+                                            work=work)
+    scaled = numpy.multiply(theta_opt, model, out=work)
+    return _ll_per_bin_arrays(scaled, model_mask, data, data_mask, out=out)
 
 def ll_per_bin(model, data, missing_model_cutoff=1e-6):
     """
@@ -394,8 +464,21 @@ def ll_multinom(model, data):
     Note: If either the model or the data is a masked array, the return ll will
           ignore any elements that are masked in *either* the model or the data.
     """
-    ll_arr = ll_multinom_per_bin(model, data)
-    return ll_arr.sum()
+    data_data, data_mask = _arrays(data)
+    if data.folded and not model.folded:
+        # Scale before folding, as ll_multinom_per_bin does.
+        model = (optimal_sfs_scaling(model, data) * model).fold()
+        model_data, model_mask = _arrays(model)
+        result, valid = _ll_per_bin_arrays(model_data, model_mask,
+                                           data_data, data_mask)
+    else:
+        model_data, model_mask = _arrays(model)
+        result, valid = _ll_multinom_per_bin_arrays(model_data, model_mask,
+                                                    data_data, data_mask)
+    if not numpy.array_equal(valid, logical_not(data_mask)):
+        # Let ll_per_bin warn about the entries that cannot be computed.
+        ll_multinom_per_bin(model, data)
+    return result.sum()
 
 def minus_ll_multinom(model, data):
     """
@@ -486,8 +569,10 @@ def optimal_sfs_scaling(model, data):
     if data.folded and not model.folded:
         model = model.fold()
 
-    model, data = Numerics.intersect_masks(model, data)
-    return data.sum()/model.sum()
+    model_data, model_mask = _arrays(model)
+    data_data, data_mask = _arrays(data)
+    return _optimal_sfs_scaling_arrays(model_data, model_mask,
+                                       data_data, data_mask)
 
 def optimize_log_fmin(p0, data, model_func, 
                       lower_bound=None, upper_bound=None,
@@ -1,3 +1,7 @@
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import inspect
 import numpy as np
 import scipy as sp
 from scipy.sparse import linalg
@@ -8,6 +12,7 @@ import Jackknife as jk
 import LinearSystem_1D as ls1
 import LinearSystem_2D as ls2
 from . import Reversible
+from . import Operators
 #------------------------------------------------------------------------------
 # Functions for the computation of the Phi-moments for multidimensional models:
 # we integrate the ode system on the Phi_n(i) to compute their evolution
@@ -60,154 +65,185 @@ def _calcB_FB(dims, theta_fd, theta_bd):
         return Reversible.calc_FB_5pop(dims, theta_fd, theta_bd)
         
 
+# Couples of populations
+def _blocks(ndim, m):
+    """
+    ndim : number of populations
+
+    m : matrix containing the migration coefficients
+
+    Returns the list of the axes updated together during the splitting:
+    each couple of populations exchanging migrants, then each population
+    without any migration on its own.
+    Couples without migration are skipped since their update would only
+    repeat the drift and selection of the two populations.
+    """
+    pairs = [(i, j) for i in range(ndim) for j in range(i + 1, ndim)
+             if m[i, j] != 0 or m[j, i] != 0]
+    single = [(i,) for i in range(ndim)
+              if not any(i in pair for pair in pairs)]
+    return pairs + single
+
+def _weights(ndim, blocks):
+    """
+    Share of the drift and selection of each population in each of the
+    blocks it belongs to.
+    """
+    nb = np.array([sum(i in b for b in blocks) for i in range(ndim)])
+    return 1.0 / nb
+
 # Drift
-def _calcD(dims):
+def _calcD(dims, blocks):
     """
     dims : List containing the pop sizes
 
-    Returns a list of drift matrices for each pair of pops
+    blocks : List containing the couples (or single pops) of axes
+
+    Returns a list of drift matrices for each block
     """ 
     res = []
-    for i in range(len(dims)):
-        for j in range(i + 1, len(dims)):
-            res.append([ls2.calcD1(np.array([dims[i], dims[j]])),
-                        ls2.calcD2(np.array([dims[i], dims[j]]))])
+    for b in blocks:
+        if len(b) == 2:
+            i, j = b
+            res.append([Operators.get('D1', dims[i], dims[j]),
+                        Operators.get('D2', dims[i], dims[j])])
+        else:
+            res.append([Operators.get('D', dims[b[0]])])
     return res
 
-def _buildD(vd, dims, N):
+def _buildD(vd, blocks, N, w):
     """
     Builds the effective drift matrices by multiplying by the 1/4N coeff
 
     vd : List containing the drift matrices
 
-    dims : List containing the pop sizes
+    blocks : List containing the couples (or single pops) of axes
     
     N : List containing the effective pop sizes for each pop 
 
-    Returns a list of effective drift matrices for each pair of pops
+    w : List containing the share of each pop in its blocks
+
+    Returns a list of effective drift matrices for each block
     """ 
-    if (len(dims) == 1): return [1.0 / 4 / N[0] * vd[0][0]]
-    res = []
-    ctr = 0
-    for i in range(len(dims)):
-        for j in range(i + 1, len(dims)):
-            res.append(1.0/(4*N[i])*vd[ctr][0] + 1.0/(4*N[j])*vd[ctr][1])
-            ctr += 1
-    return res
+    return [sum(w[ax]/(4*N[ax])*vd[ctr][k] for k, ax in enumerate(b))
+            for ctr, b in enumerate(blocks)]
 
 # Selection 1
-def _calcS(dims, ljk):
+def _calcS(dims, blocks):
     """
     dims : List containing the pop sizes
 
-    ljk : List containing the 1 jump jackknife matrices for each pair of pop
+    blocks : List containing the couples (or single pops) of axes
 
-    Returns a list of selection matrices for each pair of pops
+    Returns a list of selection matrices for each block
     """ 
     res = []
-    for i in range(len(dims)):
-        for j in range(i + 1, len(dims)):
-            res.append([ls2.calcS_1(np.array([dims[i], dims[j]]), ljk[i]),
-                        ls2.calcS_2(np.array([dims[i], dims[j]]), ljk[j])])
+    for b in blocks:
+        if len(b) == 2:
+            i, j = b
+            res.append([Operators.get('S_1', dims[i], dims[j]),
+                        Operators.get('S_2', dims[i], dims[j])])
+        else:
+            res.append([Operators.get('S', dims[b[0]])])
     return res
 
-def _buildS(vs, dims, s, h):
+def _buildS(vs, blocks, s, h, w):
     """
     Builds the effective selection matrices by multiplying by the correct coeff
 
     vs : List containing the selection matrices
 
-    dims : List containing the pop sizes
+    blocks : List containing the couples (or single pops) of axes
     
     s : List containing the selection coefficients 
 
     h : List containing the dominance coefficients 
 
-    Returns a list of effective selection matrices for each pair of pops
+    w : List containing the share of each pop in its blocks
+
+    Returns a list of effective selection matrices for each block
     """ 
-    if (len(dims) == 1): return [vs[0][0]]
-    res = []
-    ctr = 0
-    for i in range(len(dims)):
-        for j in range(i + 1, len(dims)):
-            res.append(s[i]*h[i]*vs[ctr][0] + s[j]*h[j]*vs[ctr][1])
-            ctr += 1
-    return res
+    return [sum(w[ax]*s[ax]*h[ax]*vs[ctr][k] for k, ax in enumerate(b))
+            for ctr, b in enumerate(blocks)]
 
 # Selection 2
-def _calcS2(dims, ljk):
+def _calcS2(dims, blocks):
     """
     dims : List containing the pop sizes
 
-    ljk : List containing the 2 jumps jackknife matrices for each pair of pop
+    blocks : List containing the couples (or single pops) of axes
 
-    Returns a list of selection matrices for each pair of pops
+    Returns a list of selection matrices for each block
     """ 
     res = []
-    for i in range(len(dims)):
-        for j in range(i + 1, len(dims)):
-            res.append([ls2.calcS2_1(np.array([dims[i], dims[j]]), ljk[i]),
-                        ls2.calcS2_2(np.array([dims[i], dims[j]]), ljk[j])])
+    for b in blocks:
+        if len(b) == 2:
+            i, j = b
+            res.append([Operators.get('S2_1', dims[i], dims[j]),
+                        Operators.get('S2_2', dims[i], dims[j])])
+        else:
+            res.append([Operators.get('S2', dims[b[0]])])
     return res
 
-def _buildS2(vs, dims, s, h):
+def _buildS2(vs, blocks, s, h, w):
     """
     Builds the effective selection matrices (part due to dominance)
     by multiplying by the correct coeff
 
     vs : List containing the selection matrices
 
-    dims : List containing the pop sizes
+    blocks : List containing the couples (or single pops) of axes
     
     s : List containing the selection coefficients 
 
     h : List containing the dominance coefficients 
 
-    Returns a list of effective selection matrices for each pair of pops
+    w : List containing the share of each pop in its blocks
+
+    Returns a list of effective selection matrices for each block
     """ 
-    if (len(dims) == 1): return [vs[0][0]]
-    res = []
-    ctr = 0
-    for i in range(len(dims)):
-        for j in range(i + 1, len(dims)):
-            res.append(s[i]*(1-2.0*h[i])*vs[ctr][0] + s[j]*(1-2.0*h[j])*vs[ctr][1])
-            ctr += 1
-    return res
+    return [sum(w[ax]*s[ax]*(1-2.0*h[ax])*vs[ctr][k] for k, ax in enumerate(b))
+            for ctr, b in enumerate(blocks)]
 
 # Migrations
-def _calcM(dims, ljk):
+def _calcM(dims, blocks):
     """
     dims : List containing the pop sizes
 
-    ljk : List containing the 1 jump jackknife matrices for each pair of pop
+    blocks : List containing the couples (or single pops) of axes
 
-    Returns a list of migration matrices for each pair of pops
+    Returns a list of migration matrices for each block
+    (empty for the single pops)
     """ 
     res = []
-    for i in range(len(dims)):
-        for j in range(i + 1, len(dims)):
-            res.append([ls2.calcM_1(np.array([dims[i], dims[j]]), ljk[j]),
-                        ls2.calcM_2(np.array([dims[i], dims[j]]), ljk[i])])
+    for b in blocks:
+        if len(b) == 2:
+            i, j = b
+            res.append([Operators.get('M_1', dims[i], dims[j]),
+                        Operators.get('M_2', dims[i], dims[j])])
+        else:
+            res.append([])
     return res
 
-def _buildM(vm, dims, m):
+def _buildM(vm, blocks, m):
     """
     Builds the effective migration matrices by multiplying by the migration coeff
 
     vm : List containing the migration matrices
 
-    dims : List containing the pop sizes
+    blocks : List containing the couples (or single pops) of axes
     
     m : matrix containing the migration coefficients
 
-    Returns a list of effective migration matrices for each pair of pops
+    Returns a list of effective migration matrices for each block
     """ 
     res = []
-    ctr = 0
-    for i in range(len(dims)):
-        for j in range(i + 1, len(dims)):
+    for ctr, b in enumerate(blocks):
+        if len(b) == 2:
+            i, j = b
             res.append(m[i, j]*vm[ctr][0] + m[j, i]*vm[ctr][1])
-            ctr += 1
+        else:
+            res.append(0)
     return res
 
 #----------------------------------
@@ -217,290 +253,111 @@ def _buildM(vm, dims, m):
 # step 1 functions correspond to the QY computation
 # and step 2 to the resolution of PX = Y'
 
-# 2D
-#step 1
-def _ud1_2pop_1(sfs, Q, dims):
-    sfs = Q[0].dot(sfs.reshape(dims[0] * dims[1])).reshape(dims)
-    return sfs
-
-# step 2
-def _ud2_2pop_1(sfs, slv, dims):
-    sfs = (slv[0](sfs.reshape(dims[0] * dims[1]))).reshape(dims)
-    return sfs
-
-# for 3D, 4D and 5D cases, each couple of directions are coded separately to simplify the permutations...
-#------------------------------
-# 3D
-
-# step 1
-def _ud1_3pop_1(sfs, Q, dims):
-    for i in range(int(dims[2])):
-        sfs[:, :, i] = Q[0].dot(sfs[:, :, i].reshape(dims[0] * dims[1])).reshape(dims[0], dims[1])
-    return sfs
-
-def _ud1_3pop_2(sfs, Q, dims):
-    for i in range(int(dims[1])):
-        sfs[:, i, :] = Q[1].dot(sfs[:, i, :].reshape(dims[0] * dims[2])).reshape(dims[0], dims[2])
-    return sfs
-
-def _ud1_3pop_3(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        sfs[i, :, :] = Q[2].dot(sfs[i, :, :].reshape(dims[1] * dims[2])).reshape(dims[1], dims[2])
-    return sfs
-
-# step 2
-def _ud2_3pop_1(sfs, slv, dims):
-    for i in range(int(dims[2])):
-        sfs[:, :, i] = slv[0](sfs[:, :, i].reshape(dims[0] * dims[1])).reshape(dims[0], dims[1])
-    return sfs
-
-def _ud2_3pop_2(sfs, slv, dims):
-    for i in range(int(dims[1])):
-        sfs[:, i, :] = slv[1](sfs[:, i, :].reshape(dims[0] * dims[2])).reshape(dims[0], dims[2])
-    return sfs
-
-def _ud2_3pop_3(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        sfs[i, :, :] = slv[2](sfs[i, :, :].reshape(dims[1] * dims[2])).reshape(dims[1], dims[2])
-    return sfs
-
-
-#------------------------------
-# 4D
-
-# step 1
-def _ud1_4pop_1(sfs, Q, dims):
-    for i in range(int(dims[2])):
-        for j in range(int(dims[3])):
-            sfs[:, :, i, j] = Q[0].dot(sfs[:, :, i, j].reshape(dims[0] * dims[1])).reshape(dims[0], dims[1])
-    return sfs
-
-def _ud1_4pop_2(sfs, Q, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[3])):
-            sfs[:, i, :, j] = Q[1].dot(sfs[:, i, :, j].reshape(dims[0] * dims[2])).reshape(dims[0], dims[2])
-    return sfs
-
-def _ud1_4pop_3(sfs, Q, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[2])):
-            sfs[:, i, j, :] = Q[2].dot(sfs[:, i, j, :].reshape(dims[0] * dims[3])).reshape(dims[0], dims[3])
-    return sfs
-
-def _ud1_4pop_4(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[3])):
-            sfs[i, :, :, j] = Q[3].dot(sfs[i, :, :, j].reshape(dims[1] * dims[2])).reshape(dims[1], dims[2])
-    return sfs
-
-def _ud1_4pop_5(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[2])):
-            sfs[i, :, j, :] = Q[4].dot(sfs[i, :, j, :].reshape(dims[1] * dims[3])).reshape(dims[1], dims[3])
-    return sfs
-
-def _ud1_4pop_6(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[1])):
-            sfs[i, j, :, :] = Q[5].dot(sfs[i, j, :, :].reshape(dims[2] * dims[3])).reshape(dims[2], dims[3])
-    return sfs
-
-# step 2
-
-def _ud2_4pop_1(sfs, slv, dims):
-    for i in range(int(dims[2])):
-        for j in range(int(dims[3])):
-            sfs[:, :, i, j] = slv[0](sfs[:, :, i, j].reshape(dims[0] * dims[1])).reshape(dims[0], dims[1])
-    return sfs
-
-def _ud2_4pop_2(sfs, slv, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[3])):
-            sfs[:, i, :, j] = slv[1](sfs[:, i, :, j].reshape(dims[0] * dims[2])).reshape(dims[0], dims[2])
-    return sfs
-
-def _ud2_4pop_3(sfs, slv, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[2])):
-            sfs[:, i, j, :] = slv[2](sfs[:, i, j, :].reshape(dims[0] * dims[3])).reshape(dims[0], dims[3])
-    return sfs
-
-def _ud2_4pop_4(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[3])):
-            sfs[i, :, :, j] = slv[3](sfs[i, :, :, j].reshape(dims[1] * dims[2])).reshape(dims[1], dims[2])
-    return sfs
-
-def _ud2_4pop_5(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[2])):
-            sfs[i, :, j, :] = slv[4](sfs[i, :, j, :].reshape(dims[1] * dims[3])).reshape(dims[1], dims[3])
-    return sfs
-
-def _ud2_4pop_6(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[1])):
-            sfs[i, j, :, :] = slv[5](sfs[i, j, :, :].reshape(dims[2] * dims[3])).reshape(dims[2], dims[3])
-    return sfs
-
-#------------------------------
-# 5D
-
-# step 1
-def _ud1_5pop_1(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[1])):
-            for k in range(int(dims[2])):
-                sfs[i, j, k, :, :] = Q[9].dot(sfs[i, j, k, :, :].reshape(dims[3] * dims[4])).reshape(dims[3], dims[4])
-    return sfs
-
-def _ud1_5pop_2(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[1])):
-            for k in range(int(dims[3])):
-                sfs[i, j, :, k, :] = Q[8].dot(sfs[i, j, :, k, :].reshape(dims[2] * dims[4])).reshape(dims[2], dims[4])
-    return sfs
-
-def _ud1_5pop_3(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[1])):
-            for k in range(int(dims[4])):
-                sfs[i, j, :, :, k] = Q[7].dot(sfs[i, j, :, :, k].reshape(dims[2] * dims[3])).reshape(dims[2], dims[3])
-    return sfs
-
-def _ud1_5pop_4(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[2])):
-            for k in range(int(dims[3])):
-                sfs[i, :, j, k, :] = Q[6].dot(sfs[i, :, j, k, :].reshape(dims[1] * dims[4])).reshape(dims[1], dims[4])
-    return sfs
-
-def _ud1_5pop_5(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[2])):
-            for k in range(int(dims[4])):
-                sfs[i, :, j, :, k] = Q[5].dot(sfs[i, :, j, :, k].reshape(dims[1] * dims[3])).reshape(dims[1], dims[3])
-    return sfs
-
-def _ud1_5pop_6(sfs, Q, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[3])):
-            for k in range(int(dims[4])):
-                sfs[i, :, :, j, k] = Q[4].dot(sfs[i, :, :, j, k].reshape(dims[1] * dims[2])).reshape(dims[1], dims[2])
-    return sfs
-
-def _ud1_5pop_7(sfs, Q, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[2])):
-            for k in range(int(dims[3])):
-                sfs[:, i, j, k, :] = Q[3].dot(sfs[:, i, j, k, :].reshape(dims[0] * dims[4])).reshape(dims[0], dims[4])
-    return sfs
-
-def _ud1_5pop_8(sfs, Q, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[2])):
-            for k in range(int(dims[4])):
-                sfs[:, i, j, :, k] = Q[2].dot(sfs[:, i, j, :, k].reshape(dims[0] * dims[3])).reshape(dims[0], dims[3])
-    return sfs
-
-def _ud1_5pop_9(sfs, Q, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[3])):
-            for k in range(int(dims[4])):
-                sfs[:, i, :, j, k] = Q[1].dot(sfs[:, i, :, j, k].reshape(dims[0] * dims[2])).reshape(dims[0], dims[2])
-    return sfs
-
-def _ud1_5pop_10(sfs, Q, dims):
-    for i in range(int(dims[2])):
-        for j in range(int(dims[3])):
-            for k in range(int(dims[4])):
-                sfs[:, :, i, j, k] = Q[0].dot(sfs[:, :, i, j, k].reshape(dims[0] * dims[1])).reshape(dims[0], dims[1])
-    return sfs
-
-# step 2
-def _ud2_5pop_1(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[1])):
-            for k in range(int(dims[2])):
-                sfs[i, j, k, :, :] = slv[9](sfs[i, j, k, :, :].reshape(dims[3] * dims[4])).reshape(dims[3], dims[4])
-    return sfs
-
-def _ud2_5pop_2(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[1])):
-            for k in range(int(dims[3])):
-                sfs[i, j, :, k, :] = slv[8](sfs[i, j, :, k, :].reshape(dims[2] * dims[4])).reshape(dims[2], dims[4])
-    return sfs
-
-def _ud2_5pop_3(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[1])):
-            for k in range(int(dims[4])):
-                sfs[i, j, :, :, k] = slv[7](sfs[i, j, :, :, k].reshape(dims[2] * dims[3])).reshape(dims[2], dims[3])
-    return sfs
-
-def _ud2_5pop_4(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[2])):
-            for k in range(int(dims[3])):
-                sfs[i, :, j, k, :] = slv[6](sfs[i, :, j, k, :].reshape(dims[1] * dims[4])).reshape(dims[1], dims[4])
-    return sfs
-
-def _ud2_5pop_5(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[2])):
-            for k in range(int(dims[4])):
-                sfs[i, :, j, :, k] = slv[5](sfs[i, :, j, :, k].reshape(dims[1] * dims[3])).reshape(dims[1], dims[3])
-    return sfs
+# All the slices along the axes of a block are updated at once: the tensor is
+# transposed so that the active axes come first and the slices become the
+# columns of a single right hand side.
+# With threads > 1, the columns are split in chunks processed by a pool of
+# threads and written into a preallocated output. The SuperLU solves, the
+# sparse products and the tridiagonal solver release the GIL, so the
+# chunks are processed in parallel. Operators able to write into a given
+# buffer (the tridiagonal solver) fill their slice of the output directly;
+# the others (SuperLU and sparse products have no output argument) return
+# a new array, copied into the output.
+# The result is stored with the dtype of the spectrum: the solvers work in
+# float64 but a float32 spectrum stays in float32 (see _as_dtype).
+# The pool of threads only lives during one integration: nothing is left
+# running between calls or inherited by forked processes.
+class _Threads(object):
+    """
+    Pool of threads sharing the work of one integration, shut down on exit
+    of the with block (no pool is started for a single thread).
+    """
+    def __init__(self, threads):
+        self.threads = int(threads)
+        self._executor = None
+        if self.threads > 1:
+            self._executor = ThreadPoolExecutor(self.threads)
+
+    def map(self, func, iterable):
+        if self._executor is None:
+            return list(map(func, iterable))
+        return list(self._executor.map(func, iterable))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+def _scoped_threads(func):
+    """
+    Decorator of the integrators: their threads argument (a number of
+    threads) is replaced by a _Threads pool closed when they return.
+    """
+    signature = inspect.signature(func)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        bound = signature.bind(*args, **kwargs)
+        threads = bound.arguments.get('threads', 1)
+        if isinstance(threads, _Threads):
+            return func(*args, **kwargs)
+        with _Threads(threads) as pool:
+            bound.arguments['threads'] = pool
+            return func(*bound.args, **bound.kwargs)
+    return wrapper
+
+def _apply_axes(sfs, op, axes, threads=1, out_arg=False):
+    """
+    sfs : n-dimensional spectrum
 
-def _ud2_5pop_6(sfs, slv, dims):
-    for i in range(int(dims[0])):
-        for j in range(int(dims[3])):
-            for k in range(int(dims[4])):
-                sfs[i, :, :, j, k] = slv[4](sfs[i, :, :, j, k].reshape(dims[1] * dims[2])).reshape(dims[1], dims[2])
-    return sfs
+    op : operator acting on the flattened slices spanned by axes, either
+         the product by Q or the solver of the implicit system
 
-def _ud2_5pop_7(sfs, slv, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[2])):
-            for k in range(int(dims[3])):
-                sfs[:, i, j, k, :] = slv[3](sfs[:, i, j, k, :].reshape(dims[0] * dims[4])).reshape(dims[0], dims[4])
-    return sfs
+    axes : the axes (in increasing order) the operator acts on
 
-def _ud2_5pop_8(sfs, slv, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[2])):
-            for k in range(int(dims[4])):
-                sfs[:, i, j, :, k] = slv[2](sfs[:, i, j, :, k].reshape(dims[0] * dims[3])).reshape(dims[0], dims[3])
-    return sfs
+    threads : number of threads sharing the slices, or the _Threads pool of
+              the integration
 
-def _ud2_5pop_9(sfs, slv, dims):
-    for i in range(int(dims[1])):
-        for j in range(int(dims[3])):
-            for k in range(int(dims[4])):
-                sfs[:, i, :, j, k] = slv[1](sfs[:, i, :, j, k].reshape(dims[0] * dims[2])).reshape(dims[0], dims[2])
-    return sfs
-
-def _ud2_5pop_10(sfs, slv, dims):
-    for i in range(int(dims[2])):
-        for j in range(int(dims[3])):
-            for k in range(int(dims[4])):
-                sfs[:, :, i, j, k] = slv[0](sfs[:, :, i, j, k].reshape(dims[0] * dims[1])).reshape(dims[0], dims[1])
-    return sfs
+    out_arg : whether op accepts an out keyword, a float64 array in which the
+              result is written (as Tridiag_solve.solve_2D)
+    """
+    if not isinstance(threads, _Threads):
+        with _Threads(threads) as pool:
+            return _apply_axes(sfs, op, axes, pool, out_arg)
+    shape = sfs.shape
+    perm = list(axes) + [k for k in range(sfs.ndim) if k not in axes]
+    x = np.transpose(sfs, perm).reshape(int(np.prod([shape[k] for k in axes])), -1)
+    nchunks = min(threads.threads, x.shape[1])
+    if nchunks > 1:
+        res = np.empty(x.shape, dtype=sfs.dtype)
+        bounds = np.linspace(0, x.shape[1], nchunks + 1).astype(int)
+        out_arg = out_arg and res.dtype == np.float64
+        def work(k):
+            if out_arg:
+                op(x[:, bounds[k]:bounds[k+1]], out=res[:, bounds[k]:bounds[k+1]])
+            else:
+                res[:, bounds[k]:bounds[k+1]] = op(x[:, bounds[k]:bounds[k+1]])
+        threads.map(work, range(nchunks))
+    else:
+        res = op(x)
+        if res.dtype != sfs.dtype:
+            res = res.astype(sfs.dtype)
+    res = res.reshape([shape[k] for k in perm])
+    return np.transpose(res, np.argsort(perm))
 
 # update nD with permutations
-def _update_step1(sfs, Q, dims, order):
-    assert(len(sfs.shape) == len(dims))
-    assert(len(Q) == len(dims) * (len(dims)-1) / 2)
+def _update_step1(sfs, Q, blocks, order, threads=1):
+    assert(len(Q) == len(blocks))
     for i in order:
-        sfs = eval('_ud1_' + str(len(dims)) + 'pop_' + str(i + 1) + '(sfs, Q, dims)')
+        sfs = _apply_axes(sfs, Q[i].dot, blocks[i], threads)
     return sfs
 
-def _update_step2(sfs, slv, dims, order):
-    assert(len(sfs.shape) == len(dims))
-    assert(len(slv) == len(dims) * (len(dims)-1) / 2)
+def _update_step2(sfs, slv, blocks, order, threads=1):
+    assert(len(slv) == len(blocks))
     for i in order:
-        sfs = eval('_ud2_' + str(len(dims)) + 'pop_' + str(i + 1) + '(sfs, slv, dims)')
+        sfs = _apply_axes(sfs, slv[i], blocks[i], threads)
     return sfs
 
 def _permute(tab):
@@ -519,17 +376,6 @@ def compute_dt(sample_sizes, N, s, h, m, dt_default, factor=10.0):
     return min(dt_default, factor * min(2*N, 1.0 / (mig+eps),
                1.0 / (sel1+eps), 1.0 / (sel2+eps)))
 
-def compute_dt_bis(N, T, drift, selmig, dims):
-    if callable(N):
-        Nmin = N(0)#np.amin(N(0), N(T))
-    else:
-        Nmin = N
-    nbp = int(len(dims) * (len(dims)-1) / 2)
-    D = _buildD(drift, dims, Nmin)
-    Mat =  [(D[i] + selmig[i]).todense() for i in range(nbp)]
-    ev = [np.linalg.eigvals(Mat[i]) for i in range(nbp)]
-    return 0
-
 def _compute_dt_1pop(N, m, s, h, timescale_factor=0.15):
     maxVM = max(0.25/N, max(m),\
                 abs(s) * 2*max(np.abs(h + (1-2*h)*0.5) * 0.5*(1-0.5),
@@ -557,8 +403,446 @@ def compute_dt(N, m=None, s=None, h=None, timescale_factor=0.1):
 
 
 
+#------------------------------------
+# cache for the factorized operators -
+#------------------------------------
+# During an optimization the same (dims, N, dt, gamma, h, m) combinations are
+# visited over and over, so the LU factorizations of the implicit systems can
+# be kept and reused from one call of integrate_nD to the next. The
+# integrators without migration (Integration_nomig.integrate_nomig and
+# integrate_neutral) store their operators in the same cache.
+class OperatorCache(object):
+    """
+    Least recently used store for the operators of the time integration.
+
+    max_bytes : memory budget for the stored matrices and LU factors.
+                When it is exceeded, the least recently used entries are
+                discarded.
+
+    hits, misses and evictions count the lookups since the last clear().
+    """
+    def __init__(self, max_bytes=256 * 2**20):
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Returns the value stored for key, or None if it is not in the cache.
+        """
+        try:
+            value, nbytes = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        # reinsert to mark the entry as the most recently used
+        self._entries[key] = (value, nbytes)
+        self.hits += 1
+        return value
+
+    def put(self, key, value, nbytes):
+        """
+        Stores value under key, nbytes being its memory footprint.
+        """
+        if key in self._entries:
+            self.nbytes -= self._entries.pop(key)[1]
+        if nbytes > self.max_bytes:
+            return
+        while self._entries and self.nbytes + nbytes > self.max_bytes:
+            old_key, (old_value, old_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= old_nbytes
+            self.evictions += 1
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+    def clear(self):
+        """
+        Empties the cache and resets the counters.
+        """
+        self._entries.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def info(self):
+        """
+        Dictionary with the counters and the memory usage of the cache.
+        """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'entries': len(self),
+                'nbytes': self.nbytes, 'max_bytes': self.max_bytes}
+
+# the cache is opt-in: None means that the integrators refactor as usual
+_operator_cache = None
+
+def enable_operator_cache(max_bytes=256 * 2**20):
+    """
+    Keep the factorized operators of integrate_nD, integrate_nomig and
+    integrate_neutral between calls.
+
+    max_bytes : memory budget of the cache (default 256 Mb).
+
+    Returns the OperatorCache in use.
+    """
+    global _operator_cache
+    if _operator_cache is None:
+        _operator_cache = OperatorCache(max_bytes)
+    else:
+        _operator_cache.max_bytes = max_bytes
+    return _operator_cache
+
+def disable_operator_cache():
+    """
+    Stop caching the factorized operators and free the stored ones.
+    """
+    global _operator_cache
+    if _operator_cache is not None:
+        _operator_cache.clear()
+    _operator_cache = None
+
+def operator_cache_info():
+    """
+    Counters of the operator cache, or None if it is disabled.
+    """
+    if _operator_cache is None:
+        return None
+    return _operator_cache.info()
+
+def _sparse_nbytes(A):
+    return A.data.nbytes + A.indices.nbytes + A.indptr.nbytes
+
+# Storage precision: with dtype=np.float32, the spectrum and the explicit
+# operators (Q, mutations) are stored in single precision, which halves
+# the memory traffic of the updates. The factorizations and the solves
+# stay in float64 for stability and their results are rounded back.
+def _as_dtype(B, dtype):
+    """
+    Casts an array, a sparse matrix or a list of them to dtype.
+    """
+    if isinstance(B, list):
+        return [_as_dtype(b, dtype) for b in B]
+    return B.astype(dtype)
+
+# With a callable Npop, the effective sizes change at each time step and so
+# do the operators. The sizes can be rounded to a log-spaced grid so that
+# the operators (and the time step, which depends on N) stay the same as
+# long as N stays in the same bucket: a growth epoch then costs one
+# factorization per bucket crossed instead of one per step.
+def _quantize_N(N, Npop_tol):
+    """
+    N : population sizes
+
+    Npop_tol : relative tolerance on N, or None to keep N unchanged
+
+    Returns the closest sizes on the grid exp(2*k*log(1+Npop_tol)), within
+    Npop_tol of N.
+    """
+    if Npop_tol is None:
+        return N
+    step = 2 * np.log1p(Npop_tol)
+    return np.exp(np.round(np.log(np.asarray(N, dtype=float)) / step) * step)
+
+def _factorize_ops(D, S1, S2, Mi, dt, split_dt, dtype=np.float64):
+    """
+    Builds the explicit (Q) and implicit (slv) operators of the
+    Crank-Nicolson step for each block of populations.
+    The SuperLU solvers accept several right hand sides at once.
+
+    Returns slv, Q and the memory footprint of the operators.
+    """
+    slv, Q = [], []
+    nbytes = 0
+    for i in range(len(D)):
+        A = dt/2.0/split_dt*(D[i]+S1[i]+S2[i]+Mi[i])
+        Id = sp.sparse.identity(S1[i].shape[0], dtype='float', format='csc')
+        lu = linalg.splu(sp.sparse.csc_matrix(Id - A))
+        slv.append(lu.solve)
+        Q.append((Id + A).astype(dtype))
+        nbytes += 12 * (lu.L.nnz + lu.U.nnz) + _sparse_nbytes(Q[-1])
+    return slv, Q, nbytes
+
+def _nD_ops(cache, dims, Neff, dt, split_dt, s, h, mm, vd, blocks, w, S1, S2, Mi,
+            dtype=np.float64):
+    """
+    Operators (slv, Q) of a time step of size dt for the effective sizes
+    Neff, looked up in cache first if one is given.
+    """
+    if cache is not None:
+        # the operators only depend on these quantities
+        key = (tuple(dims), tuple(np.asarray(Neff, dtype=float).ravel()),
+               dt, split_dt, tuple(s), tuple(h), mm.tobytes(), np.dtype(dtype).str)
+        ops = cache.get(key)
+        if ops is not None:
+            return ops
+    D = _buildD(vd, blocks, Neff, w)
+    # system inversion for backward scheme
+    slv, Q, nbytes = _factorize_ops(D, S1, S2, Mi, dt, split_dt, dtype)
+    if cache is not None:
+        cache.put(key, (slv, Q), nbytes)
+    return slv, Q
+
+def _nD_step(sfs, Q, slv, B, dt, blocks, order, split_dt, finite_genome, threads=1):
+    """
+    Crank-Nicolson step of size dt with the operator splitting.
+    The input spectrum is left unchanged and order is permuted in place.
+    """
+    n = np.array(sfs.shape) - 1
+    if len(n) == 1:
+        sfs = Q[0].dot(sfs)
+        if finite_genome == False:
+            sfs = slv[0](sfs + dt*B)
+        else:
+            sfs = slv[0](sfs + (dt*B).dot(sfs))
+    else:
+        for i in range(int(split_dt)):
+            sfs = _update_step1(sfs, Q, blocks, order, threads)
+            if finite_genome == False:
+                sfs += dt / split_dt * B
+            else:
+                for j in range(len(n)):
+                    sfs = sfs + (dt/split_dt*B[j]).dot(sfs.flatten()).reshape(n+1)
+            sfs = _update_step2(sfs, slv, blocks, order, threads)
+            order[:] = _permute(order)
+    return sfs
+
+#----------------------------------
+# error controlled time stepping  -
+#----------------------------------
+# The local error of a Crank-Nicolson step of size dt is estimated by step
+# doubling: the result y1 of one step is compared with the result y2 of two
+# steps of size dt/2. The scheme being of order 2, the error of y2 is
+# about (y2-y1)/3 (Richardson). A step is accepted when the RMS of this
+# error, relative to atol + rtol*|y|, is below 1, and dt is then scaled by
+# 0.9*err^(-1/3) (between 0.2 and 5).
+# Each accepted step costs three steps and up to two extra factorizations,
+# so this is not faster than a well chosen dt_fac: the point is to bound
+# the error without having to tune dt_fac for each model. With rtol = 1e-3
+# the maximal error is typically about 1e-4 relative to the largest entry.
+def _integrate_adaptive(sfs, Tmax, step, dt, rtol, atol):
+    """
+    sfs : initial spectrum
+
+    Tmax : final time
+
+    step : function (sfs, t, dt) returning the spectrum after a
+           Crank-Nicolson step of size dt starting at time t
+
+    dt : initial time step
+
+    rtol, atol : relative and absolute tolerances on the local error
+    """
+    t = 0.0
+    while t < Tmax:
+        dt = min(dt, Tmax - t)
+        full = step(sfs, t, dt)
+        half = step(step(sfs, t, dt/2.0), t + dt/2.0, dt/2.0)
+        scale = atol + rtol * np.maximum(np.abs(full), np.abs(half))
+        err = np.sqrt(np.mean(((half-full) / 3.0 / scale)**2))
+        if err > 0:
+            fac = min(5.0, max(0.2, 0.9 * err**(-1.0/3)))
+        else:
+            fac = 5.0
+        if err <= 1.0:
+            t += dt
+            sfs = half
+            # small changes of dt are skipped so that the factorizations
+            # of the previous step can be reused
+            if fac < 1.5:
+                fac = 1.0
+        dt *= fac
+    return sfs
+
+#----------------------------------
+# exponential integrator          -
+#----------------------------------
+# With constant parameters, the system Phi' = L Phi + B is linear with a
+# constant operator and its solution after a time T is exp(T L) Phi0 (plus
+# the integrated source). We compute the action of the exponential with
+# scipy's expm_multiply, without any time step nor operator splitting.
+# The affine source B is handled by the augmented system
+#       (Phi, 1)' = [[L, B], [0, 0]] (Phi, 1).
+# The cost grows with the norm of T*L (fast drift, strong selection or long
+# epochs), so this is mostly useful for moderate sample sizes.
+def _embed(A, dims, axes):
+    """
+    A : sparse operator acting on the flattened slices spanned by axes
+
+    dims : List containing the pop sizes
+
+    axes : the axes (in increasing order) A acts on
+
+    Returns the sparse operator acting on the whole flattened spectrum.
+    """
+    d = int(np.prod(dims))
+    perm = list(axes) + [k for k in range(len(dims)) if k not in axes]
+    # P maps the flattened spectrum to its transposed version (see _apply_axes)
+    idx = np.arange(d).reshape(dims).transpose(perm).ravel()
+    P = sp.sparse.csr_matrix((np.ones(d), (np.arange(d), idx)), shape=(d, d))
+    rest = sp.sparse.identity(d // A.shape[0], format='csr')
+    return P.T.dot(sp.sparse.kron(A, rest, format='csr')).dot(P).tocsr()
+
+def _integrate_expm(sfs, ops, axes, B, T, finite_genome):
+    """
+    sfs : initial spectrum
+
+    ops : List containing the (drift + selection + migration) operator of
+          each block
+
+    axes : List containing the axes each operator acts on
+
+    B : mutation source term (array), or mutation matrices in the finite
+        genome model
+
+    T : integration time
+
+    Returns the spectrum at time T.
+    """
+    dims = sfs.shape
+    d = sfs.size
+    L = sp.sparse.csr_matrix((d, d))
+    for A, ax in zip(ops, axes):
+        L = L + _embed(A, dims, ax)
+    if finite_genome:
+        if len(dims) == 1:
+            L = L + B
+        else:
+            for Bi in B:
+                L = L + Bi
+        res = linalg.expm_multiply(T * L.tocsc(), sfs.ravel())
+    else:
+        L = sp.sparse.vstack([sp.sparse.hstack([L, B.reshape(d, 1)]),
+                              sp.sparse.csr_matrix((1, d + 1))])
+        res = linalg.expm_multiply(T * L.tocsc(), np.append(sfs.ravel(), 1.0))[:-1]
+    return res.reshape(dims)
+
+#----------------------------------
+# matrix-free mode                -
+#----------------------------------
+# Drift and selection act along one axis and the migration from pop k to
+# pop j is the sum of kron(A0, I) (along axis j) and of the cross term
+# kron(A1, W) where A0 and A1 act on axis j and W on axis k. Instead of
+# assembling the operators of couples of populations, we keep these
+# (n+1)x(n+1) banded matrices and apply them along the axes of the tensor,
+# so that the memory is O(d) instead of O(d*bandwidth).
+# The implicit part is solved axis by axis with the Craig-Sneyd ADI scheme
+# (theta = 1/2), where the cross terms of migration (and the mutations)
+# are explicit:
+#       Y0 = U + dt*F(U)
+#       Yj = Yj-1 + theta*dt*(Fj(Yj) - Fj(U)),       j = 1...p
+#       Z0 = Y0 + theta*dt*(F0(Yp) - F0(U))
+#       Zj = Zj-1 + theta*dt*(Fj(Zj) - Fj(U)),       j = 1...p
+# Fj is the part of the operator acting on axis j only and F0 the cross
+# terms. The scheme is of order 2.
+def _calcM_kron(nj, nk, ljk):
+    """
+    nj, nk : dimensions of the receiving (j) and source (k) pops
+
+    ljk : order 3 jackknife coefficients (calcJK13) of pop k, in dense,
+          sparse or band form (see Jackknife.band)
+
+    Returns A0, A1 (acting on axis j) and W (acting on axis k) such that the
+    migration matrix of calcM_jk3 (for 2 pops) is kron(A0, I) + kron(A1, W).
+    """
+    x = np.arange(nj)
+    A0 = sp.sparse.diags([-x, x[:-1]+1], [0, 1], format='csr')
+    A1 = sp.sparse.diags([2*x-(nj-1), nj-x[1:], -x[:-1]-1], [0, -1, 1], format='csr')
+    xk = np.arange(nk)
+    c = (xk+1) / np.float64(nk)
+    # the jackknife extrapolates Phi_(nk+1)(xk+1) from Phi_nk around index_bis
+    xt = np.array([jk.index_bis(i+1, nk-1) for i in xk])
+    last = xk == nk-1
+    rk = np.where(last, xk-1, xk)
+    jb = jk.band(ljk)
+    data = [np.where(last, -1.0/nk, 1.0) * jb[rk, l] * c for l in range(3)]
+    row = [xk] * 3
+    col = [xt-1+l for l in range(3)]
+    W = sp.sparse.coo_matrix((np.concatenate(data + [c[last]]),
+                              (np.concatenate(row + [xk[last]]), np.concatenate(col + [xk[last]]))),
+                             shape=(nk, nk)).tocsr()
+    return A0, A1, W
+
+def _kron_ops(dims, s, h, mm):
+    """
+    Builds the N independent operators of the matrix-free mode.
+
+    Returns the list of drift matrices of each axis, the list of the
+    selection and migration (A0) matrices acting on each axis and the
+    list of the cross terms (j, k, A1, W) of migration.
+    """
+    ndim = len(dims)
+    vd = [Operators.get('D', dims[i]) for i in range(ndim)]
+    L0 = []
+    for i in range(ndim):
+        L0.append(s[i]*h[i]*Operators.get('S', dims[i])
+                  + s[i]*(1-2.0*h[i])*Operators.get('S2', dims[i]))
+    cross = []
+    for j in range(ndim):
+        for k in range(ndim):
+            if j != k and mm[j, k] != 0:
+                A0, A1, W = _calcM_kron(dims[j], dims[k], Operators.calcJK13(int(dims[k] - 1)))
+                L0[j] = L0[j] + mm[j, k]*A0
+                cross.append((j, k, mm[j, k]*A1, W))
+    return vd, L0, cross
+
+def _kron_solvers(vd, L0, Neff, dt, theta=0.5, dtype=np.float64):
+    """
+    Returns the operator acting on each axis for the effective sizes Neff,
+    the solvers of (I - theta*dt*L) along each axis and their memory
+    footprint.
+    """
+    L, slv = [], []
+    nbytes = 0
+    for i in range(len(vd)):
+        Li = sp.sparse.csc_matrix(1.0 / 4 / Neff[i] * vd[i] + L0[i])
+        L.append(Li.astype(dtype))
+        Id = sp.sparse.identity(vd[i].shape[0], dtype='float', format='csc')
+        lu = linalg.splu(sp.sparse.csc_matrix(Id - theta*dt*Li))
+        slv.append(lu.solve)
+        nbytes += 12 * (lu.L.nnz + lu.U.nnz) + _sparse_nbytes(L[i])
+    return L, slv, nbytes
+
+def _kron_step(sfs, L, slv, cross, B, dt, finite_genome, theta=0.5, threads=1):
+    """
+    Craig-Sneyd step of size dt in the matrix-free mode.
+    """
+    n = np.array(sfs.shape) - 1
+    axes = range(len(L))
+    def F0(y):
+        res = np.zeros(y.shape, dtype=y.dtype)
+        for j, k, A1, W in cross:
+            res += _apply_axes(_apply_axes(y, W.dot, (k,), threads), A1.dot, (j,), threads)
+        if finite_genome:
+            if len(n) == 1:
+                res += B.dot(y)
+            else:
+                for Bi in B:
+                    res += Bi.dot(y.flatten()).reshape(n+1)
+        return res
+    FU = [_apply_axes(sfs, L[i].dot, (i,), threads) for i in axes]
+    F0U = F0(sfs)
+    Y0 = sfs + dt*(F0U + sum(FU))
+    if not finite_genome:
+        Y0 += dt*B
+    Y = Y0
+    for i in axes:
+        Y = _apply_axes(Y - theta*dt*FU[i], slv[i], (i,), threads)
+    Z = Y0 + theta*dt*(F0(Y) - F0U)
+    for i in axes:
+        Z = _apply_axes(Z - theta*dt*FU[i], slv[i], (i,), threads)
+    return Z
+
+@_scoped_threads
 def integrate_nD(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, m=None, theta=1.0, adapt_dt=False,
-                 finite_genome=False, theta_fd=None, theta_bd=None, frozen=[False]):
+                 finite_genome=False, theta_fd=None, theta_bd=None, frozen=[False],
+                 rtol=None, atol=1e-8, method='cn', matrix_free=False, threads=1,
+                 dtype=np.float64, Npop_tol=None):
     """
     N : total population size (vector N = (N1,...,Np))
     tf : final simulation time (/2N1 generations)
@@ -568,11 +852,25 @@ def integrate_nD(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, m=None, theta=1
     m : migration rates matrix (2D array, m[i,j] is the migration rate from pop j to pop i, normalized by 1/4N1)
     finite_genome : whether to integrate under the finite genome model
     if we integrate under finite genome model, theta_fd and theta_bd should be given
+    rtol, atol : if rtol is given, the time step is controlled by an estimate of
+      the local error instead of dt_fac (see _integrate_adaptive)
+    method : 'cn' for Crank-Nicolson time steps, 'expm' for the exponential
+      integrator (constant Npop only, see _integrate_expm)
+    matrix_free : if True, the operators are applied along the axes of the
+      spectrum without assembling the matrices of couples of pops and the
+      time steps are ADI steps (see _kron_step)
+    threads : number of threads sharing the slices of the spectrum in the
+      updates (see _apply_axes)
+    dtype : storage type of the spectrum and of the explicit operators
+      during the integration (see _as_dtype)
+    Npop_tol : if given with a callable Npop, the population sizes are rounded
+      to log-spaced values within this relative tolerance so that the
+      factorizations are reused (see _quantize_N)
     for a "lambda" definition of N - with backward Euler integration scheme
     where t is the relative time in generations such as t = 0 initially
     Npop is a lambda function of the time t returning the vector N = (N1,...,Np) or directly the vector if N does not evolve in time
     """
-    sfs0 = np.array(sfs0)
+    sfs0 = np.array(sfs0, dtype=dtype)
     n = np.array(sfs0.shape)-1
     
     # neutral case if the parameters are not provided
@@ -642,45 +940,121 @@ def integrate_nD(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, m=None, theta=1
     Nold = N.copy()
     Neff = N
 
-    # number of "directions" for the splitting
-    nbp = int(len(n) * (len(n)-1) / 2)
-    if len(n) == 1: nbp = 1
-    # we compute the matrices we will need
-    ljk = [jk.calcJK13(int(dims[i] - 1)) for i in range(len(dims))]
-    ljk2 = [jk.calcJK23(int(dims[i] - 1)) for i in range(len(dims))]
-    
+    # mutations
+    if finite_genome == False:
+        B = _calcB(dims, u)
+    else:
+        B = _calcB_FB(dims, u, v)
+    B = _as_dtype(B, dtype)
+
+    if matrix_free:
+        if method != 'cn':
+            raise ValueError("The matrix-free mode only supports method='cn'.")
+        vd, L0, cross = _kron_ops(dims, s, h, mm)
+        # the axis operators are small, we keep them for each step size
+        cache = OperatorCache()
+        def step(sfs, t, dt):
+            if callable(Npop):
+                Neff = Numerics.compute_N_effective(Npop, 0.5*t, 0.5*(t+dt))
+                Neff = _quantize_N(Neff, Npop_tol)
+            else:
+                Neff = N
+            key = (dt, tuple(np.asarray(Neff, dtype=float).ravel()))
+            ops = cache.get(key)
+            if ops is None:
+                L, slv, nbytes = _kron_solvers(vd, L0, Neff, dt, dtype=dtype)
+                ops = (L, slv)
+                cache.put(key, ops, nbytes)
+            return _kron_step(sfs, ops[0], ops[1], cross, B, dt, finite_genome,
+                              threads=threads)
+        if rtol is not None:
+            dt = min(compute_dt(N, mm, s, h), Tmax * dt_fac)
+            sfs = _integrate_adaptive(sfs0, Tmax, step, dt, rtol, atol)
+        else:
+            t = 0.0
+            sfs = sfs0
+            while t < Tmax:
+                if callable(Npop):
+                    N = _quantize_N(np.array(Npop(t / 2.0)), Npop_tol)
+                dt = min(compute_dt(N, mm, s, h), Tmax * dt_fac, Tmax - t)
+                sfs = step(sfs, t, dt)
+                t += dt
+        if finite_genome == False:
+            return moments.Spectrum_mod.Spectrum(sfs)
+        else:
+            return moments.Spectrum_mod.Spectrum(sfs, mask_corners=False)
+
+    # "directions" for the splitting: couples of pops exchanging migrants
+    # and pops without migration
+    blocks = _blocks(len(n), mm)
+    w = _weights(len(n), blocks)
+    # we get the matrices we will need (see Operators)
     # drift
-    vd = _calcD(dims)
-    D = _buildD(vd, dims, N)
+    vd = _calcD(dims, blocks)
+    D = _buildD(vd, blocks, N, w)
     
     # selection part 1
-    vs = _calcS(dims, ljk)
-    S1 = _buildS(vs, dims, s, h)
+    vs = _calcS(dims, blocks)
+    S1 = _buildS(vs, blocks, s, h, w)
     
     # selection part 2
-    vs2 = _calcS2(dims, ljk2)
-    S2 = _buildS2(vs2, dims, s, h)
+    vs2 = _calcS2(dims, blocks)
+    S2 = _buildS2(vs2, blocks, s, h, w)
     
     # migration
-    vm = _calcM(dims, ljk)
-    Mi = _buildM(vm, dims, mm)
-    
-    # mutations
-    if finite_genome == False:
-        B = _calcB(dims, u)
-    else:
-        B = _calcB_FB(dims, u, v)
+    vm = _calcM(dims, blocks)
+    Mi = _buildM(vm, blocks, mm)
     
+    if method == 'expm':
+        if callable(Npop):
+            raise ValueError("method='expm' requires constant population sizes.")
+        ops = [D[i]+S1[i]+S2[i]+Mi[i] for i in range(len(blocks))]
+        sfs = _integrate_expm(sfs0, ops, blocks, B, Tmax, finite_genome)
+        if finite_genome == False:
+            return moments.Spectrum_mod.Spectrum(sfs)
+        else:
+            return moments.Spectrum_mod.Spectrum(sfs, mask_corners=False)
+    elif method != 'cn':
+        raise ValueError("Unknown integration method: %s" % method)
+
     # indexes for the permutation trick
-    order = list(range(nbp))
+    order = list(range(len(blocks)))
 
     # time step splitting
     split_dt = 1.0
     if len(n) > 2: split_dt = 2.0*len(n)
 
+    if rtol is not None:
+        # operators reused between steps of the same size
+        cache = _operator_cache
+        if cache is None:
+            cache = OperatorCache()
+        def step(sfs, t, dt):
+            if callable(Npop):
+                Neff = Numerics.compute_N_effective(Npop, 0.5*t, 0.5*(t+dt))
+                Neff = _quantize_N(Neff, Npop_tol)
+            else:
+                Neff = N
+            slv, Q = _nD_ops(cache, dims, Neff, dt, split_dt, s, h, mm,
+                             vd, blocks, w, S1, S2, Mi, dtype)
+            return _nD_step(sfs, Q, slv, B, dt, blocks, order, split_dt,
+                            finite_genome, threads)
+        dt = min(compute_dt(N, mm, s, h), Tmax * dt_fac)
+        sfs = _integrate_adaptive(sfs0, Tmax, step, dt, rtol, atol)
+        if finite_genome == False:
+            return moments.Spectrum_mod.Spectrum(sfs)
+        else:
+            return moments.Spectrum_mod.Spectrum(sfs, mask_corners=False)
+
     # indicator of negative entries
     neg = False
 
+    # with Npop_tol, the operators of each bucket of sizes are kept during
+    # the call (see Integration_nomig.integrate_nomig)
+    cache = _operator_cache
+    if cache is None and Npop_tol is not None:
+        cache = OperatorCache()
+
     # time loop:
     t = 0.0
     sfs = sfs0
@@ -726,38 +1100,17 @@ def integrate_nD(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, m=None, theta=1
                     print("consider reducing timestep factor dt_fac in integrate function")
                     print("currently %2.2f" % dt_fac)
                     break
-        
+            N = _quantize_N(N, Npop_tol)
+            Neff = _quantize_N(Neff, Npop_tol)
             
         # we recompute the matrix only if N has changed...
         if t == 0.0 or (Nold != N).any() or dt != dt_old or neg == True:
-            D = _buildD(vd, dims, Neff)
-            # system inversion for backward scheme
-            slv = [linalg.factorized(sp.sparse.identity(S1[i].shape[0], dtype='float', format='csc') 
-                   - dt/2.0/split_dt*(1.0/(max(len(n), 2)-1)*(D[i]+S1[i]+S2[i])+Mi[i])) for i in range(nbp)]
-            Q = [sp.sparse.identity(S1[i].shape[0], dtype='float', format='csc')
-                 + dt/2.0/split_dt*(1.0/(max(len(n), 2)-1)*(D[i]+S1[i]+S2[i])+Mi[i]) for i in range(nbp)]
+            slv, Q = _nD_ops(cache, dims, Neff, dt, split_dt, s, h, mm,
+                             vd, blocks, w, S1, S2, Mi, dtype)
             
         # drift, selection and migration (depends on the dimension)
-        if len(n) == 1:
-            sfs = Q[0].dot(sfs)
-            if finite_genome == False:
-                sfs = slv[0](sfs + dt*B)
-            else:
-                sfs = slv[0](sfs + (dt*B).dot(sfs))
-        elif len(n) > 1:
-            if finite_genome == False:
-                for i in range(int(split_dt)):
-                    sfs = _update_step1(sfs, Q, dims, order)
-                    sfs += dt / split_dt * B
-                    sfs = _update_step2(sfs, slv, dims, order)
-                    order = _permute(order)
-            else:
-                for i in range(int(split_dt)):
-                    sfs = _update_step1(sfs, Q, dims, order)
-                    for j in range(len(n)):
-                        sfs = sfs + (dt/split_dt*B[j]).dot(sfs.flatten()).reshape(n+1)
-                    sfs = _update_step2(sfs, slv, dims, order)
-                    order = _permute(order)
+        sfs = _nD_step(sfs, Q, slv, B, dt, blocks, order, split_dt,
+                       finite_genome, threads)
         
         if (sfs<0).any() and adapt_dt:
             neg = True
@@ -775,3 +1128,190 @@ def integrate_nD(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, m=None, theta=1
         return moments.Spectrum_mod.Spectrum(sfs)
     else:
         return moments.Spectrum_mod.Spectrum(sfs, mask_corners=False)
+
+
+#---------------------------------------------
+# batched integration over selection values  -
+#---------------------------------------------
+# For the inference of a distribution of fitness effects the same demography
+# is integrated for a grid of selection coefficients. The spectra of all the
+# gammas are evolved together on a common time grid (the step of the
+# strongest selection), so that the drift, migration and mutation operators,
+# the effective sizes and the step sizes are computed once per step for the
+# whole batch. Only the factorizations depend on gamma.
+@_scoped_threads
+def integrate_gamma_batch(sfs0, Npop, tf, gammas, dt_fac=0.02, h=None, m=None,
+                          theta=1.0, finite_genome=False, theta_fd=None,
+                          theta_bd=None, frozen=[False], threads=1,
+                          dtype=np.float64, Npop_tol=None):
+    """
+    sfs0 : initial spectrum (shared by all gammas) or stack of spectra with
+      one spectrum per gamma along the first axis
+    Npop, tf, h, m, theta, finite_genome, theta_fd, theta_bd, frozen, dtype,
+      Npop_tol : as in integrate_nD
+    gammas : selection coefficients, either one value per spectrum (the same
+      in all pops) or an array of shape (number of gammas, number of pops)
+    dt_fac : maximal time step, relative to tf (as in Spectrum.integrate)
+    threads : number of threads sharing the gammas (the factorizations and
+      the solves release the GIL)
+
+    Returns a 2D array (gammas x entries): row i is the flattened spectrum
+    for gammas[i] (reshape it to the shape of the spectrum to use it).
+    """
+    N = np.array(Npop(0) if callable(Npop) else Npop, dtype=float)
+    p = len(N)
+    gammas = np.array(gammas, dtype=float)
+    G = gammas.shape[0]
+    sfs0 = np.asarray(sfs0)
+    # a single spectrum or a stack of spectra
+    shape = sfs0.shape[1:] if sfs0.ndim == p + 1 else sfs0.shape
+    n = np.array(shape) - 1
+    sfs = np.empty((G,) + tuple(shape), dtype=dtype)
+    sfs[:] = sfs0
+    if gammas.ndim == 1:
+        gammas = np.outer(gammas, np.ones(p))
+    if h is None: h = 0.5 * np.ones(p)
+    if m is None: m = np.zeros([p, p])
+    h = np.array(h)
+
+    Tmax = tf * 2.0
+    dims = np.array(n + 1, dtype=int)
+
+    u = np.array(theta if finite_genome == False else theta_fd) / 4.0 * np.ones(p)
+    if finite_genome:
+        v = np.array(theta_bd) / 4.0 * np.ones(p)
+    mm = np.array(m) / 2.0
+
+    # frozen populations, as in integrate_nD: no selection, mutation or
+    # migration, and a very large size
+    frozen = np.array(frozen)
+    if np.any(frozen):
+        frozen_pops = np.where(frozen)[0]
+        gammas[:, frozen_pops] = 0.0
+        if callable(Npop):
+            nu_func = Npop
+            Npop = lambda t: np.array(nu_func(t)) * (1-frozen) + 1e40*frozen
+        N = N * (1-frozen) + 1e40*frozen
+        u *= (1-frozen)
+        if finite_genome:
+            v *= (1-frozen)
+        mm[:, frozen_pops] = 0.0
+        mm[frozen_pops, :] = 0.0
+
+    # the demography dependent parts, shared by all gammas
+    if finite_genome == False:
+        B = _calcB(dims, u)
+    else:
+        B = _calcB_FB(dims, u, v)
+    B = _as_dtype(B, dtype)
+    blocks = _blocks(p, mm)
+    w = _weights(p, blocks)
+    vd = _calcD(dims, blocks)
+    vs = _calcS(dims, blocks)
+    vs2 = _calcS2(dims, blocks)
+    Mi = _buildM(_calcM(dims, blocks), blocks, mm)
+    # the selection operators only depend on gamma: for each block, the
+    # operators are stored as data arrays on a common sparsity pattern, so
+    # that the matrices of a step are combined without sparse additions
+    L = [[S1[i] + S2[i] + Mi[i] for i in range(len(blocks))]
+         for S1, S2 in [(_buildS(vs, blocks, s, h, w), _buildS2(vs2, blocks, s, h, w))
+                        for s in gammas]]
+    patterns, Id, vd_data, L_data = [], [], [], []
+    for i in range(len(blocks)):
+        T = _pattern(vd[i] + [L[g][i] for g in range(G)])
+        lin = _linear_index(T)
+        patterns.append(T)
+        Id.append(_align(lin, sp.sparse.identity(T.shape[0])))
+        vd_data.append([_align(lin, A) for A in vd[i]])
+        L_data.append([_align(lin, L[g][i]) for g in range(G)])
+
+    order = list(range(len(blocks)))
+    split_dt = 1.0
+    if p > 2: split_dt = 2.0 * p
+    pool_map = threads.map
+
+    # with Npop_tol, the operators of each bucket of sizes are kept during
+    # the call (see integrate_nD)
+    cache = OperatorCache() if Npop_tol is not None else None
+
+    def factorize(Neff, dt):
+        if cache is not None:
+            key = (tuple(np.asarray(Neff, dtype=float).ravel()), dt)
+            ops = cache.get(key)
+            if ops is not None:
+                return ops
+        # drift part, shared by the gammas
+        D = [sum(w[ax]/(4*Neff[ax])*vd_data[i][k] for k, ax in enumerate(b))
+             for i, b in enumerate(blocks)]
+        def ops(g):
+            slv, Q = [], []
+            nbytes = 0
+            for i, T in enumerate(patterns):
+                A = dt/2.0/split_dt * (D[i] + L_data[i][g])
+                lu = linalg.splu(sp.sparse.csc_matrix((Id[i] - A, T.indices, T.indptr),
+                                                      shape=T.shape))
+                slv.append(lu.solve)
+                Q.append(sp.sparse.csc_matrix(((Id[i] + A).astype(dtype), T.indices,
+                                               T.indptr), shape=T.shape))
+                nbytes += 12 * (lu.L.nnz + lu.U.nnz) + _sparse_nbytes(Q[-1])
+            return slv, Q, nbytes
+        res = pool_map(ops, range(G))
+        ops = [(slv, Q) for slv, Q, _ in res]
+        if cache is not None:
+            cache.put(key, ops, sum(nbytes for _, _, nbytes in res))
+        return ops
+
+    t = 0.0
+    Nold, dt_old, ops = None, None, None
+    while t < Tmax:
+        # common step: the smallest one over the gammas
+        dt = min([compute_dt(N, mm, s, h) for s in gammas] + [Tmax * dt_fac])
+        dt = min(dt, Tmax - t)
+        if callable(Npop):
+            N = _quantize_N(np.array(Npop((t + dt) / 2.0), dtype=float), Npop_tol)
+            Neff = _quantize_N(Numerics.compute_N_effective(Npop, 0.5*t, 0.5*(t+dt)),
+                               Npop_tol)
+        else:
+            Neff = N
+        if ops is None or (N != Nold).any() or dt != dt_old:
+            ops = factorize(Neff, dt)
+        # each spectrum gets the same sequence of splitting orders
+        def update(i):
+            o = list(order)
+            sfs[i] = _nD_step(sfs[i], ops[i][1], ops[i][0], B, dt, blocks, o,
+                              split_dt, finite_genome)
+            return o
+        order[:] = pool_map(update, range(G))[-1]
+        Nold, dt_old = N, dt
+        t += dt
+
+    return sfs.reshape(G, -1)
+
+def _pattern(mats):
+    """
+    Common sparsity pattern (CSC, sorted indices) of the identity and of the
+    matrices mats.
+    """
+    T = sp.sparse.identity(mats[0].shape[0], format='csc')
+    for A in mats:
+        T = T + abs(A)
+    T = sp.sparse.csc_matrix(T)
+    T.sort_indices()
+    return T
+
+def _linear_index(T):
+    """
+    Column-major linear index of the entries of the CSC matrix T (sorted).
+    """
+    col = np.repeat(np.arange(T.shape[1]), np.diff(T.indptr))
+    return col * T.shape[0] + T.indices
+
+def _align(lin, A):
+    """
+    Data of the sparse matrix A on the pattern of linear index lin
+    (see _linear_index), which must contain the entries of A.
+    """
+    A = sp.sparse.coo_matrix(A)
+    res = np.zeros(len(lin))
+    np.add.at(res, np.searchsorted(lin, A.col * A.shape[0] + A.row), A.data)
+    return res
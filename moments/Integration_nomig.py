@@ -9,6 +9,7 @@ import LinearSystem_1D as ls1
 import LinearSystem_2D as ls2
 import Tridiag_solve as ts
 from . import Integration
+from . import Operators
 import copy
 #------------------------------------------------------------------------------
 # Functions for the computation of the Phi-moments for multidimensional models
@@ -70,313 +71,120 @@ def _calcB_FB(dims, u, v):
 # we solve a system like PX = QY
 # step 1 functions correspond to the QY computation
 # and step 2 to the resolution of PX = Y'
-
-# 2D
-# step 1
-def _ud1_2pop_1(sfs, Q):
-    sfs = Q[0].dot(sfs)
-    return sfs
-
-def _ud1_2pop_2(sfs, Q):
-    sfs = Q[1].dot(sfs.transpose()).transpose()
-    return sfs
-
-# step 2
-def _ud2_2pop_1(sfs, slv):
-    for i in range(int(sfs.shape[1])):
-        sfs[:, i] = slv[0](sfs[:, i])
-    return sfs
-
-def _ud2_2pop_2(sfs, slv):
-    for i in range(int(sfs.shape[0])):
-        sfs[i, :] = slv[1](sfs[i, :])
-    return sfs
-
-# for 3D, 4D and 5D cases, each couple of directions are coded separately to simplify the permutations...
-#------------------------------
-# 3D
-# step 1
-
-def _ud1_3pop_1(sfs, Q):
-    dims = sfs.shape
-    dim2 = np.prod(dims[1::])
-    sfs = Q[0].dot(sfs.reshape(dims[0], dim2)).reshape(dims)
-    return sfs
-
-def _ud1_3pop_2(sfs, Q):
-    Q = [Q[1]]
-    sfs = _ud1_3pop_1(np.transpose(sfs, (1, 0, 2)), Q)
-    return np.transpose(sfs, (1, 0, 2))
-
-def _ud1_3pop_3(sfs, Q):
-    Q = [Q[2]]
-    sfs = _ud1_3pop_1(np.transpose(sfs, (2, 1, 0)), Q)
-    return np.transpose(sfs, (2, 1, 0))
-
-# step 2
-def _ud2_3pop_1(sfs, slv):
-    for i in range(int(sfs.shape[2])):
-        for j in range(int(sfs.shape[1])):
-            sfs[:, j, i] = slv[0](sfs[:, j, i])
-    return sfs
-
-def _ud2_3pop_2(sfs, slv):
-    for i in range(int(sfs.shape[2])):
-        for j in range(int(sfs.shape[0])):
-            sfs[j, :, i] = slv[1](sfs[j, :, i])
-    return sfs
-
-def _ud2_3pop_3(sfs, slv):
-    for i in range(int(sfs.shape[1])):
-        for j in range(int(sfs.shape[0])):
-            sfs[j, i, :] = slv[2](sfs[j, i, :])
-    return sfs
-
-#------------------------------
-# 4D
-# step 1
-def _ud1_4pop_1(sfs, Q):
-    return _ud1_3pop_1(sfs, Q)
-
-def _ud1_4pop_2(sfs, Q):
-    Q = [Q[1]]
-    sfs = _ud1_4pop_1(np.transpose(sfs, (1, 0, 2, 3)), Q)
-    return np.transpose(sfs, (1, 0, 2, 3))
-
-def _ud1_4pop_3(sfs, Q):
-    Q = [Q[2]]
-    sfs = _ud1_4pop_1(np.transpose(sfs, (2, 1, 0, 3)), Q)
-    return np.transpose(sfs, (2, 1, 0, 3))
-
-def _ud1_4pop_4(sfs, Q):
-    Q = [Q[3]]
-    sfs = _ud1_4pop_1(np.transpose(sfs, (3, 1, 2, 0)), Q)
-    return np.transpose(sfs, (3, 1, 2, 0))
-
-# step 2
-def _ud2_4pop_1(sfs, slv):
-    for i in range(int(sfs.shape[1])):
-        for j in range(int(sfs.shape[2])):
-            for k in range(int(sfs.shape[3])):
-                sfs[:, i, j, k] = slv[0](sfs[:, i, j, k])
-    return sfs
-
-def _ud2_4pop_2(sfs, slv):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[2])):
-            for k in range(int(sfs.shape[3])):
-                sfs[i, :, j, k] = slv[1](sfs[i, :, j, k])
-    return sfs
-
-def _ud2_4pop_3(sfs, slv):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[3])):
-                sfs[i, j, :, k] = slv[2](sfs[i, j, :, k])
-    return sfs
-
-def _ud2_4pop_4(sfs, slv):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[2])):
-                sfs[i, j, k, :] = slv[3](sfs[i, j, k, :])
-    return sfs
-
-
-
-#------------------------------
-# 5D
-# step 1
-
-def _ud1_5pop_1(sfs, Q):
-    return _ud1_3pop_1(sfs, Q)
-
-def _ud1_5pop_2(sfs, Q):
-    Q = [Q[1]]
-    sfs = _ud1_5pop_1(np.transpose(sfs, (1, 0, 2, 3, 4)), Q)
-    return np.transpose(sfs, (1, 0, 2, 3, 4))
-
-def _ud1_5pop_3(sfs, Q):
-    Q = [Q[2]]
-    sfs = _ud1_5pop_1(np.transpose(sfs, (2, 1, 0, 3, 4)), Q)
-    return np.transpose(sfs, (2, 1, 0, 3, 4))
-
-def _ud1_5pop_4(sfs, Q):
-    Q = [Q[3]]
-    sfs = _ud1_5pop_1(np.transpose(sfs, (3, 1, 2, 0, 4)), Q)
-    return np.transpose(sfs, (3, 1, 2, 0, 4))
-
-def _ud1_5pop_5(sfs, Q):
-    Q = [Q[4]]
-    sfs = _ud1_5pop_1(np.transpose(sfs, (4, 1, 2, 3, 0)), Q)
-    return np.transpose(sfs, (4, 1, 2, 3, 0))
-
-# step 2
-def _ud2_5pop_1(sfs, slv):
-    for i in range(int(sfs.shape[1])):
-        for j in range(int(sfs.shape[2])):
-            for k in range(int(sfs.shape[3])):
-                for l in range(int(sfs.shape[4])):
-                    sfs[:, i, j, k, l] = slv[0](sfs[:, i, j, k, l])
-    return sfs
-
-def _ud2_5pop_2(sfs, slv):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[2])):
-            for k in range(int(sfs.shape[3])):
-                for l in range(int(sfs.shape[4])):
-                    sfs[i, :, j, k, l] = slv[1](sfs[i, :, j, k, l])
-    return sfs
-
-def _ud2_5pop_3(sfs, slv):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[3])):
-                for l in range(int(sfs.shape[4])):
-                    sfs[i, j, :, k, l] = slv[2](sfs[i, j, :, k, l])
-    return sfs
-
-def _ud2_5pop_4(sfs, slv):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[2])):
-                for l in range(int(sfs.shape[4])):
-                    sfs[i, j, k, :, l] = slv[3](sfs[i, j, k, :, l])
-    return sfs
-
-def _ud2_5pop_5(sfs, slv):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[2])):
-                for l in range(int(sfs.shape[3])):
-                    sfs[i, j, k, l, :] = slv[4](sfs[i, j, k, l, :])
-    return sfs
-
-# neutral case step 2 (tridiag solver)
-# 2D
-def _udn2_2pop_1(sfs, A, Di, C):
-    for i in range(int(sfs.shape[1])):
-        sfs[:, i] = ts.solve(A[0], Di[0], C[0], sfs[:, i])
-    return sfs
-
-def _udn2_2pop_2(sfs, A, Di, C):
-    for i in range(int(sfs.shape[0])):
-        sfs[i, :] = ts.solve(A[1], Di[1], C[1], sfs[i, :])
-    return sfs
-
-# 3D
-def _udn2_3pop_1(sfs, A, Di, C):
-    for i in range(int(sfs.shape[2])):
-        for j in range(int(sfs.shape[1])):
-            sfs[:, j, i] = ts.solve(A[0], Di[0], C[0], sfs[:, j, i])
-    return sfs
-
-def _udn2_3pop_2(sfs, A, Di, C):
-    for i in range(int(sfs.shape[2])):
-        for j in range(int(sfs.shape[0])):
-            sfs[j, :, i] = ts.solve(A[1], Di[1], C[1], sfs[j, :, i])
-    return sfs
-
-def _udn2_3pop_3(sfs, A, Di, C):
-    for i in range(int(sfs.shape[1])):
-        for j in range(int(sfs.shape[0])):
-            sfs[j, i, :] = ts.solve(A[2], Di[2], C[2], sfs[j, i, :])
-    return sfs
-
-# 4D
-def _udn2_4pop_1(sfs, A, Di, C):
-    for i in range(int(sfs.shape[1])):
-        for j in range(int(sfs.shape[2])):
-            for k in range(int(sfs.shape[3])):
-                sfs[:, i, j, k] = ts.solve(A[0], Di[0], C[0], sfs[:, i, j, k])
-    return sfs
-
-def _udn2_4pop_2(sfs, A, Di, C):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[2])):
-            for k in range(int(sfs.shape[3])):
-                sfs[i, :, j, k] = ts.solve(A[1], Di[1], C[1], sfs[i, :, j, k])
-    return sfs
-
-def _udn2_4pop_3(sfs, A, Di, C):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[3])):
-                sfs[i, j, :, k] = ts.solve(A[2], Di[2], C[2], sfs[i, j, :, k])
-    return sfs
-
-def _udn2_4pop_4(sfs, A, Di, C):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[2])):
-                sfs[i, j, k, :] = ts.solve(A[3], Di[3], C[3], sfs[i, j, k, :])
-    return sfs
-
-# 5D
-def _udn2_5pop_1(sfs, A, Di, C):
-    for i in range(int(sfs.shape[1])):
-        for j in range(int(sfs.shape[2])):
-            for k in range(int(sfs.shape[3])):
-                for l in range(int(sfs.shape[4])):
-                    sfs[:, i, j, k, l] = ts.solve(A[0], Di[0], C[0], sfs[:, i, j, k, l])
-    return sfs
-
-def _udn2_5pop_2(sfs, A, Di, C):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[2])):
-            for k in range(int(sfs.shape[3])):
-                for l in range(int(sfs.shape[4])):
-                    sfs[i, :, j, k, l] = ts.solve(A[1], Di[1], C[1], sfs[i, :, j, k, l])
-    return sfs
-
-def _udn2_5pop_3(sfs, A, Di, C):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[3])):
-                for l in range(int(sfs.shape[4])):
-                    sfs[i, j, :, k, l] = ts.solve(A[2], Di[2], C[2], sfs[i, j, :, k, l])
-    return sfs
-
-def _udn2_5pop_4(sfs, A, Di, C):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[2])):
-                for l in range(int(sfs.shape[4])):
-                    sfs[i, j, k, :, l] = ts.solve(A[3], Di[3], C[3], sfs[i, j, k, :, l])
-    return sfs
-
-def _udn2_5pop_5(sfs, A, Di, C):
-    for i in range(int(sfs.shape[0])):
-        for j in range(int(sfs.shape[1])):
-            for k in range(int(sfs.shape[2])):
-                for l in range(int(sfs.shape[3])):
-                    sfs[i, j, k, l, :] = ts.solve(A[4], Di[4], C[4], sfs[i, j, k, l, :])
-    return sfs
+# Each population is updated along its own axis, all the 1D slices of the
+# spectrum along that axis being processed at once (see Integration._apply_axes).
 
 # sfs update 
-def _update_step1(sfs, Q):
+def _update_step1(sfs, Q, threads=1):
     assert(len(Q) == len(sfs.shape))
     for i in range(len(sfs.shape)):
-        sfs = eval('_ud1_'+str(len(sfs.shape))+'pop_'+str(i+1)+'(sfs, Q)')
+        sfs = Integration._apply_axes(sfs, Q[i].dot, (i,), threads)
     return sfs
 
-def _update_step2(sfs, slv):
+def _update_step2(sfs, slv, threads=1):
     assert(len(slv) == len(sfs.shape))
     for i in range(len(sfs.shape)):
-        sfs = eval('_ud2_'+str(len(sfs.shape))+'pop_'+str(i+1)+'(sfs, slv)')
+        sfs = Integration._apply_axes(sfs, slv[i], (i,), threads)
     return sfs
 
-def _update_step2_neutral(sfs, A, Di, C):
+# neutral case step 2 (tridiag solver)
+def _update_step2_neutral(sfs, A, Di, C, threads=1):
     assert(len(A) == len(sfs.shape))
     for i in range(len(sfs.shape)):
-        sfs = eval('_udn2_'+str(len(sfs.shape))+'pop_'+str(i+1)+'(sfs, A, Di, C)')
+        sfs = Integration._apply_axes(sfs,
+                  lambda b, out=None: ts.solve_2D(A[i], Di[i], C[i],
+                                                  np.asarray(b, dtype=np.float64),
+                                                  out=out),
+                  (i,), threads, out_arg=True)
     return sfs
 
 
+def _nomig_ops(dt, Neff, vd, S1, S2, dtype=np.float64):
+    """
+    Operators (slv, Q) of a time step of size dt for the effective sizes
+    Neff, and their memory footprint.
+    """
+    slv, Q = [], []
+    nbytes = 0
+    for i in range(len(vd)):
+        A = dt/2.0*(1.0 / 4 / Neff[i] * vd[i] + S1[i] + S2[i])
+        Id = sp.sparse.identity(S1[i].shape[0], dtype='float', format='csc')
+        # system inversion for backward scheme
+        lu = linalg.splu(sp.sparse.csc_matrix(Id - A))
+        slv.append(lu.solve)
+        Q.append((Id + A).astype(dtype))
+        nbytes += 12 * (lu.L.nnz + lu.U.nnz) + Integration._sparse_nbytes(Q[-1])
+    return slv, Q, nbytes
+
+def _nomig_cached_ops(cache, dims, Neff, dt, s, h, vd, S1, S2,
+                      dtype=np.float64):
+    """
+    Operators (slv, Q) of _nomig_ops, looked up in cache first if one is
+    given (see Integration.OperatorCache).
+    """
+    if cache is not None:
+        # the operators only depend on these quantities
+        key = ('nomig', tuple(dims), tuple(np.asarray(Neff, dtype=float).ravel()),
+               dt, tuple(s), tuple(h), np.dtype(dtype).str)
+        ops = cache.get(key)
+        if ops is not None:
+            return ops
+    slv, Q, nbytes = _nomig_ops(dt, Neff, vd, S1, S2, dtype)
+    if cache is not None:
+        cache.put(key, (slv, Q), nbytes)
+    return slv, Q
+
+def _neutral_ops(cache, dims, Neff, dt, vd, diags, dtype=np.float64):
+    """
+    Factorized tridiagonal systems (A, Di, C) and explicit operators Q of a
+    neutral time step of size dt, looked up in cache first if one is given.
+    """
+    if cache is not None:
+        key = ('neutral', tuple(dims), tuple(np.asarray(Neff, dtype=float).ravel()),
+               dt, np.dtype(dtype).str)
+        ops = cache.get(key)
+        if ops is not None:
+            return ops
+    n = len(dims)
+    D = [1.0 / 4 / Neff[i] * vd[i] for i in range(n)]
+    A = [-0.5 * dt/ 4 / Neff[i] * diags[i][0] for i in range(n)]
+    Di = [np.ones(dims[i])-0.5 * dt / 4 / Neff[i] * diags[i][1] for i in range(n)]
+    C = [-0.5 * dt/ 4 / Neff[i] * diags[i][2] for i in range(n)]
+    # system inversion for backward scheme
+    for i in range(n):
+        ts.factor(A[i], Di[i], C[i])
+    Q = [(np.eye(dims[i]) + 0.5*dt*D[i]).astype(dtype) for i in range(n)]
+    if cache is not None:
+        nbytes = sum(x.nbytes for x in A + Di + C + Q)
+        cache.put(key, (A, Di, C, Q), nbytes)
+    return A, Di, C, Q
+
+def _nomig_step(sfs, Q, slv, B, dt, finite_genome, threads=1):
+    """
+    Crank-Nicolson step of size dt, the input spectrum is left unchanged.
+    """
+    n = np.array(sfs.shape) - 1
+    if len(n) == 1:
+        sfs = Q[0].dot(sfs)
+        if finite_genome == False:
+            sfs = slv[0](sfs + dt*B)
+        else:
+            sfs = slv[0](sfs + (dt*B).dot(sfs))
+    else:
+        sfs = _update_step1(sfs, Q, threads)
+        if finite_genome == False:
+            sfs = sfs + dt*B
+        else:
+            for i in range(len(n)):
+                sfs = sfs + (dt*B[i]).dot(sfs.flatten()).reshape(n+1)
+        sfs = _update_step2(sfs, slv, threads)
+    return sfs
 
-
+@Integration._scoped_threads
 def integrate_nomig(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, theta=1.0, adapt_tstep=False,
-                    finite_genome=False, theta_fd=None, theta_bd=None, frozen=[False]):
+                    finite_genome=False, theta_fd=None, theta_bd=None, frozen=[False],
+                    rtol=None, atol=1e-8, method='cn', threads=1, dtype=np.float64,
+                    Npop_tol=None):
     """
     Integration in time
     tf : final simulation time (/2N1 generations)
@@ -385,13 +193,24 @@ def integrate_nomig(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, theta=1.0, a
     h : allele dominance (vector h = (h1,...,hp))
     m : migration rates matrix (2D array, m[i,j] is the migration rate
       from pop j to pop i, normalized by 1/4N1)
+    rtol, atol : if rtol is given, the time step is controlled by an estimate
+      of the local error instead of dt_fac (see Integration._integrate_adaptive)
+    method : 'cn' for Crank-Nicolson time steps, 'expm' for the exponential
+      integrator (constant Npop only, see Integration._integrate_expm)
+    threads : number of threads sharing the slices of the spectrum in the
+      updates (see Integration._apply_axes)
+    dtype : storage type of the spectrum and of the explicit operators
+      during the integration (see Integration._as_dtype)
+    Npop_tol : if given with a callable Npop, the population sizes are rounded
+      to log-spaced values within this relative tolerance so that the
+      factorizations are reused (see Integration._quantize_N)
 
     for a "lambda" definition of N - with backward Euler integration scheme
     where t is the relative time in generations such as t = 0 initially
     Npop is a lambda function of the time t returning the vector N = (N1,...,Np)
       or directly the vector if N does not evolve in time\n
     """
-    sfs0 = np.array(sfs0)
+    sfs0 = np.array(sfs0, dtype=dtype)
     n = np.array(sfs0.shape)-1
 
     # neutral case if the parameters are not provided
@@ -465,20 +284,18 @@ def integrate_nomig(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, theta=1.0, a
     # effective pop size for the integration
     Neff = N
     
-    # we compute the matrices we will need
-    ljk = [jk.calcJK13(int(dims[i] - 1)) for i in range(len(dims))]
-    ljk2 = [jk.calcJK23(int(dims[i] - 1)) for i in range(len(dims))]
+    # we get the matrices we will need (see Operators)
     
     # drift
-    vd = [ls1.calcD(np.array(dims[i])) for i in range(len(dims))]
+    vd = [Operators.get('D', dims[i]) for i in range(len(dims))]
     D = [1.0 / 4 / N[i] * vd[i] for i in range(len(dims))]
     
     # selection part 1
-    vs = [ls1.calcS(dims[i], ljk[i]) for i in range(len(n))]
+    vs = [Operators.get('S', dims[i]) for i in range(len(n))]
     S1 = [s[i] * h[i] * vs[i] for i in range(len(n))]
 
     # selection part 2
-    vs2 = [ls1.calcS2(dims[i], ljk2[i]) for i in range(len(n))]
+    vs2 = [Operators.get('S2', dims[i]) for i in range(len(n))]
     S2 = [s[i] * (1-2.0*h[i]) * vs2[i] for i in range(len(n))]
     
     # mutations
@@ -486,7 +303,49 @@ def integrate_nomig(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, theta=1.0, a
         B = _calcB(dims, u)
     else:
         B = _calcB_FB(dims, u, v)
+    B = Integration._as_dtype(B, dtype)
     
+    if method == 'expm':
+        if callable(Npop):
+            raise ValueError("method='expm' requires constant population sizes.")
+        ops = [D[i]+S1[i]+S2[i] for i in range(len(dims))]
+        axes = [(i,) for i in range(len(dims))]
+        sfs = Integration._integrate_expm(sfs0, ops, axes, B, Tmax, finite_genome)
+        if finite_genome == False:
+            return moments.Spectrum_mod.Spectrum(sfs)
+        else:
+            return moments.Spectrum_mod.Spectrum(sfs, mask_corners=False)
+    elif method != 'cn':
+        raise ValueError("Unknown integration method: %s" % method)
+
+    if rtol is not None:
+        # operators reused between steps of the same size
+        cache = Integration._operator_cache
+        if cache is None:
+            cache = Integration.OperatorCache()
+        def step(sfs, t, dt):
+            if callable(Npop):
+                Neff = Numerics.compute_N_effective(Npop, 0.5*t, 0.5*(t+dt))
+                Neff = Integration._quantize_N(Neff, Npop_tol)
+            else:
+                Neff = N
+            slv, Q = _nomig_cached_ops(cache, dims, Neff, dt, s, h, vd, S1, S2,
+                                       dtype)
+            return _nomig_step(sfs, Q, slv, B, dt, finite_genome, threads)
+        dt = min(Integration.compute_dt(N, s=s, h=h), Tmax * dt_fac)
+        sfs = Integration._integrate_adaptive(sfs0, Tmax, step, dt, rtol, atol)
+        if finite_genome == False:
+            return moments.Spectrum_mod.Spectrum(sfs)
+        else:
+            return moments.Spectrum_mod.Spectrum(sfs, mask_corners=False)
+
+    # with Npop_tol, the operators of each bucket of sizes are kept during
+    # the call, so a bucket left and entered again (e.g. a bottleneck
+    # followed by a recovery) is not factorized again
+    cache = Integration._operator_cache
+    if cache is None and Npop_tol is not None:
+        cache = Integration.OperatorCache()
+
     # time loop:
     t = 0.0
     sfs = sfs0
@@ -529,31 +388,16 @@ def integrate_nomig(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, theta=1.0, a
                     print("N_old, " , Nold, "N_new", N)
                     print("relative change", np.max(np.abs(N-Nold)/Nold))
                     break
+            N = Integration._quantize_N(N, Npop_tol)
+            Neff = Integration._quantize_N(Neff, Npop_tol)
                             
         # we recompute the matrix only if N has changed...
         if t==0.0 or (Nold != N).any() or dt != dt_old:
-            D = [1.0 / 4 / Neff[i] * vd[i] for i in range(len(dims))]
-            # system inversion for backward scheme
-            slv = [linalg.factorized(sp.sparse.identity(S1[i].shape[0], dtype='float', format='csc')
-                   - dt/2.0*(D[i]+S1[i]+S2[i])) for i in range(len(n))]
-            Q = [sp.sparse.identity(S1[i].shape[0], dtype='float', format='csc')
-                 + dt/2.0*(D[i]+S1[i]+S2[i]) for i in range(len(n))]
+            slv, Q = _nomig_cached_ops(cache, dims, Neff, dt, s, h, vd, S1, S2,
+                                       dtype)
 
         # drift, selection and migration (depends on the dimension)
-        if len(n) == 1:
-            sfs = Q[0].dot(sfs)
-            if finite_genome == False:
-                sfs = slv[0](sfs + dt*B)
-            else:
-                sfs = slv[0](sfs + (dt*B).dot(sfs))
-        elif len(n) > 1:
-            sfs = _update_step1(sfs, Q)
-            if finite_genome == False:
-                sfs = sfs + dt*B
-            else:
-                for i in range(len(n)):
-                    sfs = sfs + (dt*B[i]).dot(sfs.flatten()).reshape(n+1)
-            sfs = _update_step2(sfs, slv)
+        sfs = _nomig_step(sfs, Q, slv, B, dt, finite_genome, threads)
         Nold = N
         t += dt
 
@@ -563,8 +407,10 @@ def integrate_nomig(sfs0, Npop, tf, dt_fac=0.1, gamma=None, h=None, theta=1.0, a
         return moments.Spectrum_mod.Spectrum(sfs, mask_corners=False)
 
 
+@Integration._scoped_threads
 def integrate_neutral(sfs0, Npop, tf, dt_fac=0.1, theta=1.0, adapt_tstep=False, 
-                      finite_genome = False, theta_fd=None, theta_bd=None, frozen=[False]):
+                      finite_genome = False, theta_fd=None, theta_bd=None, frozen=[False],
+                      threads=1, dtype=np.float64, Npop_tol=None):
     """ Integration in time \n
     # tf : final simulation time (/2N1 generations)\n
     # gamma : selection coefficients (vector gamma = (gamma1,...,gammap))\n
@@ -577,8 +423,12 @@ def integrate_neutral(sfs0, Npop, tf, dt_fac=0.1, theta=1.0, adapt_tstep=False,
     # where t is the relative time in generations such as t = 0 initially\n
     # Npop is a lambda function of the time t returning the vector N = (N1,...,Np)\n
     #   or directly the vector if N does not evolve in time\n
+    # threads : number of threads sharing the slices of the spectrum\n
+    # dtype : storage type of the spectrum during the integration\n
+    # Npop_tol : relative tolerance used to round the sizes of a callable
+    #   Npop (see integrate_nomig)\n
     """
-    sfs0 = np.array(sfs0)
+    sfs0 = np.array(sfs0, dtype=dtype)
     n = np.array(sfs0.shape)-1
     
     Tmax = tf * 2.0
@@ -641,7 +491,15 @@ def integrate_neutral(sfs0, Npop, tf, dt_fac=0.1, theta=1.0, adapt_tstep=False,
         B = _calcB(dims, u)
     else:
         B = _calcB_FB(dims, u, v)
+    B = Integration._as_dtype(B, dtype)
     
+    # with Npop_tol, the operators of each bucket of sizes are kept during
+    # the call, so a bucket left and entered again (e.g. a bottleneck
+    # followed by a recovery) is not factorized again
+    cache = Integration._operator_cache
+    if cache is None and Npop_tol is not None:
+        cache = Integration.OperatorCache()
+
     # time loop:
     t = 0.0
     sfs = sfs0
@@ -673,32 +531,29 @@ def integrate_neutral(sfs0, Npop, tf, dt_fac=0.1, theta=1.0, adapt_tstep=False,
                     print("N_old, " , Nold, "N_new", N)
                     print("relative change", np.max(np.abs(N-Nold)/Nold))
                     break
+            N = Integration._quantize_N(N, Npop_tol)
+            Neff = Integration._quantize_N(Neff, Npop_tol)
               
         # we recompute the matrix only if N has changed...
         if t==0.0 or (Nold != N).any() or dt != dt_old: #SG not sure why dt_old is involved here. 
-            D = [1.0 / 4 / Neff[i] * vd[i] for i in range(len(n))]
-            A = [-0.5 * dt/ 4 / Neff[i] * diags[i][0] for i in range(len(n))]
-            Di = [np.ones(dims[i])-0.5 * dt / 4 / Neff[i] * diags[i][1] for i in range(len(n))]
-            C = [-0.5 * dt/ 4 / Neff[i] * diags[i][2] for i in range(len(n))]
-            # system inversion for backward scheme
-            for i in range(len(n)):
-                ts.factor(A[i], Di[i], C[i])
-            Q = [np.eye(dims[i]) + 0.5*dt*D[i] for i in range(len(n))]
+            A, Di, C, Q = _neutral_ops(cache, dims, Neff, dt, vd, diags, dtype)
             
         # drift, selection and migration (depends on the dimension)
         if len(n) == 1:
+            # the tridiagonal solver returns float64
             if finite_genome == False:
                 sfs = ts.solve(A[0], Di[0], C[0], np.dot(Q[0], sfs) + dt*B)
             else:
                 sfs = ts.solve(A[0], Di[0], C[0], np.dot(Q[0], sfs) + (dt*B).dot(sfs))
+            sfs = Integration._as_dtype(sfs, dtype)
         else:
-            sfs = _update_step1(sfs, Q)
+            sfs = _update_step1(sfs, Q, threads)
             if finite_genome == False:
                 sfs = sfs + dt*B
             else:
                 for i in range(len(n)):
                     sfs = sfs + (dt*B[i]).dot(sfs.flatten()).reshape(n+1)
-            sfs = _update_step2_neutral(sfs, A, Di, C)
+            sfs = _update_step2_neutral(sfs, A, Di, C, threads)
         Nold = N
         t += dt
 
@@ -1,5 +1,6 @@
 import numpy as np
 cimport numpy as np
+from scipy.sparse import csr_matrix, issparse, isspmatrix_csr
 
 #--------------------------------------------
 # Jackknife extrapolations :
@@ -17,35 +18,109 @@ def python2round(float f):
 cpdef int index_bis(int i, int n):
     return int(min(max(python2round(i * n / float(n+1)), 2), n-2))
 
-# Compute the order 3 Jackknife extrapolation coefficients for 1 jump (Phi_n -> Phi_(n+1))
-cpdef np.ndarray[np.float64_t, ndim = 2] calcJK13(int n):
-    cdef np.ndarray[np.float64_t, ndim = 2] J = np.zeros((n, n-1))
+# Nonzero coefficients of the order 3 Jackknife for 1 jump (Phi_n -> Phi_(n+1)):
+# row i of the (n, n-1) matrix has 3 nonzeros, band[i, k] in column
+# index_bis(i + 1, n) - 2 + k
+cpdef np.ndarray[np.float64_t, ndim = 2] calcJK13_band(int n):
+    cdef np.ndarray[np.float64_t, ndim = 2] J = np.zeros((n, 3))
     cdef int i
     cdef int ibis
     for i in range(n):
         ibis = index_bis(i + 1, n) - 1
-        J[i, ibis] = -(1.+n) * ((2.+i)*(2.+n)*(-6.-n+(i+1.)*(3.+n))-2.*(4.+n)*(-1.+(i+1.)*(2.+n))*(ibis+1.)
+        J[i, 1] = -(1.+n) * ((2.+i)*(2.+n)*(-6.-n+(i+1.)*(3.+n))-2.*(4.+n)*(-1.+(i+1.)*(2.+n))*(ibis+1.)
                   +(12.+7.*n+n**2)*(ibis+1.)**2) / (2.+n) / (3.+n) / (4.+n)
-        J[i, ibis - 1] = (1.+n) * (4.+(1.+i)**2*(6.+5.*n+n**2)-(i+1.)*(14.+9.*n+n**2)-(4.+n)*(-5.-n+2.*(i+1.)*(2.+n))*(ibis+1.)
+        J[i, 0] = (1.+n) * (4.+(1.+i)**2*(6.+5.*n+n**2)-(i+1.)*(14.+9.*n+n**2)-(4.+n)*(-5.-n+2.*(i+1.)*(2.+n))*(ibis+1.)
                     +(12.+7.*n+n**2)*(ibis+1.)**2) / (2.+n) / (3.+n) / (4.+n) / 2.
-        J[i, ibis + 1] = (1.+n) * ((2.+i)*(2.+n)*(-2.+(i+1.)*(3.+n))-(4.+n)*(1.+n+2.*(i+1.)*(2.+n))*(ibis+1.)
+        J[i, 2] = (1.+n) * ((2.+i)*(2.+n)*(-2.+(i+1.)*(3.+n))-(4.+n)*(1.+n+2.*(i+1.)*(2.+n))*(ibis+1.)
                     +(12.+7.*n+n**2)*(ibis+1.)**2) / (2.+n) / (3.+n) / (4.+n) / 2.
-    return J
+    return _small_n(J, n)
 
 
-# Compute the order 3 Jackknife extrapolation coefficients for 2 jumps (Phi_n -> Phi_(n+2))
-cpdef np.ndarray[np.float64_t, ndim = 2] calcJK23(int n):
-    cdef np.ndarray[np.float64_t, ndim = 2] J = np.zeros((n + 1, n - 1))
+# Same for 2 jumps (Phi_n -> Phi_(n+2)), (n+1, n-1) matrix
+cpdef np.ndarray[np.float64_t, ndim = 2] calcJK23_band(int n):
+    cdef np.ndarray[np.float64_t, ndim = 2] J = np.zeros((n + 1, 3))
     cdef int i
     cdef int ibis
     for i in range(n + 1):
         ibis = index_bis(i + 1, n) - 1
-        if i == n - 1 or i == n:
-            ibis = n - 3
-        J[i, ibis] = -(1.+n) * ((2.+i)*(2.+n)*(-9.-n+(i+1.)*(3.+n))-2.*(5.+n)*(-2.+(i+1.)*(2.+n))*(ibis+1.)
+        J[i, 1] = -(1.+n) * ((2.+i)*(2.+n)*(-9.-n+(i+1.)*(3.+n))-2.*(5.+n)*(-2.+(i+1.)*(2.+n))*(ibis+1.)
                   +(20.+9.*n+n**2)*(ibis+1.)**2) / (3.+n) / (4.+n) / (5.+n)
-        J[i, ibis - 1] = (1.+n) * (12.+(1.+i)**2*(6.+5.*n+n**2)-(i+1.)*(22.+13.*n+n**2)-(5.+n)*(-8.-n+2.*(i+1.)*(2.+n))*(ibis+1.)
+        J[i, 0] = (1.+n) * (12.+(1.+i)**2*(6.+5.*n+n**2)-(i+1.)*(22.+13.*n+n**2)-(5.+n)*(-8.-n+2.*(i+1.)*(2.+n))*(ibis+1.)
                     +(20.+9.*n+n**2)*(ibis+1.)**2) / (3.+n) / (4.+n) / (5.+n) / 2.
-        J[i, ibis + 1] = (1.+n) * ((2.+i)*(2.+n)*(-4.+(i+1.)*(3.+n))-(5.+n)*(n+2.*(i+1.)*(2.+n))*(ibis+1.)
+        J[i, 2] = (1.+n) * ((2.+i)*(2.+n)*(-4.+(i+1.)*(3.+n))-(5.+n)*(n+2.*(i+1.)*(2.+n))*(ibis+1.)
                     +(20.+9.*n+n**2)*(ibis+1.)**2) / (3.+n) / (4.+n) / (5.+n) / 2.
-    return J
\ No newline at end of file
+    return _small_n(J, n)
+
+
+# For n < 4, index_bis is clamped and the 3 columns of the band wrap
+# around the n-1 columns of the matrix, so the band is read back from
+# the dense matrix as the matrix builders always did.
+def _small_n(b, int n):
+    if n < 4:
+        return band(_dense(b, n))
+    return b
+
+
+# Columns of the band: col[i] is the column of band[i, 0]
+cpdef np.ndarray[np.int32_t, ndim = 1] band_columns(int nrows, int n):
+    cdef np.ndarray[np.int32_t, ndim = 1] col = np.zeros(nrows, dtype=np.int32)
+    cdef int i
+    for i in range(nrows):
+        col[i] = index_bis(i + 1, n) - 2
+    return col
+
+
+def _dense(b, int n):
+    cdef np.ndarray[np.int32_t, ndim = 1] col = band_columns(b.shape[0], n)
+    J = np.zeros((b.shape[0], n - 1))
+    rows = np.arange(b.shape[0])
+    for k in range(3):
+        J[rows, col + k] = b[:, k]
+    return J
+
+
+def _sparse(b, int n):
+    cdef int nrows = b.shape[0]
+    cdef np.ndarray[np.int32_t, ndim = 1] cols = band_columns(nrows, n)
+    if n < 4:
+        return csr_matrix(_dense(b, n))
+    indices = cols[:, None] + np.arange(3, dtype=np.int32)
+    indptr = np.arange(0, 3 * nrows + 1, 3, dtype=np.int32)
+    return csr_matrix((b.ravel(), indices.ravel(), indptr), shape=(nrows, n - 1))
+
+
+# Compute the order 3 Jackknife extrapolation coefficients for 1 jump (Phi_n -> Phi_(n+1))
+cpdef np.ndarray[np.float64_t, ndim = 2] calcJK13(int n):
+    return _dense(calcJK13_band(n), n)
+
+
+# Compute the order 3 Jackknife extrapolation coefficients for 2 jumps (Phi_n -> Phi_(n+2))
+cpdef np.ndarray[np.float64_t, ndim = 2] calcJK23(int n):
+    return _dense(calcJK23_band(n), n)
+
+
+# Sparse (CSR) versions, with 3 nonzeros per row
+cpdef calcJK13_sparse(int n):
+    return _sparse(calcJK13_band(n), n)
+
+
+cpdef calcJK23_sparse(int n):
+    return _sparse(calcJK23_band(n), n)
+
+
+# Returns the band (see calcJK13_band) of a jackknife matrix given in
+# dense, sparse (CSR) or band form. The matrix builders accept all of them.
+def band(ljk):
+    cdef np.ndarray[np.int32_t, ndim = 1] cols
+    if isspmatrix_csr(ljk) and ljk.nnz == 3 * ljk.shape[0]:
+        ljk.sort_indices()
+        return np.asarray(ljk.data, dtype=np.float64).reshape(-1, 3)
+    if issparse(ljk):
+        ljk = ljk.toarray()
+    ljk = np.asarray(ljk, dtype=np.float64)
+    if ljk.shape[1] == 3:
+        # already a band (for n = 4, the band and the dense matrix are equal)
+        return ljk
+    rows = np.arange(ljk.shape[0])
+    cols = band_columns(ljk.shape[0], ljk.shape[1] + 1)
+    return np.ascontiguousarray(np.array([ljk[rows, cols + k] for k in range(3)]).T)
@@ -15,6 +15,7 @@ except ImportError:
     pass
 
 from . import Util
+from .. import Misc
 
 def check_imports():
     if imported_allel == 0:
@@ -65,6 +66,18 @@ def load_h5(vcf_file, report=True):
 
 
 ### genotype function
+def _strip_chr(chroms):
+    """
+    Chromosome names without their chr prefix (chr22 -> 22). The names of
+    the SNPs of a VCF file come in long runs, which are renamed at once.
+    """
+    chroms = np.asarray(chroms).astype(str)
+    if len(chroms) == 0:
+        return chroms
+    firsts = np.concatenate([[0], np.flatnonzero(chroms[1:] != chroms[:-1]) + 1])
+    names = [c[3:] if c.startswith('chr') else c for c in chroms[firsts]]
+    return np.repeat(names, np.diff(np.concatenate([firsts, [len(chroms)]])))
+
 def get_genotypes(vcf_file, bed_file=None, chromosome=None, min_bp=None, use_h5=True, report=True):
     """
     Given a vcf file, we extract the biallelic SNP genotypes.
@@ -94,38 +107,17 @@ def get_genotypes(vcf_file, bed_file=None, chromosome=None, min_bp=None, use_h5=
     
     # filter SNPs not in bed file, if one is given
     if bed_file is not None: # filter genotypes and positions
-        mask_bed = pandas.read_csv(bed_file, sep='\t', header=None)
-        chroms = [c for c in list(set(callset['variants/CHROM'][:]))]
-        
+        # if we want a minimum length of feature, only keep long enough features
         # because of the variation of chrom labels (with our without chr (22 vs chr22)),
-        # we check that chroms start with chr
-        
-        for ii,c in enumerate(chroms):
-            if 'chr' in c:
-                chroms[ii] = c[3:]
+        # we compare chromosome names without chr
+        mask_bed = Misc.IntervalIndex.from_bed(bed_file, min_length=min_bp)
+        mask_bed = Misc.IntervalIndex(_strip_chr(mask_bed.chroms),
+                                      mask_bed.starts, mask_bed.ends)
+        all_chromosomes = _strip_chr(callset['variants/CHROM'][:])
         
-        chrom_filter = [False] * len(mask_bed)
+        in_mask = mask_bed.contains(all_chromosomes, all_positions)
         if chromosome is not None:
-            chrom_filter = np.logical_or(chrom_filter, np.logical_or(mask_bed[0].values.astype(str) == str(chromosome), mask_bed[0].values.astype(str) == 'chr'+str(chromosome)))
-        else:
-            for chrom in chroms:
-                chrom_filter = np.logical_or(chrom_filter, np.logical_or(mask_bed[0].values.astype(str) == chrom, mask_bed[0].values.astype(str) == 'chr'+chrom))
-        
-        mask_bed = mask_bed.loc[chrom_filter]
-
-        # if we want a minimum length of feature, only keep long enough features
-        if min_bp is not None:
-            mask_bed = mask_bed.loc[mask_bed[2] - mask_bed[1] >= min_bp]
-        
-        n_features = mask_bed.shape[0]
-
-        in_mask = (all_positions < 0)
-        for _index, feature in mask_bed.iterrows():
-            start = feature[1]
-            end = feature[2]
-              
-            in_mask = np.logical_or(in_mask, np.logical_and(all_positions>=start, 
-                                                            all_positions<end))
+            in_mask &= (all_chromosomes == _strip_chr([str(chromosome)])[0])
         if report is True: print("created bed filter"); sys.stdout.flush()
         
         all_positions = all_positions.compress(in_mask)
@@ -52,44 +52,48 @@ def calcB(u, dims):
         B[tp] = dims[k] - 1
     return u*B
 
+# The matrices are assembled in bulk: for each population, the entries of
+# all the fs elements are computed at once from the arrays of their
+# nD indexes, and the columns are shifts of the 1D index by the strides.
+# dims -> array containing the dimensions of the problem dims[j] = nj+1
+def _grid(dims):
+    dims = np.array(dims, dtype=int)
+    # nD index of each fs element stored in a vector (index[:, i] = index_nD(i, dims))
+    index = np.indices(dims).reshape(len(dims), -1)
+    # index_1D(ind + ej, dims) = index_1D(ind, dims) + strides[j]
+    strides = np.array([int(np.prod(dims[j+1:])) for j in range(len(dims))], dtype=int)
+    return dims, index, strides
+
+# jk.index_bis for all the values of i in [0, imax]
+def _index_bis(imax, n):
+    return np.array([jk.index_bis(i, n) for i in range(imax + 1)], dtype=int)
+
+def _assemble(data, row, col, d):
+    if len(data) == 0:
+        return sp.sparse.coo_matrix(([], ([], [])), shape=(d, d), dtype='float').tocsc()
+    return sp.sparse.coo_matrix((np.concatenate(data), (np.concatenate(row), np.concatenate(col))),
+                                shape=(d, d), dtype='float').tocsc()
+
 # We compute the  matrices for drift
 # this function returns a list of matrices corresponding to each population
-# dims -> array containing the dimensions of the problem dims[j] = nj+1
 def calcD(dims):
+    dims, index, strides = _grid(dims)
     # number of freedom degrees
     d = int(np.prod(dims))
+    ids = np.arange(d)
     # we consider separately the contributions of each dimension
     res = []
     for j in range(len(dims)):
-        data = []
-        row = []
-        col = []
-        # creating the ej vector
-        ind = np.zeros(len(dims), dtype='int')
-        ind[j] = int(1)
-        # loop over the fs elements:
-        for i in range(0, d):
-            # for each element of our nD fs (stored in a vector),
-            # we compute its nD index (position in the nD matrix figuring the fs)
-            index = index_nD(i, dims)
-            # notice that "index[j] = ij"
-            if index[j] > 1:
-                data.append((index[j]-1) * (dims[j]-index[j]))
-                row.append(i)
-                col.append(index_1D(index - ind, dims))
-
-            if index[j] < dims[j] - 2:
-                data.append((index[j]+1) * (dims[j]-index[j]-2))
-                col.append(index_1D(index + ind, dims))
-                row.append(i)
-
-            if index[j] > 0 and index[j] < dims[j] - 1:
-                data.append(-2 * index[j] * (dims[j]-index[j]-1))
-                row.append(i)
-                col.append(i)
-        res.append(sp.sparse.coo_matrix((data, (row, col)), shape=(d, d),
-                   dtype='float').tocsc())
-
+        # notice that "index[j] = ij"
+        x = index[j]
+        lo = x > 1
+        up = x < dims[j] - 2
+        mid = (x > 0) & (x < dims[j] - 1)
+        data = [((x-1) * (dims[j]-x))[lo], ((x+1) * (dims[j]-x-2))[up],
+                (-2 * x * (dims[j]-x-1))[mid]]
+        row = [ids[lo], ids[up], ids[mid]]
+        col = [ids[lo] - strides[j], ids[up] + strides[j], ids[mid]]
+        res.append(_assemble(data, row, col, d))
     return res
 
 # Selection
@@ -97,6 +101,7 @@ def calcD(dims):
 # h -> [h1, h2, ..., hp]
 # with order 3 JK...
 def calcS_jk3(dims, s, h):
+    dims, index, strides = _grid(dims)
     # number of degrees of freedom
     d = int(np.prod(dims))
     s = np.array(s)
@@ -104,54 +109,41 @@ def calcS_jk3(dims, s, h):
     # we don't compute the matrix if not necessary
     if not s.any():
         return  sp.sparse.coo_matrix(([], ([], [])), shape=(d, d), dtype='float').tocsc()
-    
-    # we precompute the JK3 coefficients we will need (same as in 1D)...
-    ljk = []
-    for i in range(len(dims)):
-        ljk.append(jk.calcJK13(int(dims[i] - 1)))
 
+    ids = np.arange(d)
     data = []
     row = []
     col = []
+    for j in range(len(dims)):
+        # we precompute the JK3 coefficients we will need (band form, see Jackknife)
+        ljk = jk.calcJK13_band(int(dims[j] - 1))
+        ib = _index_bis(dims[j], dims[j] - 1)
+        x = index[j]
+        g1 = s[j] * h[j] / np.float64(dims[j]) * x * (dims[j]-x)
+        g2 = -s[j] * h[j] / np.float64(dims[j]) * (x+1) * (dims[j]-1-x)
+        # the jth coordinate is replaced by index_bis(ij) and index_bis(ij+1)
+        xb = ib[x]
+        cb = ids + (xb - x) * strides[j]
+        for k in range(-1, 2):
+            data.append(g1 * ljk[x - 1, k + 1])
+            row.append(ids)
+            col.append(cb + k * strides[j])
+        # g2 = 0 for ij = nj
+        inner = x < dims[j] - 1
+        x, g2, ids2 = x[inner], g2[inner], ids[inner]
+        xt = ib[x + 1]
+        ct = ids2 + (xt - x) * strides[j]
+        for k in range(-1, 2):
+            data.append(g2 * ljk[x, k + 1])
+            row.append(ids2)
+            col.append(ct + k * strides[j])
 
-    for i in range(d):
-        # multi-D index of the current variable
-        index = index_nD(i, dims)
-        for j in range(len(dims)):
-            ind = np.zeros(len(dims), dtype='int')
-            ind[j] = int(1)
-            g1 = s[j] * h[j] / np.float64(dims[j]) * index[j] * (dims[j]-index[j])
-            g2 = -s[j] * h[j] / np.float64(dims[j]) * (index[j]+1) * (dims[j]-1-index[j])
-            index_bis = np.array(index)
-            index_bis[j] = jk.index_bis(index_bis[j], dims[j] - 1)
-            index_ter = np.array(index) + ind
-            index_ter[j] = jk.index_bis(index_ter[j], dims[j] - 1)
-
-            if index[j] < dims[j] - 1:
-                data += [g1 * ljk[j][index[j] - 1, index_bis[j] - 1],
-                         g1 * ljk[j][index[j] - 1, index_bis[j] - 2],
-                         g1 * ljk[j][index[j] - 1, index_bis[j]],
-                         g2 * ljk[j][index[j], index_ter[j] - 1],
-                         g2 * ljk[j][index[j], index_ter[j] - 2],
-                         g2 * ljk[j][index[j], index_ter[j]]]
-                row += [i] * 6
-                col += [index_1D(index_bis, dims), index_1D(index_bis - ind, dims),
-                        index_1D(index_bis + ind, dims), index_1D(index_ter, dims),
-                        index_1D(index_ter - ind, dims), index_1D(index_ter + ind, dims)]
-            
-            if index[j] == dims[j] - 1: # g2=0
-                data += [g1 * ljk[j][index[j] - 1, index_bis[j] - 1],
-                         g1 * ljk[j][index[j] - 1, index_bis[j] - 2],
-                         g1 * ljk[j][index[j] - 1,index_bis[j]]]
-                row += [i] * 3
-                col += [index_1D(index_bis, dims), index_1D(index_bis - ind, dims),
-                        index_1D(index_bis + ind, dims)]
-
-    return sp.sparse.coo_matrix((data, (row, col)), shape=(d, d), dtype='float').tocsc()
+    return _assemble(data, row, col, d)
 
 # s -> array containing the selection coefficients for each population [s1, s2, ..., sp]
 # h -> [h1, h2, ..., hp]
 def calcS2_jk3(dims, s, h):
+    dims, index, strides = _grid(dims)
     # number of degrees of freedom
     d = int(np.prod(dims))
     s = np.array(s)
@@ -159,54 +151,42 @@ def calcS2_jk3(dims, s, h):
     # we don't compute the matrix if not necessary
     if not s.any() or not (h - 0.5).any():
         return  sp.sparse.coo_matrix(([], ([], [])), shape=(d, d), dtype='float').tocsc()
-    
-    # we precompute the JK3 coefficients we will need (same as in 1D)...
-    ljk = []
-    for i in range(len(dims)):
-        ljk.append(jk.calcJK23(int(dims[i] - 1)))
 
+    ids = np.arange(d)
     data = []
     row = []
     col = []
-    for i in range(d):
-        # multi-D index of the current variable
-        index = index_nD(i, dims)
-        for j in range(len(dims)):
-            ind = np.zeros(len(dims), dtype='int')
-            ind[j] = int(1)
-            g1 = s[j] * (1-2.0*h[j]) * (index[j]+1) / np.float64(dims[j]) / (dims[j]+1) * index[j] * (dims[j]-index[j])
-            g2 = -s[j] * (1-2.0*h[j]) * (index[j]+1) / np.float64(dims[j]) / (dims[j]+1) * (index[j]+2) * (dims[j]-1-index[j])
-            index_ter = np.array(index) + ind
-            index_ter[j] = jk.index_bis(index_ter[j], dims[j] - 1)
-            index_qua = np.array(index) + 2*ind
-            index_qua[j] = jk.index_bis(index_qua[j], dims[j] - 1)
-
-            if index[j] < dims[j] - 1:
-                data += [g1 * ljk[j][index[j], index_ter[j] - 1],
-                         g1 * ljk[j][index[j], index_ter[j] - 2],
-                         g1 * ljk[j][index[j], index_ter[j]],
-                         g2 * ljk[j][index[j] + 1, index_qua[j] - 1],
-                         g2 * ljk[j][index[j] + 1, index_qua[j] - 2],
-                         g2 * ljk[j][index[j] + 1, index_qua[j]]]
-                row += [i] * 6
-                col += [index_1D(index_ter, dims), index_1D(index_ter - ind, dims),
-                        index_1D(index_ter + ind, dims), index_1D(index_qua, dims),
-                        index_1D(index_qua - ind, dims), index_1D(index_qua + ind, dims)]
-            
-            if index[j] == dims[j] - 1: # g2=0
-                data += [g1 * ljk[j][index[j], index_ter[j] - 1],
-                         g1 * ljk[j][index[j],index_ter[j] - 2],
-                         g1 * ljk[j][index[j],index_ter[j]]]
-                row += [i] * 3
-                col += [index_1D(index_ter, dims), index_1D(index_ter - ind, dims),
-                        index_1D(index_ter + ind, dims)]
+    for j in range(len(dims)):
+        # we precompute the JK3 coefficients we will need (band form, see Jackknife)
+        ljk = jk.calcJK23_band(int(dims[j] - 1))
+        ib = _index_bis(dims[j] + 1, dims[j] - 1)
+        x = index[j]
+        g1 = s[j] * (1-2.0*h[j]) * (x+1) / np.float64(dims[j]) / (dims[j]+1) * x * (dims[j]-x)
+        g2 = -s[j] * (1-2.0*h[j]) * (x+1) / np.float64(dims[j]) / (dims[j]+1) * (x+2) * (dims[j]-1-x)
+        # the jth coordinate is replaced by index_bis(ij+1) and index_bis(ij+2)
+        xt = ib[x + 1]
+        ct = ids + (xt - x) * strides[j]
+        for k in range(-1, 2):
+            data.append(g1 * ljk[x, k + 1])
+            row.append(ids)
+            col.append(ct + k * strides[j])
+        # g2 = 0 for ij = nj
+        inner = x < dims[j] - 1
+        x, g2, ids2 = x[inner], g2[inner], ids[inner]
+        xq = ib[x + 2]
+        cq = ids2 + (xq - x) * strides[j]
+        for k in range(-1, 2):
+            data.append(g2 * ljk[x + 1, k + 1])
+            row.append(ids2)
+            col.append(cq + k * strides[j])
 
-    return sp.sparse.coo_matrix((data, (row, col)), shape=(d, d), dtype='float').tocsc()
+    return _assemble(data, row, col, d)
 
 # Migration
 # m -> migration rates matrix, m[i,j] = migration rate from pop i to pop j
 # with order 3 JK
 def calcM_jk3(dims, m):
+    dims, index, strides = _grid(dims)
     # number of degrees of freedom
     d = int(np.prod(dims))
     
@@ -215,104 +195,51 @@ def calcM_jk3(dims, m):
         return  sp.sparse.coo_matrix(([], ([], [])), shape=(dims[0], dims[0]), dtype='float').tocsc()
     if not m.any():
         return  sp.sparse.coo_matrix(([], ([], [])), shape=(d, d), dtype='float').tocsc()
-   
-   # we precompute the JK3 coefficients we will need (same as in 1D)...
-    ljk = []
-    for i in range(len(dims)):
-        ljk.append(jk.calcJK13(int(dims[i] - 1)))
 
+    ids = np.arange(d)
     data = []
     row = []
     col = []
-    for i in range(d):
-        # multi-D index of the current variable
-        index = index_nD(i, dims)
-        
+    for k in range(len(dims)):
+        # we precompute the JK3 coefficients we will need (band form, see Jackknife)
+        ljk = jk.calcJK13_band(int(dims[k] - 1))
+        ib = _index_bis(dims[k], dims[k] - 1)
+        xk = index[k]
+        c = (xk+1) / np.float64(dims[k])
+        # the kth coordinate is replaced by index_bis(ik+1)
+        xt = ib[xk + 1]
+        ct = ids + (xt - xk) * strides[k]
+        # extrapolation weights for the 3 columns ct - ek, ct, ct + ek
+        # and, for ik = nk, additional weight on the current element
+        last = xk == dims[k] - 1
+        rk = np.where(last, xk - 1, xk)
+        w = [np.where(last, -1.0 / dims[k], 1.0) * ljk[rk, l] * c for l in range(3)]
         for j in range(len(dims)):
-            indj = np.zeros(len(dims), dtype='int')
-            indj[j] = int(1)
-            
-            index_bisj = np.array(index)
-            index_bisj[j] = jk.index_bis(index_bisj[j], dims[j] - 1)
-            index_terj = np.array(index) + indj
-            index_terj[j] = jk.index_bis(index_terj[j], dims[j] - 1)
-            
-            coeff1 = 2*index[j] - (dims[j]-1)
-            coeff2 = dims[j] - index[j]
-            coeff3 = -index[j] - 1
-            for k in range(len(dims)):
-                if k != j:
-                    indk = np.zeros(len(dims), dtype='int')
-                    indk[k] = int(1)
-                    
-                    c = (index[k]+1) / np.float64(dims[k])
-                    
-                    data.append(-m[j, k] * index[j])
-                    row.append(i)
-                    col.append(i)
-                    
-                    index_bisk = np.array(index)
-                    index_bisk[k] = jk.index_bis(index_bisk[k], dims[k] - 1)
-                    index_terk = np.array(index) + indk
-                    index_terk[k] = jk.index_bis(index_terk[k], dims[k] - 1)
-                    
-                    if index[j] < dims[j] - 1:
-                        data.append(m[j, k] * (index[j]+1))
-                        row.append(i)
-                        col.append(index_1D(index + indj, dims))
-                    
-                    if index[k] < dims[k] - 1:
-                        data += [m[j, k] * coeff1 * ljk[k][index[k], index_terk[k] - 2] * c,
-                                 m[j, k] * coeff1 * ljk[k][index[k], index_terk[k] - 1] * c,
-                                 m[j, k] * coeff1 * ljk[k][index[k], index_terk[k]] * c]
-                        row += [i] * 3
-                        col += [index_1D(index_terk - indk, dims), index_1D(index_terk, dims),
-                                index_1D(index_terk + indk, dims)]
-
-                        if index[j] > 0:
-                            data +=[m[j, k] * coeff2 * ljk[k][index[k], index_terk[k] - 2] *c,
-                                    m[j, k] * coeff2 * ljk[k][index[k], index_terk[k] - 1] *c,
-                                    m[j, k] * coeff2 * ljk[k][index[k], index_terk[k]] * c]
-                            row += [i] * 3
-                            col += [index_1D(index_terk - indk - indj, dims), index_1D(index_terk - indj, dims),
-                                    index_1D(index_terk + indk - indj, dims)]
+            if j == k:
+                continue
+            xj = index[j]
+            coeff1 = 2*xj - (dims[j]-1)
+            coeff2 = dims[j] - xj
+            coeff3 = -xj - 1
+            up = xj < dims[j] - 1
+            lo = xj > 0
 
-                        if index[j] < dims[j] - 1:
-                            data += [m[j, k] * coeff3 * ljk[k][index[k], index_terk[k] - 2] * c,
-                                     m[j, k] * coeff3 * ljk[k][index[k], index_terk[k] - 1] * c,
-                                     m[j, k] * coeff3 * ljk[k][index[k], index_terk[k]] * c]
-                            row += [i] * 3
-                            col += [index_1D(index_terk - indk + indj, dims), index_1D(index_terk + indj, dims),
-                                    index_1D(index_terk + indk + indj, dims)]
-                            
-                    if index[k] == dims[k] - 1:
-                        data += [m[j, k] * coeff1 * c,
-                                 -m[j, k] * coeff1 / dims[k] * ljk[k][index[k] - 1, index_terk[k] - 2] * c,
-                                 -m[j, k] * coeff1 / dims[k] * ljk[k][index[k] - 1, index_terk[k] - 1] * c,
-                                 -m[j, k] * coeff1 / dims[k] * ljk[k][index[k] - 1, index_terk[k]] * c]
-                        row += [i] * 4
-                        col += [i, index_1D(index_terk - indk, dims),
-                                index_1D(index_terk, dims), index_1D(index_terk + indk, dims)]
+            data += [-m[j, k] * xj, m[j, k] * (xj+1)[up]]
+            row += [ids, ids[up]]
+            col += [ids, ids[up] + strides[j]]
 
-                        if index[j] > 0:
-                            data += [m[j, k] * coeff2 * c,
-                                     -m[j, k] * coeff2 / dims[k] * ljk[k][index[k] - 1, index_terk[k] - 2] * c,
-                                     -m[j, k] * coeff2 / dims[k] * ljk[k][index[k] - 1, index_terk[k] - 1] * c,
-                                     -m[j, k] * coeff2 / dims[k] * ljk[k][index[k] - 1, index_terk[k]] * c]
-                            row += [i] * 4
-                            col += [index_1D(index - indj, dims), index_1D(index_terk - indk - indj, dims),
-                                    index_1D(index_terk - indj, dims), index_1D(index_terk + indk - indj, dims)]
-                        
-                        if index[j] < dims[j] - 1:
-                            data += [m[j, k] * coeff3 * c,
-                                     -m[j, k] * coeff3 / dims[k] * ljk[k][index[k] - 1, index_terk[k] - 2] * c,
-                                     -m[j, k] * coeff3 / dims[k] * ljk[k][index[k] - 1, index_terk[k] - 1] * c,
-                                     -m[j, k] * coeff3 / dims[k] * ljk[k][index[k] - 1, index_terk[k]] * c]
-                            row += [i] * 4
-                            col += [index_1D(index + indj, dims), index_1D(index_terk - indk + indj, dims),
-                                    index_1D(index_terk + indj, dims), index_1D(index_terk + indk + indj, dims)]
+            for coeff, mask, shift in [(coeff1, Ellipsis, 0), (coeff2, lo, -strides[j]),
+                                       (coeff3, up, strides[j])]:
+                for l in range(3):
+                    data.append((m[j, k] * coeff * w[l])[mask])
+                    row.append(ids[mask])
+                    col.append((ct + (l-1) * strides[k] + shift)[mask])
+                sel = last & mask if mask is not Ellipsis else last
+                data.append((m[j, k] * coeff * c)[sel])
+                row.append(ids[sel])
+                col.append(ids[sel] + shift)
 
-    return sp.sparse.coo_matrix((data, (row, col)), shape=(d, d), dtype='float').tocsc()
+    return _assemble(data, row, col, d)
 
 #----------------------------------
 # Steady state (for initialization)
@@ -338,7 +265,7 @@ def steady_state(n, N=None, gamma=None, h=None, m=None, theta=1.0, reshape=True)
     s = np.array(gamma) / N[0]
     u = theta / 4.0 / N[0]
     # dimensions of the sfs
-    dims = n + np.ones(len(n))
+    dims = np.array(n + np.ones(len(n)), dtype=int)
     d = int(np.prod(dims))
     
     # matrix for mutations
@@ -85,9 +85,11 @@ cpdef calcD_dense(int d):
 Matrices for selection with order 3 JK
 dims = n1+1
 ljk is the Jacknife array corresponding to the concerned population size,
+    dense, sparse (CSR) or band (see Jackknife.band)
 """
 # selection with h = 0.5
-cpdef calcS(int d, np.ndarray[np.float64_t, ndim = 2] ljk):
+cpdef calcS(int d, ljk):
+    cdef np.ndarray[np.float64_t, ndim = 2] jb = jk.band(ljk)
     # Computes the jackknife-transformed selection matrix 1
     # for the addition of a single sample
     cdef int i, i_bis, i_ter
@@ -107,22 +109,22 @@ cpdef calcS(int d, np.ndarray[np.float64_t, ndim = 2] ljk):
         g2 = -(i+1) * (d-1-i) / np.float64(d)
 
         if i < d - 1 and i > 0: # First deal with non-fixed variants
-            data += [g1 * ljk[i - 1, i_bis - 1], g1 * ljk[i - 1, i_bis - 2],
-                    g1 * ljk[i - 1, i_bis], g2 * ljk[i, i_ter - 1],
-                    g2 * ljk[i, i_ter - 2], g2 * ljk[i, i_ter]]
+            data += [g1 * jb[i - 1, 1], g1 * jb[i - 1, 0],
+                    g1 * jb[i - 1, 2], g2 * jb[i, 1],
+                    g2 * jb[i, 0], g2 * jb[i, 2]]
             row += 6 * [i]
             col += [i_bis, i_bis - 1, i_bis + 1,
                     i_ter, i_ter - 1, i_ter + 1]
         
         elif i == 0: # g1=0
-            data += [g2 * ljk[i, i_ter - 1],
-                     g2 * ljk[i, i_ter - 2], g2 * ljk[i, i_ter]]
+            data += [g2 * jb[i, 1],
+                     g2 * jb[i, 0], g2 * jb[i, 2]]
             row += 3 * [i]
             col += [i_ter, i_ter - 1, i_ter + 1]
         
         elif i == d - 1: # g2=0
-            data += [g1 * ljk[i - 1, i_bis - 1], g1 * ljk[i - 1, i_bis - 2],
-                     g1 * ljk[i - 1, i_bis]]
+            data += [g1 * jb[i - 1, 1], g1 * jb[i - 1, 0],
+                     g1 * jb[i - 1, 2]]
             row += 3 * [i]
             col += [i_bis, i_bis - 1, i_bis + 1]
 
@@ -131,7 +133,8 @@ cpdef calcS(int d, np.ndarray[np.float64_t, ndim = 2] ljk):
 
 
 # selection with h != 0.5
-cpdef calcS2(int d, np.ndarray[np.float64_t, ndim = 2] ljk):
+cpdef calcS2(int d, ljk):
+    cdef np.ndarray[np.float64_t, ndim = 2] jb = jk.band(ljk)
     cdef int i, i_qua, i_ter
     cdef list data, row, col
     cdef np.float64_t g1, g2
@@ -147,15 +150,15 @@ cpdef calcS2(int d, np.ndarray[np.float64_t, ndim = 2] ljk):
         g2 = -(i+1) / np.float64(d) / (d+1.0) * (i+2) * (d-1-i)
         
         if i < d - 1:
-            data += [g1 * ljk[i, i_ter - 1], g1 * ljk[i, i_ter - 2],
-                     g1 * ljk[i, i_ter], g2 * ljk[i + 1, i_qua - 1],
-                     g2 * ljk[i + 1, i_qua - 2], g2 * ljk[i + 1, i_qua]]
+            data += [g1 * jb[i, 1], g1 * jb[i, 0],
+                     g1 * jb[i, 2], g2 * jb[i + 1, 1],
+                     g2 * jb[i + 1, 0], g2 * jb[i + 1, 2]]
             row += 6 * [i]
             col += [i_ter, i_ter - 1, i_ter + 1,
                     i_qua, i_qua - 1, i_qua + 1]
     
         elif i == d - 1: # g2=0
-            data += [g1 * ljk[i, i_ter - 1], g1 * ljk[i, i_ter - 2], g1 * ljk[i, i_ter]]
+            data += [g1 * jb[i, 1], g1 * jb[i, 0], g1 * jb[i, 2]]
             row += 3 * [i]
             col += [i_ter, i_ter - 1, i_ter + 1]
 
@@ -187,8 +190,8 @@ cpdef np.ndarray[np.float64_t] steady_state_1D(int n, float N=1.0, float gamma=0
     # matrix for drift
     D = 1 / 4.0 / N * calcD(d)
     # jackknife matrices
-    ljk = jk.calcJK13(int(d - 1))
-    ljk2 = jk.calcJK23(int(d - 1))
+    ljk = jk.calcJK13_band(int(d - 1))
+    ljk2 = jk.calcJK23_band(int(d - 1))
     # matrix for selection
     S = s * h * calcS(d, ljk)
 
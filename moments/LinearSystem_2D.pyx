@@ -134,10 +134,12 @@ Matrices for selection with order 3 JK
 dims = numpy.array([n1+1,n2+1])
 ljk is the Jacknife array corresponding to the concerned population size:
     ljk=ljk(pop1) in calcS_1, calcS2_1 and ljk=ljk(pop2) in calcS_2, calcS2_2
+    (dense, sparse (CSR) or band, see Jackknife.band)
 s and h are the coefficients for selection and dominance in the concerned population.
 """
 # selection along the first dimension with h1 = 0.5
-cpdef calcS_1(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
+cpdef calcS_1(np.ndarray dims, ljk):
+    cdef np.ndarray[np.float64_t, ndim = 2] jb = jk.band(ljk)
     cdef int d, d1, d2, i, j, k, i_bis, i_ter
     cdef np.float64_t g1, g2
     cdef list data, row, col
@@ -158,23 +160,24 @@ cpdef calcS_1(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
         g1 = i * (d1-i) / np.float64(d1)
         g2 = -(i+1) * (d1-1-i) / np.float64(d1)
         if i < d1 - 1:
-            data += [g1 * ljk[i - 1, i_bis - 1], g1 * ljk[i - 1, i_bis - 2],
-                    g1 * ljk[i - 1, i_bis], g2 * ljk[i, i_ter - 1],
-                    g2 * ljk[i, i_ter - 2], g2 * ljk[i, i_ter]]
+            data += [g1 * jb[i - 1, 1], g1 * jb[i - 1, 0],
+                    g1 * jb[i - 1, 2], g2 * jb[i, 1],
+                    g2 * jb[i, 0], g2 * jb[i, 2]]
             row += 6 * [k]
             col += [i_bis*d2 + j, (i_bis-1)*d2 + j, (i_bis+1)*d2 + j,
                     i_ter*d2 + j, (i_ter-1)*d2 + j, (i_ter+1)*d2 + j]
             
         if i == d1 - 1: # g2=0
-            data += [g1 * ljk[i - 1, i_bis - 1], g1 * ljk[i - 1, i_bis - 2],
-                     g1 * ljk[i - 1, i_bis]]
+            data += [g1 * jb[i - 1, 1], g1 * jb[i - 1, 0],
+                     g1 * jb[i - 1, 2]]
             row += 3 * [k]
             col += [i_bis*d2 + j, (i_bis-1)*d2 + j, (i_bis+1)*d2 + j]
 
     return coo_matrix((data, (row, col)), shape=(d, d), dtype='float').tocsc()
 
 # selection along the second dimension with h2 = 0.5
-cpdef calcS_2(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
+cpdef calcS_2(np.ndarray dims, ljk):
+    cdef np.ndarray[np.float64_t, ndim = 2] jb = jk.band(ljk)
     cdef int d, d2, i, j, k, j_bis, j_ter
     cdef np.float64_t g1, g2
     cdef list data, row, col
@@ -194,16 +197,16 @@ cpdef calcS_2(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
         g1 = j * (d2-j) / np.float64(d2)
         g2 = -(j+1) * (d2-1-j) / np.float64(d2)
         if j < d2 - 1:
-            data += [g1 * ljk[j - 1, j_bis - 1], g1 * ljk[j - 1, j_bis - 2],
-                    g1 * ljk[j - 1, j_bis], g2 * ljk[j, j_ter - 1],
-                    g2 * ljk[j, j_ter - 2], g2 * ljk[j, j_ter]]
+            data += [g1 * jb[j - 1, 1], g1 * jb[j - 1, 0],
+                    g1 * jb[j - 1, 2], g2 * jb[j, 1],
+                    g2 * jb[j, 0], g2 * jb[j, 2]]
             row += 6 * [k]
             col += [i*d2 + j_bis, i*d2 + j_bis - 1, i*d2 + j_bis + 1,
                     i*d2 + j_ter, i*d2 + j_ter - 1, i*d2 + j_ter + 1]
             
         if j == d2 - 1: # g2=0
-            data += [g1 * ljk[j - 1, j_bis - 1], g1 * ljk[j - 1, j_bis - 2],
-                     g1 * ljk[j - 1, j_bis]]
+            data += [g1 * jb[j - 1, 1], g1 * jb[j - 1, 0],
+                     g1 * jb[j - 1, 2]]
             row += 3 * [k]
             col += [i*d2 + j_bis, i*d2 + j_bis - 1, i*d2 + j_bis + 1]
 
@@ -211,7 +214,8 @@ cpdef calcS_2(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
 
 # selection along the first dimension, part related to h1 != 0.5
 # ljk is a 2-jumps jackknife
-cpdef calcS2_1(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
+cpdef calcS2_1(np.ndarray dims, ljk):
+    cdef np.ndarray[np.float64_t, ndim = 2] jb = jk.band(ljk)
     cdef int d, d1, d2, k, i, j, i_ter, i_qua
     cdef np.float64_t g1, g2
     cdef list data, row, col
@@ -231,16 +235,16 @@ cpdef calcS2_1(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
         g2 = -(i+1) / np.float64(d1) / (d1+1) * (i+2) * (d1-1-i)
 
         if i < d1 - 1:
-            data += [g1 * ljk[i, i_ter - 1], g1 * ljk[i, i_ter - 2],
-                    g1 * ljk[i, i_ter], g2 * ljk[i + 1, i_qua - 1],
-                    g2 * ljk[i + 1, i_qua - 2], g2 * ljk[i + 1, i_qua]]
+            data += [g1 * jb[i, 1], g1 * jb[i, 0],
+                    g1 * jb[i, 2], g2 * jb[i + 1, 1],
+                    g2 * jb[i + 1, 0], g2 * jb[i + 1, 2]]
             row += 6 * [k]
             col += [i_ter*d2 + j, (i_ter-1)*d2 + j, (i_ter+1)*d2 + j,
                     i_qua*d2 + j, (i_qua-1)*d2 + j, (i_qua+1)*d2 + j]
             
         if i == d1 - 1: # g2=0
-            data += [g1 * ljk[i, i_ter - 1], g1 * ljk[i, i_ter - 2],
-                     g1 * ljk[i, i_ter]]
+            data += [g1 * jb[i, 1], g1 * jb[i, 0],
+                     g1 * jb[i, 2]]
             row += 3 * [k]
             col += [i_ter*d2 + j, (i_ter-1)*d2 + j, (i_ter+1)*d2 + j]
 
@@ -248,7 +252,8 @@ cpdef calcS2_1(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
 
 # selection along the second dimension, part related to h2 != 0.5
 # ljk is a 2-jumps jackknife
-cpdef calcS2_2(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
+cpdef calcS2_2(np.ndarray dims, ljk):
+    cdef np.ndarray[np.float64_t, ndim = 2] jb = jk.band(ljk)
     cdef int d, d2, k, i, j, j_ter, j_qua
     cdef np.float64_t g1, g2
     cdef list data, row, col
@@ -268,16 +273,16 @@ cpdef calcS2_2(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
         g2 = -(j+1) / np.float64(d2) / (d2+1) * (j+2) * (d2-1-j)
 
         if j < d2 - 1:
-            data += [g1 * ljk[j, j_ter - 1], g1 * ljk[j, j_ter - 2],
-                    g1 * ljk[j, j_ter], g2 * ljk[j + 1, j_qua - 1],
-                    g2 * ljk[j + 1, j_qua - 2], g2 * ljk[j + 1, j_qua]]
+            data += [g1 * jb[j, 1], g1 * jb[j, 0],
+                    g1 * jb[j, 2], g2 * jb[j + 1, 1],
+                    g2 * jb[j + 1, 0], g2 * jb[j + 1, 2]]
             row += 6 * [k]
             col += [i*d2 + j_ter, i*d2 + j_ter - 1, i*d2 + j_ter + 1,
                     i*d2 + j_qua, i*d2 + j_qua - 1, i*d2 + j_qua + 1]
             
         if j == d2 - 1: # g2=0
-            data += [g1 * ljk[j, j_ter - 1], g1 * ljk[j, j_ter - 2],
-                     g1 * ljk[j, j_ter]]
+            data += [g1 * jb[j, 1], g1 * jb[j, 0],
+                     g1 * jb[j, 2]]
             row += 3 * [k]
             col += [i*d2 + j_ter, i*d2 + j_ter - 1, i*d2 + j_ter + 1]
 
@@ -289,9 +294,11 @@ Matrices for migration with order 3 JK
 dims = numpy.array([n1+1,n2+1])
 ljk is the Jacknife array corresponding to the concerned population size: 
     ljk=ljk(pop2) in calcM1 and ljk=ljk(pop1) in calcM2
+    (dense, sparse (CSR) or band, see Jackknife.band)
 m is the migration rate: m=m12 in calcM1 and m=m21 in calcM2
 """
-cpdef calcM_1(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
+cpdef calcM_1(np.ndarray dims, ljk):
+    cdef np.ndarray[np.float64_t, ndim = 2] jb = jk.band(ljk)
     cdef int d, d1, d2, i, j, k, i_ter
     cdef np.float64_t c, coeff1, coef2, coeff3
     cdef list data, row, col
@@ -322,47 +329,48 @@ cpdef calcM_1(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
             col.append(k + d2)
                 
         if j < d2 - 1:
-            data += [coeff1 * ljk[j, j_ter - 2], coeff1 * ljk[j, j_ter - 1],
-                     coeff1 * ljk[j, j_ter]]
+            data += [coeff1 * jb[j, 0], coeff1 * jb[j, 1],
+                     coeff1 * jb[j, 2]]
             row += 3 * [k]
             col += [i*d2 + j_ter - 1, i*d2 + j_ter, i*d2 + j_ter + 1]
             if i > 0:
-                data +=[coeff2 * ljk[j, j_ter - 2], coeff2 * ljk[j, j_ter - 1],
-                        coeff2 * ljk[j, j_ter]]
+                data +=[coeff2 * jb[j, 0], coeff2 * jb[j, 1],
+                        coeff2 * jb[j, 2]]
                 row += 3 * [k]
                 col += [(i-1)*d2 + j_ter - 1, (i-1)*d2 + j_ter, (i-1)*d2 + j_ter + 1]
             if i < d1 - 1:
-                data += [coeff3 * ljk[j, j_ter - 2], coeff3 * ljk[j, j_ter - 1],
-                         coeff3 * ljk[j, j_ter]]
+                data += [coeff3 * jb[j, 0], coeff3 * jb[j, 1],
+                         coeff3 * jb[j, 2]]
                 row += 3 * [k]
                 col += [(i+1)*d2 + j_ter - 1, (i+1)*d2 + j_ter, (i+1)*d2 + j_ter + 1]
             
         elif j == d2 - 1:
-            data += [coeff1, -coeff1 / d2 * ljk[j - 1, j_ter - 2],
-                    -coeff1 / d2 * ljk[j - 1, j_ter - 1],
-                    -coeff1 / d2 * ljk[j - 1, j_ter]]
+            data += [coeff1, -coeff1 / d2 * jb[j - 1, 0],
+                    -coeff1 / d2 * jb[j - 1, 1],
+                    -coeff1 / d2 * jb[j - 1, 2]]
             row += 4 * [k]
             col += [k, i*d2 + j_ter - 1, i*d2 + j_ter, i*d2 + j_ter + 1]
                              
             if i > 0:
-                data += [coeff2, -coeff2 / d2 * ljk[j - 1, j_ter - 2],
-                        -coeff2 / d2 * ljk[j - 1, j_ter - 1],
-                        -coeff2 / d2 * ljk[j - 1, j_ter]]
+                data += [coeff2, -coeff2 / d2 * jb[j - 1, 0],
+                        -coeff2 / d2 * jb[j - 1, 1],
+                        -coeff2 / d2 * jb[j - 1, 2]]
                 row += 4 * [k]
                 col += [k - d2, (i-1)*d2 + j_ter - 1,
                         (i-1)*d2 + j_ter, (i-1)*d2 + j_ter + 1]
                                      
             if i < d1 - 1:
-                data += [coeff3, -coeff3 / d2 * ljk[j - 1, j_ter - 2],
-                        -coeff3 / d2 * ljk[j - 1, j_ter - 1],
-                        -coeff3 / d2 * ljk[j - 1, j_ter]]
+                data += [coeff3, -coeff3 / d2 * jb[j - 1, 0],
+                        -coeff3 / d2 * jb[j - 1, 1],
+                        -coeff3 / d2 * jb[j - 1, 2]]
                 row += 4 * [k]
                 col += [k + d2, (i+1)*d2 + j_ter - 1,
                         (i+1)*d2 + j_ter, (i+1)*d2 + j_ter + 1]
     
     return coo_matrix((data, (row, col)), shape=(d, d), dtype='float').tocsc()
 
-cpdef calcM_2(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
+cpdef calcM_2(np.ndarray dims, ljk):
+    cdef np.ndarray[np.float64_t, ndim = 2] jb = jk.band(ljk)
     cdef int d, d1, d2, i, j, k, i_ter
     cdef np.float64_t c, coeff1, coef2, coeff3
     cdef list data, row, col
@@ -393,40 +401,40 @@ cpdef calcM_2(np.ndarray dims, np.ndarray[np.float64_t, ndim = 2] ljk):
             col.append(k + 1)
                 
         if i < d1 - 1:
-            data += [coeff1 * ljk[i, i_ter - 2], coeff1 * ljk[i, i_ter - 1],
-                     coeff1 * ljk[i, i_ter]]
+            data += [coeff1 * jb[i, 0], coeff1 * jb[i, 1],
+                     coeff1 * jb[i, 2]]
             row += 3 * [k]
             col += [(i_ter-1)*d2 + j, i_ter*d2 + j, (i_ter+1)*d2 + j]
             if j > 0:
-                data +=[coeff2 * ljk[i, i_ter - 2], coeff2 * ljk[i, i_ter - 1],
-                        coeff2 * ljk[i, i_ter]]
+                data +=[coeff2 * jb[i, 0], coeff2 * jb[i, 1],
+                        coeff2 * jb[i, 2]]
                 row += 3 * [k]
                 col += [(i_ter-1)*d2 + j - 1, i_ter*d2 + j - 1, (i_ter+1)*d2 + j - 1]
             if j < d2 - 1:
-                data += [coeff3 * ljk[i, i_ter - 2], coeff3 * ljk[i, i_ter - 1],
-                         coeff3 * ljk[i, i_ter]]
+                data += [coeff3 * jb[i, 0], coeff3 * jb[i, 1],
+                         coeff3 * jb[i, 2]]
                 row += 3 * [k]
                 col += [(i_ter-1)*d2 + j + 1, i_ter*d2 + j + 1, (i_ter+1)*d2 + j + 1]
             
         elif i == d1 - 1:
-            data += [coeff1, -coeff1 / d1 * ljk[i - 1, i_ter - 2],
-                    -coeff1 / d1 * ljk[i - 1, i_ter - 1],
-                    -coeff1 / d1 * ljk[i - 1, i_ter]]
+            data += [coeff1, -coeff1 / d1 * jb[i - 1, 0],
+                    -coeff1 / d1 * jb[i - 1, 1],
+                    -coeff1 / d1 * jb[i - 1, 2]]
             row += 4 * [k]
             col += [k, (i_ter-1)*d2 + j, i_ter*d2 + j, (i_ter+1)*d2 + j]
                              
             if j > 0:
-                data += [coeff2, -coeff2 / d1 * ljk[i - 1, i_ter - 2],
-                        -coeff2 / d1 * ljk[i - 1, i_ter - 1],
-                        -coeff2 / d1 * ljk[i - 1, i_ter]]
+                data += [coeff2, -coeff2 / d1 * jb[i - 1, 0],
+                        -coeff2 / d1 * jb[i - 1, 1],
+                        -coeff2 / d1 * jb[i - 1, 2]]
                 row += 4 * [k]
                 col += [k - 1, (i_ter-1)*d2 + j - 1,
                         i_ter*d2 + j - 1, (i_ter+1)*d2 + j - 1]
                                      
             if j < d2 - 1:
-                data += [coeff3, -coeff3 / d1 * ljk[i - 1, i_ter - 2],
-                        -coeff3 / d1 * ljk[i - 1, i_ter - 1],
-                        -coeff3 / d1 * ljk[i - 1, i_ter]]
+                data += [coeff3, -coeff3 / d1 * jb[i - 1, 0],
+                        -coeff3 / d1 * jb[i - 1, 1],
+                        -coeff3 / d1 * jb[i - 1, 2]]
                 row += 4 * [k]
                 col += [k + 1, (i_ter-1)*d2 + j + 1,
                         i_ter*d2 + j + 1, (i_ter+1)*d2 + j + 1]
@@ -7,7 +7,6 @@ from scipy.optimize import _nnls
 import scipy as sp
 from scipy import stats
 from numpy import asarray_chkfinite, zeros, double
-import copy
 from scipy.special import gammaln
 
 """
@@ -21,6 +20,37 @@ Usefull functions for Spectra manipulations:
 def _log_comb(n, k):
     return gammaln(n+1) - gammaln(n-k+1) - gammaln(k+1)
 
+def _split_array(data, axis, n_keep, n_new):
+    """
+    Entries (plain array) of the spectrum after a population split.
+
+    data : entries of the spectrum, whose sample size along axis is
+           n_keep + n_new
+    
+    n_keep : sample size remaining along axis
+    
+    n_new : sample size of the new population, added as the last axis
+    """
+    i = np.arange(n_keep + 1)[:, np.newaxis]
+    j = np.arange(n_new + 1)[np.newaxis, :]
+    log_entry_weight = _log_comb(n_keep, i) + _log_comb(n_new, j) \
+                       - _log_comb(n_keep + n_new, i + j)
+    weights = np.exp(log_entry_weight).reshape(log_entry_weight.shape
+                                               + (1,) * (data.ndim - axis - 1))
+    split = np.take(data, i + j, axis=axis) * weights
+    return np.ascontiguousarray(np.moveaxis(split, axis + 1, -1))
+
+def _merge_array(data):
+    """
+    Entries (plain array) of the 1D spectrum merging the two populations of
+    the 2D spectrum data.
+    """
+    dim1, dim2 = data.shape
+    merged = np.zeros(dim1 + dim2 - 1)
+    for k in range(dim1):
+        merged[k:k + dim2] += data[k]
+    return merged
+
 def split_1D_to_2D(sfs, n1, n2):
     """
     One-to-two population split for the spectrum,
@@ -50,20 +80,15 @@ def split_1D_to_2D(sfs, n1, n2):
     if model is not None:
         model.split(0, (0,1))
     
-    data_1D = copy.copy(sfs) # copy to preserve masking of sp
+    data_1D = sfs
     assert(len(data_1D.shape) == 1)
     assert(len(data_1D) >= n1 + n2 + 1)
     # if the sample size before split is too large, we project
     if len(data_1D) > n1 + n2 + 1:
         data_1D = data_1D.project([n1 + n2])
-    data_1D.unmask_all()
     
     # then we compute the joint fs resulting from the split
-    data_2D = np.zeros((n1 + 1, n2 + 1))
-    for i in range(n1 + 1):
-        for j in range(n2 + 1):
-            log_entry = _log_comb(n1, i) + _log_comb(n2, j) - _log_comb(n1 + n2, i + j)
-            data_2D[i, j] = data_1D.data[i+j] * np.exp(log_entry)
+    data_2D = _split_array(data_1D.data, 0, n1, n2)
 
     data_2D = Spectrum_mod.Spectrum(data_2D, mask_corners=False)
     if mask_lost == True:
@@ -101,7 +126,7 @@ def split_2D_to_3D_2(sfs, n2new, n3):
     if model is not None:
         model.split(1, (1,2))
     
-    data_2D = copy.copy(sfs)
+    data_2D = sfs
     assert(len(data_2D.shape) == 2)
     n1 = data_2D.shape[0] - 1
     n2 = data_2D.shape[1] - 1
@@ -109,14 +134,9 @@ def split_2D_to_3D_2(sfs, n2new, n3):
     # if the sample size before split is too large, we project
     if n2 > n2new + n3:
         data_2D = data_2D.project([n1, n2new + n3])
-    data_2D.unmask_all()
     
     # then we compute the joint fs resulting from the split
-    data_3D = np.zeros((n1 + 1, n2new + 1, n3 + 1))
-    for i in range(n2new + 1):
-        for j in range(n3 + 1):
-            log_entry_weight = _log_comb(n2new, i) + _log_comb(n3, j) - _log_comb(n2new + n3, i + j)
-            data_3D[:, i, j] = data_2D.data[:, i + j] * np.exp(log_entry_weight)
+    data_3D = _split_array(data_2D.data, 1, n2new, n3)
 
     data_3D = Spectrum_mod.Spectrum(data_3D, mask_corners=False)
     if mask_lost == True:
@@ -154,7 +174,7 @@ def split_2D_to_3D_1(sfs, n1new, n3):
     if model is not None:
         model.split(0, (0,2))
   
-    data_2D = copy.copy(sfs)
+    data_2D = sfs
     assert(len(data_2D.shape) == 2)
     n1 = data_2D.shape[0] - 1
     n2 = data_2D.shape[1] - 1
@@ -162,14 +182,9 @@ def split_2D_to_3D_1(sfs, n1new, n3):
     # if the sample size before split is too large, we project
     if n1 > n1new + n3:
         data_2D = data_2D.project([n1new + n3, n2])
-    data_2D.unmask_all()
     
     # then we compute the joint fs resulting from the split
-    data_3D = np.zeros((n1new + 1, n2 + 1, n3 + 1))
-    for i in range(n1new + 1):
-        for j in range(n3 + 1):
-            log_entry_weight = _log_comb(n1new, i) + _log_comb(n3, j) - _log_comb(n1new + n3, i + j)
-            data_3D[i, :, j] = data_2D.data[i + j, :] * np.exp(log_entry_weight)
+    data_3D = _split_array(data_2D.data, 0, n1new, n3)
 
     data_3D = Spectrum_mod.Spectrum(data_3D, mask_corners=False)
     if mask_lost == True:
@@ -207,7 +222,7 @@ def split_3D_to_4D_3(sfs, n3new, n4):
     if model is not None:
         model.split(2, (2,3))
     
-    data_3D = copy.copy(sfs)
+    data_3D = sfs
     assert(len(data_3D.shape) == 3)
     n1 = data_3D.shape[0] - 1
     n2 = data_3D.shape[1] - 1
@@ -216,14 +231,9 @@ def split_3D_to_4D_3(sfs, n3new, n4):
     # if the sample size before split is too large, we project
     if n3 > n3new + n4:
         data_3D = data_3D.project([n1, n2, n3new + n4])
-    data_3D.unmask_all()
     
     # then we compute the joint fs resulting from the split
-    data_4D = np.zeros((n1 + 1, n2 + 1, n3new + 1, n4 + 1))
-    for i in range(n3new + 1):
-        for j in range(n4 + 1):
-            log_entry_weight = _log_comb(n3new, i) + _log_comb(n4, j) - _log_comb(n3new + n4, i + j)
-            data_4D[:, :, i, j] = data_3D.data[:, :, i + j] * np.exp(log_entry_weight)
+    data_4D = _split_array(data_3D.data, 2, n3new, n4)
 
     data_4D = Spectrum_mod.Spectrum(data_4D, mask_corners=False)
     if mask_lost == True:
@@ -261,7 +271,7 @@ def split_4D_to_5D_4(sfs, n4new, n5):
     if model is not None:
         model.split(3, (3,4))
     
-    data_4D = copy.copy(sfs)
+    data_4D = sfs
     assert(len(data_4D.shape) == 4)
     n1 = data_4D.shape[0] - 1
     n2 = data_4D.shape[1] - 1
@@ -271,14 +281,9 @@ def split_4D_to_5D_4(sfs, n4new, n5):
     # if the sample size before split is too large, we project
     if n4 > n4new + n5:
         data_4D = data_4D.project([n1, n2, n3, n4new + n5])
-    data_4D.unmask_all()
     
     # then we compute the joint fs resulting from the split
-    data_5D = np.zeros((n1 + 1, n2 + 1, n3 + 1, n4new + 1, n5 + 1))
-    for i in range(n4new + 1):
-        for j in range(n5 + 1):
-            log_entry_weight = _log_comb(n4new, i) + _log_comb(n5, j) - _log_comb(n4new + n5, i + j)
-            data_5D[:, :, :, i, j] = data_4D.data[:, :, :, i + j] * np.exp(log_entry_weight)
+    data_5D = _split_array(data_4D.data, 3, n4new, n5)
 
     data_5D = Spectrum_mod.Spectrum(data_5D, mask_corners=False)
     if mask_lost == True:
@@ -316,7 +321,7 @@ def split_4D_to_5D_3(sfs, n3new, n5):
     if model is not None:
         model.split(2, (2,4))
     
-    data_4D = copy.copy(sfs)
+    data_4D = sfs
     assert(len(data_4D.shape) == 4)
     n1 = data_4D.shape[0] - 1
     n2 = data_4D.shape[1] - 1
@@ -326,14 +331,9 @@ def split_4D_to_5D_3(sfs, n3new, n5):
     # if the sample size before split is too large, we project
     if n3 > n3new + n5:
         data_4D = data_4D.project([n1, n2, n3new + n5, n4])
-    data_4D.unmask_all()
     
     # then we compute the joint fs resulting from the split
-    data_5D = np.zeros((n1 + 1, n2 + 1, n3new + 1, n4 + 1, n5 + 1))
-    for i in range(n3new + 1):
-        for j in range(n5 + 1):
-            log_entry_weight = _log_comb(n3new, i) + _log_comb(n5, j) - _log_comb(n3new + n5, i + j)
-            data_5D[:, :, i, :, j] = data_4D.data[:, :, i + j, :] * np.exp(log_entry_weight)
+    data_5D = _split_array(data_4D.data, 2, n3new, n5)
 
     data_5D = Spectrum_mod.Spectrum(data_5D, mask_corners=False)
     if mask_lost == True:
@@ -413,14 +413,8 @@ def merge_2D_to_1D(sfs):
     if model is not None:
         model.merge((0,1),0)
     
-    data_2D = copy.copy(sfs)
-    assert(len(data_2D.shape) == 2)
-    data_2D.unmask_all()
-    dim1, dim2 = data_2D.shape
-    data = np.zeros(dim1 + dim2 - 1)
-    for k in range(dim1):
-        for l in range(dim2):
-            data[k + l] += data_2D[k, l]
+    assert(len(sfs.shape) == 2)
+    data = _merge_array(sfs.data)
 
     data = Spectrum_mod.Spectrum(data, mask_corners=False)
     if mask_lost == True:
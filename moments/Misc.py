@@ -2,7 +2,7 @@
 Miscellaneous utility functions. Including ms simulation.
 """
 
-import bisect,collections,operator,os,sys,time
+import array,collections,multiprocessing,operator,os,struct,sys,time
 
 import numpy
 import scipy.linalg
@@ -300,7 +300,7 @@ def count_data_dict(data_dict, pop_ids):
     """
     Summarize data in data_dict by mapping SNP configurations to counts.
 
-    data_dict: data_dict formatted as in Misc.make_data_dict
+    data_dict: data_dict formatted as in Misc.make_data_dict, or SNPData
     pop_ids: IDs of populations to collect data for.
     
     Returns a dictionary with keys (successful_calls, derived_calls,
@@ -309,6 +309,8 @@ def count_data_dict(data_dict, pop_ids):
     of derived calls per pop, and polarized indicates whether that SNP was
     polarized using an ancestral state.
     """
+    if isinstance(data_dict, SNPData):
+        return data_dict.count_configurations(pop_ids)
     count_dict = collections.defaultdict(int)
     for snp, snp_info in data_dict.items():
         # Skip SNPs that aren't biallelic.
@@ -382,40 +384,47 @@ def make_data_dict_vcf(vcf_filename, popinfo_filename, filter=True,
                     base-pair is the one immediately preceding the SNP, and the
                     last base-pair is the one immediately following the SNP.
     """
-    # Read population information from file based on extension
-    if os.path.splitext(popinfo_filename)[1] == '.gz':
-        import gzip
-        popinfo_file = gzip.open(popinfo_filename)
-    elif os.path.splitext(popinfo_filename)[1] == '.zip':
-        import zipfile
-        archive = zipfile.ZipFile(popinfo_filename)
-        namelist = archive.namelist()
-        if len(namelist) != 1:
-            raise ValueError("Must be only a single popinfo file in zip "
-                             "archive: {}".format(popinfo_filename))
-        popinfo_file = archive.open(namelist[0])
-    else:
-        popinfo_file = open(popinfo_filename)
     # pop_dict has key, value pairs of "SAMPLE_NAME" : "POP_NAME"
+    popinfo_file = _open_file(popinfo_filename, 'popinfo')
     popinfo_dict = _get_popinfo(popinfo_file)
     popinfo_file.close()
 
-    # Open VCF file
-    if os.path.splitext(vcf_filename)[1] == '.gz':
+    vcf_file = _open_file(vcf_filename, 'vcf')
+    data_dict = {}
+    for chrom, pos, snp_dict in _parse_vcf(vcf_file, popinfo_dict, filter,
+                                           flanking_info):
+        data_dict[chrom + '_' + pos] = snp_dict
+
+    vcf_file.close()
+    return data_dict
+
+def _open_file(filename, kind):
+    """
+    Opens a file, which may be zipped (.zip) or gzipped (.gz). A zip archive
+    must contain only this file.
+
+    kind: Description of the file for the error messages.
+    """
+    if os.path.splitext(filename)[1] == '.gz':
         import gzip
-        vcf_file = gzip.open(vcf_filename)
-    elif os.path.splitext(vcf_filename)[1] == '.zip':
+        return gzip.open(filename)
+    elif os.path.splitext(filename)[1] == '.zip':
         import zipfile
-        archive = zipfile.ZipFile(vcf_filename)
+        archive = zipfile.ZipFile(filename)
         namelist = archive.namelist()
         if len(namelist) != 1:
-            raise ValueError("Must be only a single vcf file in zip "
-                             "archive: {}".format(vcf_filename))
-        vcf_file = archive.open(namelist[0])
+            raise ValueError("Must be only a single {} file in zip "
+                             "archive: {}".format(kind, filename))
+        return archive.open(namelist[0])
     else:
-        vcf_file = open(vcf_filename)
-    
-    data_dict = {}
+        return open(filename)
+
+def _parse_vcf(vcf_file, popinfo_dict, filter, flanking_info):
+    """
+    Generator of the (chrom, pos, snp_dict) of the SNPs of an open VCF file
+    (chrom and pos being the strings of the first two columns), with
+    snp_dict formatted as in the data dictionaries (see make_data_dict_vcf).
+    """
     for line in vcf_file:
         # decoding lines for Python 3 - probably a better way to handle this
         try:
@@ -438,7 +447,6 @@ def make_data_dict_vcf(vcf_filename, popinfo_filename, filter=True,
             
         # Read SNP data
         cols = line.split()
-        snp_id = '_'.join(cols[:2]) # CHROM_POS
         snp_dict = {}
         
         # Skip SNP if filter is set to True and it fails a filter test
@@ -513,10 +521,531 @@ def make_data_dict_vcf(vcf_filename, popinfo_filename, filter=True,
         if not full_info:
             continue
         snp_dict['calls'] = calls_dict
-        data_dict[snp_id] = snp_dict
+        yield cols[0], cols[1], snp_dict
+
+class SNPData(object):
+    """
+    Columnar store of biallelic SNP data: an array based alternative to the
+    data dictionaries (see make_data_dict), with a few bytes per SNP instead
+    of a dictionary per SNP. It is accepted by count_data_dict, bootstrap and
+    the Spectrum.from_data_dict methods in place of a data dictionary.
+
+    chrom: Chromosome of each SNP (strings).
+    pos: Position of each SNP.
+    alleles: Array (SNPs x 2) of the segregating alleles.
+    outgroup: Outgroup allele of each SNP ('-' if unknown).
+    calls: Array (SNPs x pops x 2) of the number of calls of each allele in
+           each population.
+    pop_ids: Population of each column of calls.
+    context, outgroup_context: Optional 3 bases contexts of the SNPs in the
+                               species of interest and in the outgroup.
+    """
+    _columns = ['chrom', 'pos', 'alleles', 'outgroup', 'calls', 'context',
+                'outgroup_context']
+
+    def __init__(self, chrom, pos, alleles, outgroup, calls, pop_ids,
+                 context=None, outgroup_context=None):
+        # Arrays (and memory maps) of the right kind are kept as they are.
+        self.chrom = _as_column(chrom, 'U')
+        self.pos = _as_column(pos, 'i', numpy.int64)
+        self.alleles = _as_column(alleles, 'U').reshape(-1, 2)
+        self.outgroup = _as_column(outgroup, 'U')
+        self.pop_ids = list(pop_ids)
+        self.calls = _as_column(calls, 'i', numpy.int32).reshape(
+            len(self.pos), len(self.pop_ids), 2)
+        if context is None:
+            context = numpy.char.add(numpy.char.add('-', self.alleles[:, 0]), '-')
+        if outgroup_context is None:
+            outgroup_context = numpy.char.add(numpy.char.add('-', self.outgroup), '-')
+        self.context = _as_column(context, 'U')
+        self.outgroup_context = _as_column(outgroup_context, 'U')
+
+    def __len__(self):
+        return len(self.pos)
+
+    @staticmethod
+    def from_data_dict(data_dict, pop_ids=None):
+        """
+        Converts a data dictionary. Non-biallelic SNPs are skipped.
+
+        pop_ids: Populations to keep (by default all the populations of the
+                 first SNP, sorted).
+
+        The chromosome and position are read from SNP IDs of the form
+        CHROM_POS. Other IDs are kept as chromosome, with position 0.
+        """
+        records = []
+        for snp_id, snp_info in data_dict.items():
+            if len(snp_info['segregating']) != 2:
+                continue
+            if pop_ids is None:
+                pop_ids = sorted(snp_info['calls'])
+            chrom, _, pos = snp_id.rpartition('_')
+            if not chrom or not pos.isdigit():
+                chrom, pos = snp_id, 0
+            records.append((chrom, int(pos), snp_info))
+        return SNPData._from_records(records, pop_ids)
+
+    @staticmethod
+    def _from_records(records, pop_ids):
+        """
+        SNPData from a list of (chrom, pos, snp_info), snp_info being
+        formatted as in the data dictionaries.
+        """
+        if pop_ids is None:
+            pop_ids = sorted(records[0][2]['calls']) if records else []
+        outgroup = [info.get('outgroup_allele', '-') for _, _, info in records]
+        return SNPData([chrom for chrom, _, _ in records],
+                       [pos for _, pos, _ in records],
+                       [info['segregating'] for _, _, info in records],
+                       outgroup,
+                       [[info['calls'][pop] for pop in pop_ids]
+                        for _, _, info in records],
+                       pop_ids,
+                       [info.get('context', '-' + info['segregating'][0] + '-')
+                        for _, _, info in records],
+                       [info.get('outgroup_context', '-' + og + '-')
+                        for (_, _, info), og in zip(records, outgroup)])
+
+    def to_data_dict(self):
+        """
+        Data dictionary with the same SNPs, with IDs CHROM_POS.
+        """
+        data_dict = {}
+        calls = self.calls.tolist()
+        for ii in range(len(self)):
+            data_dict['%s_%i' % (self.chrom[ii], self.pos[ii])] = {
+                'segregating': tuple(self.alleles[ii]),
+                'outgroup_allele': str(self.outgroup[ii]),
+                'context': str(self.context[ii]),
+                'outgroup_context': str(self.outgroup_context[ii]),
+                'calls': dict((pop, tuple(c)) for pop, c
+                              in zip(self.pop_ids, calls[ii]))}
+        return data_dict
+
+    def save(self, dirname):
+        """
+        Writes the columns as .npy files (and the population IDs as
+        pop_ids.txt) in the directory dirname, created if needed.
+        """
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for name in self._columns:
+            numpy.save(os.path.join(dirname, name + '.npy'), getattr(self, name))
+        with open(os.path.join(dirname, 'pop_ids.txt'), 'w') as f:
+            f.write('\n'.join(self.pop_ids) + '\n')
+
+    @staticmethod
+    def load(dirname, mmap_mode='r'):
+        """
+        Reads the columns written by save.
+
+        mmap_mode: The columns are memory-mapped by default (see numpy.load),
+                   so that only the parts used are read from the disk. None
+                   reads them in memory.
+        """
+        columns = dict((name, numpy.load(os.path.join(dirname, name + '.npy'),
+                                         mmap_mode=mmap_mode))
+                       for name in SNPData._columns)
+        with open(os.path.join(dirname, 'pop_ids.txt')) as f:
+            pop_ids = [line.strip() for line in f if line.strip()]
+        return SNPData(pop_ids=pop_ids, **columns)
+
+    def _pop_indices(self, pop_ids):
+        try:
+            return [self.pop_ids.index(pop) for pop in pop_ids]
+        except ValueError:
+            raise ValueError('Populations %s not all in the data (%s).'
+                             % (pop_ids, self.pop_ids))
+
+    def configurations(self, pop_ids):
+        """
+        Successful and derived calls of each SNP, as in count_data_dict.
+
+        Returns the arrays (SNPs x pops) of successful calls and of derived
+        calls, and whether each SNP is polarized by its outgroup allele (if
+        it is not, the second allele is taken as derived).
+        """
+        calls = numpy.asarray(self.calls)[:, self._pop_indices(pop_ids), :]
+        polarized = (self.outgroup == self.alleles[:, 0])\
+                    | (self.outgroup == self.alleles[:, 1])
+        first_derived = (self.outgroup == self.alleles[:, 1])\
+                        & (self.outgroup != self.alleles[:, 0])
+        derived = numpy.where(first_derived[:, numpy.newaxis],
+                              calls[:, :, 0], calls[:, :, 1])
+        return calls.sum(axis=2), derived, polarized
+
+    def count_configurations(self, pop_ids):
+        """
+        Dictionary mapping SNP configurations to counts (see
+        count_data_dict).
+        """
+        return _count_configurations(*self.configurations(pop_ids))
+
+def _count_configurations(called, derived, polarized):
+    """
+    Dictionary mapping SNP configurations to counts (see count_data_dict),
+    from the arrays (SNPs x pops) of successful and derived calls and the
+    polarization of the SNPs.
+    """
+    npops = called.shape[1]
+    keys, counts = _unique_rows(numpy.hstack([called, derived,
+                                              polarized[:, numpy.newaxis]]))
+    count_dict = collections.defaultdict(int)
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        count_dict[tuple(key[:npops]), tuple(key[npops:2 * npops]),
+                   bool(key[-1])] = count
+    return count_dict
+
+def _unique_rows(keys):
+    """
+    Sorted unique rows of the array keys (of non-negative integers), and
+    their counts.
+    """
+    if len(keys) == 0:
+        return keys, numpy.zeros(0, int)
+    bases = keys.max(axis=0) + 1
+    if numpy.prod(bases.astype(float)) < 2**62:
+        # sorting integers is much faster than sorting rows
+        codes = numpy.ravel_multi_index(keys.T, bases)
+        codes, counts = numpy.unique(codes, return_counts=True)
+        keys = numpy.array(numpy.unravel_index(codes, bases)).T
+        return keys.reshape(len(codes), -1), counts
+    return numpy.unique(keys, axis=0, return_counts=True)
+
+def _as_column(values, kind, dtype=None):
+    """
+    Array of values, converted only if it is not of the given kind
+    ('U' for strings, 'i' for integers).
+    """
+    if isinstance(values, numpy.ndarray) and values.dtype.kind == kind:
+        return values
+    if kind == 'U':
+        return numpy.array(values, dtype=str)
+    return numpy.array(values, dtype=dtype)
+
+def make_snp_data_vcf(vcf_filename, popinfo_filename, filter=True,
+                      flanking_info=[None, None]):
+    """
+    Parse a VCF file as make_data_dict_vcf, but store the SNPs in a SNPData
+    object (with the populations sorted by name).
+    """
+    popinfo_file = _open_file(popinfo_filename, 'popinfo')
+    popinfo_dict = _get_popinfo(popinfo_file)
+    popinfo_file.close()
 
+    # The columns grow while the file is read, and the dictionary of each
+    # SNP is dropped. Numbers are stored in compact arrays, and the few
+    # distinct strings (chromosomes, contexts) are shared between SNPs.
+    strings = {}
+    chroms, alleles, outgroup, context, outgroup_context = [], [], [], [], []
+    pos = array.array('q')
+    calls = array.array('i')
+    pop_ids = None
+    vcf_file = _open_file(vcf_filename, 'vcf')
+    for chrom, snp_pos, snp_dict in _parse_vcf(vcf_file, popinfo_dict, filter,
+                                               flanking_info):
+        if pop_ids is None:
+            pop_ids = sorted(snp_dict['calls'])
+        chroms.append(strings.setdefault(chrom, chrom))
+        pos.append(int(snp_pos))
+        alleles.extend(snp_dict['segregating'])
+        outgroup.append(snp_dict['outgroup_allele'])
+        for key, column in [('context', context),
+                            ('outgroup_context', outgroup_context)]:
+            column.append(strings.setdefault(snp_dict[key], snp_dict[key]))
+        for pop in pop_ids:
+            calls.extend(snp_dict['calls'][pop])
     vcf_file.close()
-    return data_dict
+    if pop_ids is None:
+        pop_ids = sorted(set(popinfo_dict.values()))
+    return SNPData(chroms, numpy.frombuffer(pos, numpy.int64), alleles,
+                   outgroup, numpy.frombuffer(calls, numpy.int32),
+                   pop_ids, context, outgroup_context)
+
+def count_data_vcf(vcf_filename, popinfo_filename, pop_ids, filter=True,
+                   processes=1, chunk_size=2**26):
+    """
+    Count the SNP configurations of a VCF file, as
+    count_data_dict(make_data_dict_vcf(...), pop_ids), without building a
+    dictionary per SNP.
+
+    The file is split into chunks of about chunk_size bytes, which are
+    parsed by processes worker processes. The genotypes of each chunk are
+    read with vectorized operations on the raw bytes, and the workers send
+    back the (small) count dictionaries of their chunks, which are merged.
+
+    Uncompressed and bgzipped (e.g. bgzip, tabix) files are split into byte
+    ranges read by the workers themselves (at block boundaries for bgzip).
+    Other gzipped or zipped files cannot be read from the middle, so they
+    are decompressed by the main process and their lines sent to the
+    workers.
+
+    vcf_filename, popinfo_filename, filter: See make_data_dict_vcf. Only the
+                                            GT field of the genotypes is
+                                            used, and context information
+                                            is ignored.
+    pop_ids: Populations to count, in order.
+
+    Unlike data dictionaries, which keep a single SNP per CHROM_POS ID, every
+    record of the file is counted.
+    """
+    popinfo_file = _open_file(popinfo_filename, 'popinfo')
+    popinfo_dict = _get_popinfo(popinfo_file)
+    popinfo_file.close()
+    missing = set(pop_ids) - set(popinfo_dict.values())
+    if missing:
+        raise ValueError('Populations %s not in the popinfo file.'
+                         % sorted(missing))
+
+    # Sample columns: index of their population in pop_ids, -1 if they are
+    # in another population (they must still be called) and -2 if they are
+    # not in popinfo_dict.
+    vcf_file = _open_file(vcf_filename, 'vcf')
+    for line in vcf_file:
+        try:
+            line = line.decode()
+        except AttributeError:
+            pass
+        if line.startswith('#') and not line.startswith('##'):
+            break
+    else:
+        raise ValueError("No header in VCF file")
+    vcf_file.close()
+    header_cols = line.split()
+    if len(header_cols) <= 9:
+        raise ValueError("No samples in VCF file")
+    sample_pops = numpy.array([pop_ids.index(popinfo_dict[sample])
+                               if popinfo_dict.get(sample) in pop_ids
+                               else -1 if sample in popinfo_dict else -2
+                               for sample in header_cols[9:]])
+    args = (sample_pops, len(pop_ids), filter)
+
+    kind = _vcf_kind(vcf_filename)
+    if kind == 'text':
+        size = os.path.getsize(vcf_filename)
+        tasks = [(_count_vcf_range, (vcf_filename, False, start,
+                                     min(start + chunk_size, size)) + args)
+                 for start in range(0, size, chunk_size)]
+    elif kind == 'bgzip':
+        tasks = [(_count_vcf_range, (vcf_filename, True, offset, length)
+                                    + args)
+                 for offset, length in _bgzip_chunks(vcf_filename,
+                                                     chunk_size)]
+    else:
+        tasks = ((_count_vcf_lines, (lines,) + args)
+                 for lines in _vcf_line_chunks(vcf_filename, chunk_size))
+
+    count_dict = collections.defaultdict(int)
+    def merge(counts):
+        for key, count in counts.items():
+            count_dict[key] += count
+
+    if processes == 1:
+        for func, func_args in tasks:
+            merge(func(*func_args))
+        return count_dict
+
+    pool = multiprocessing.Pool(processes)
+    try:
+        # Bound the number of pending chunks, which may be held in memory.
+        pending = collections.deque()
+        for func, func_args in tasks:
+            pending.append(pool.apply_async(func, func_args))
+            if len(pending) > 2 * processes:
+                merge(pending.popleft().get())
+        while pending:
+            merge(pending.popleft().get())
+    finally:
+        pool.close()
+        pool.join()
+    return count_dict
+
+def make_spectrum_vcf(vcf_filename, popinfo_filename, pop_ids, projections,
+                      polarized=True, mask_corners=True, filter=True,
+                      processes=1, chunk_size=2**26):
+    """
+    Frequency spectrum of a VCF file, as
+    Spectrum.from_data_dict(make_data_dict_vcf(...), ...), computed by
+    count_data_vcf (see it for the parallel processing and the arguments).
+
+    pop_ids, projections, polarized, mask_corners: See
+                                                   Spectrum.from_data_dict.
+    """
+    count_dict = count_data_vcf(vcf_filename, popinfo_filename, pop_ids,
+                                filter=filter, processes=processes,
+                                chunk_size=chunk_size)
+    return Spectrum_mod.Spectrum._from_count_dict(count_dict, projections,
+                                                  polarized, pop_ids,
+                                                  mask_corners)
+
+def _vcf_kind(filename):
+    """
+    'text', 'bgzip' (gzip with BGZF blocks, which can be read from the start
+    of any block) or 'compressed' (other gzip or zip files).
+    """
+    ext = os.path.splitext(filename)[1]
+    if ext == '.zip':
+        return 'compressed'
+    if ext != '.gz':
+        return 'text'
+    with open(filename, 'rb') as f:
+        header = f.read(18)
+    # gzip header with the extra subfield 'BC' of BGZF
+    if len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04'\
+       and header[12:14] == b'BC':
+        return 'bgzip'
+    return 'compressed'
+
+def _bgzip_chunks(filename, chunk_size):
+    """
+    Split a BGZF file into chunks of whole blocks, of about chunk_size
+    compressed bytes.
+
+    Returns a list of (offset, length) with the compressed offset of the
+    first block of each chunk and its uncompressed length.
+    """
+    chunks = []
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        offset = chunk_offset = chunk_length = 0
+        while offset < size:
+            f.seek(offset)
+            header = f.read(18)
+            if header[12:14] != b'BC':
+                raise ValueError('Invalid BGZF block in %s at offset %i.'
+                                 % (filename, offset))
+            block_size = struct.unpack('<H', header[16:18])[0] + 1
+            f.seek(offset + block_size - 4)
+            chunk_length += struct.unpack('<I', f.read(4))[0]
+            offset += block_size
+            if offset - chunk_offset >= chunk_size or offset >= size:
+                chunks.append((chunk_offset, chunk_length))
+                chunk_offset, chunk_length = offset, 0
+    return [chunk for chunk in chunks if chunk[1] > 0]
+
+def _vcf_line_chunks(filename, chunk_size):
+    """
+    Generator of lists of lines of about chunk_size bytes, read from a file
+    that cannot be split.
+    """
+    vcf_file = _open_file(filename, 'vcf')
+    try:
+        while True:
+            lines = vcf_file.readlines(chunk_size)
+            if not lines:
+                break
+            if not isinstance(lines[0], bytes):
+                lines = [line.encode() for line in lines]
+            yield lines
+    finally:
+        vcf_file.close()
+
+def _count_vcf_range(filename, bgzip, start, end, sample_pops, npops,
+                     filter):
+    """
+    Count the SNP configurations of the lines of a VCF file that start in a
+    byte range: ]start, end], or [0, end] if start is 0.
+
+    If bgzip is True, start is the compressed offset of a BGZF block, and
+    end is the uncompressed length of the range starting there.
+    """
+    import gzip
+    raw = open(filename, 'rb')
+    try:
+        raw.seek(start)
+        if bgzip:
+            # Offsets in the uncompressed stream, from the block
+            f = gzip.GzipFile(fileobj=raw)
+            first, start = start == 0, 0
+        else:
+            f = raw
+            first = start == 0
+        if not first:
+            # The line overlapping the start belongs to the previous range.
+            f.readline()
+        lines = []
+        while f.tell() <= end:
+            line = f.readline()
+            if not line:
+                break
+            lines.append(line)
+    finally:
+        raw.close()
+    return _count_vcf_lines(lines, sample_pops, npops, filter)
+
+_bases = (b'A', b'C', b'G', b'T')
+
+def _count_vcf_lines(lines, sample_pops, npops, filter):
+    """
+    Count the SNP configurations of lines (bytes) of a VCF file, with the
+    same rules as make_data_dict_vcf.
+
+    sample_pops: Population index of each sample column (see
+                 count_data_vcf).
+    """
+    genotypes, ref_derived, polarized = [], [], []
+    for line in lines:
+        if line.startswith(b'#'):
+            continue
+        cols = line.split(b'\t', 9)
+        if len(cols) < 10:
+            continue
+        # Skip SNP if filter is set to True and it fails a filter test
+        if filter and cols[6] != b'PASS' and cols[6] != b'.':
+            continue
+        ref, alt = cols[3].upper(), cols[4].upper()
+        if ref not in _bases or alt not in _bases:
+            continue
+        outgroup = b'-'
+        for field in cols[7].split(b';'):
+            if field.startswith(b'AA'):
+                outgroup = field[3:].upper()
+                break
+        gts = cols[9].rstrip()
+        if not cols[8].startswith(b'GT'):
+            # GT should be the first field, but is not always
+            gtindex = cols[8].split(b':').index(b'GT')
+            gts = b'\t'.join([sample.split(b':')[gtindex]
+                              for sample in gts.split(b'\t')])
+        genotypes.append(gts)
+        # The reference allele is derived if the outgroup has the alternate
+        # one. Otherwise the alternate allele is taken as derived.
+        ref_derived.append(outgroup == alt and outgroup != ref)
+        polarized.append(outgroup in (ref, alt))
+    nsnps, nsamples = len(genotypes), len(sample_pops)
+    if nsnps == 0:
+        return collections.defaultdict(int)
+
+    # All the genotypes, as bytes, separated by tabs. The alleles are the
+    # first and third bytes of each sample column.
+    chars = numpy.frombuffer(b'\t'.join(genotypes), numpy.uint8)
+    tabs = numpy.flatnonzero(chars == ord('\t'))
+    if len(tabs) + 1 != nsnps * nsamples:
+        raise ValueError('Lines of the VCF file without one column per '
+                         'sample.')
+    starts = numpy.concatenate([[0], tabs + 1])
+    lengths = numpy.concatenate([tabs, [len(chars)]]) - starts
+    called = sample_pops >= -1
+    starts = starts.reshape(nsnps, nsamples)[:, called]
+    lengths = lengths.reshape(nsnps, nsamples)[:, called]
+    g1 = chars[starts]
+    g2 = chars[numpy.minimum(starts + 2, len(chars) - 1)]
+    # Skip SNPs with a missing genotype (or not diploid)
+    missing = (g1 == ord('.')) | (g2 == ord('.')) | (lengths < 3)
+    keep = ~missing.any(axis=1)
+    refcalls = (g1 == ord('0')).astype(numpy.int32) + (g2 == ord('0'))
+    altcalls = (g1 == ord('1')).astype(numpy.int32) + (g2 == ord('1'))
+    pops = sample_pops[called]
+    refs = numpy.zeros((nsnps, npops), numpy.int32)
+    alts = numpy.zeros((nsnps, npops), numpy.int32)
+    for pop in range(npops):
+        refs[:, pop] = refcalls[:, pops == pop].sum(axis=1)
+        alts[:, pop] = altcalls[:, pops == pop].sum(axis=1)
+    ref_derived = numpy.array(ref_derived)
+    derived = numpy.where(ref_derived[:, numpy.newaxis], refs, alts)
+    return _count_configurations((refs + alts)[keep], derived[keep],
+                                 numpy.array(polarized)[keep])
 
 def _get_popinfo(popinfo_file):
     """
@@ -570,8 +1099,185 @@ def _get_popinfo(popinfo_file):
     
     return popinfo_dict
 
+class IntervalIndex(object):
+    """
+    Index of genomic intervals (e.g. the regions of a BED file), to find at
+    once the intervals containing many positions.
+
+    chroms, starts, ends: Chromosome, start and end of each interval. The
+                          intervals are half-open [start, end) as in BED
+                          files. They may be unsorted and overlap.
+    labels: Optional label of each interval. Intervals with the same label
+            form a group (by default each interval is its own group).
+
+    The intervals of each chromosome are sorted by start, and the positions
+    are located by binary search (numpy.searchsorted) over these arrays.
+    """
+    def __init__(self, chroms, starts, ends, labels=None):
+        self.chroms = _as_column(chroms, 'U')
+        self.starts = _as_column(starts, 'i', numpy.int64)
+        self.ends = _as_column(ends, 'i', numpy.int64)
+        if labels is None:
+            labels = range(len(self.starts))
+        group_dict = {}
+        self.groups = numpy.array([group_dict.setdefault(label, len(group_dict))
+                                   for label in labels], int)
+        # Label of each group
+        self.labels = list(group_dict)
+
+        self._chrom_dict = {}
+        order = numpy.lexsort((self.starts, self.chroms))
+        sorted_chroms = self.chroms[order]
+        bounds = numpy.flatnonzero(sorted_chroms[1:] != sorted_chroms[:-1]) + 1
+        bounds = numpy.concatenate([[0], bounds, [len(order)]])
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            if first == last:
+                continue
+            ii = order[first:last]
+            ends = self.ends[ii]
+            # The largest end of the intervals starting before each one
+            # tells whether a position can be in an interval before the
+            # last one starting before it.
+            self._chrom_dict[sorted_chroms[first]] = [
+                ii, self.starts[ii], ends, numpy.maximum.accumulate(ends), None]
+
+    def __len__(self):
+        return len(self.starts)
+
+    @staticmethod
+    def from_bed(filename, min_length=None):
+        """
+        Reads the intervals of a BED file.
+
+        filename: Name of the BED file.
+        min_length: If not None, shorter intervals are skipped.
+
+        The label of each interval is its name (fourth column) if present,
+        else its line number. Track, browser and comment lines are skipped.
+        """
+        chroms, starts, ends, labels = [], [], [], []
+        with open(filename) as bed_file:
+            for linenum, line in enumerate(bed_file):
+                fields = line.split()
+                if not fields or fields[0] in ('track', 'browser')\
+                   or fields[0].startswith('#'):
+                    continue
+                start, end = int(fields[1]), int(fields[2])
+                if min_length is not None and end - start < min_length:
+                    continue
+                chroms.append(fields[0])
+                starts.append(start)
+                ends.append(end)
+                labels.append(fields[3] if len(fields) >= 4 else linenum)
+        return IntervalIndex(chroms, starts, ends, labels)
+
+    def find(self, chroms, positions, closed=False):
+        """
+        Index of the interval containing each position (-1 if there is none).
+
+        chroms: Chromosome of each position, or a single chromosome name.
+        positions: Array of positions.
+        closed: If True, the ends of the intervals are included.
+
+        If several intervals contain a position, the one starting last is
+        returned.
+        """
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        result = -numpy.ones(len(positions), int)
+        for chrom, sl in _chrom_slices(chroms, len(positions)):
+            entry = self._chrom_dict.get(chrom)
+            if entry is not None:
+                result[sl] = self._find(entry, positions[sl], closed)
+        return result
+
+    def contains(self, chroms, positions, closed=False):
+        """
+        Whether each position is in some interval (see find).
+        """
+        positions = numpy.asarray(positions, dtype=numpy.int64)
+        result = numpy.zeros(len(positions), bool)
+        for chrom, sl in _chrom_slices(chroms, len(positions)):
+            entry = self._chrom_dict.get(chrom)
+            if entry is not None:
+                ii, limits = self._last_start(entry, positions[sl], closed)
+                result[sl] = (ii >= 0) & (entry[3][ii] > limits)
+        return result
+
+    @staticmethod
+    def _last_start(entry, positions, closed):
+        """
+        Index (in the sorted intervals of a chromosome) of the last interval
+        starting at or before each position, and the limits the ends of the
+        intervals must exceed to contain the positions.
+        """
+        ii = numpy.searchsorted(entry[1], positions, 'right') - 1
+        return ii, positions - 1 if closed else positions
+
+    def _find(self, entry, positions, closed):
+        """
+        Intervals of a chromosome containing positions (see find).
+        """
+        order, starts, ends, max_ends = entry[:4]
+        ii, limits = self._last_start(entry, positions, closed)
+        result = -numpy.ones(len(positions), int)
+        found = ii >= 0
+        inside = found & (ends[ii] > limits)
+        result[inside] = ii[inside]
+        # Positions after the end of the last interval starting before them,
+        # but inside an earlier (longer) interval
+        back = numpy.flatnonzero(found & ~inside & (max_ends[ii] > limits))
+        if len(back):
+            result[back] = self._find_back(entry, ii[back], limits[back])
+        return numpy.where(result >= 0, order[result], -1)
+
+    @staticmethod
+    def _find_back(entry, ii, limits):
+        """
+        Last interval before ii whose end is above limits (there must be one).
+        """
+        ends = entry[2]
+        if entry[4] is None:
+            # table[k][j] is the largest end of the intervals j - 2**k + 1 to j
+            table = [ends]
+            while 2**len(table) <= len(ends):
+                step = 2**(len(table) - 1)
+                level = table[-1].copy()
+                level[step:] = numpy.maximum(level[step:], table[-1][:-step])
+                table.append(level)
+            entry[4] = table
+        ii = ii.copy()
+        # The distance to the interval is found bit by bit, skipping blocks
+        # of intervals which all end before the limits.
+        for k in range(len(entry[4]) - 1, -1, -1):
+            skip = entry[4][k][ii] <= limits
+            ii[skip] -= 2**k
+        return ii
+
+def _chrom_slices(chroms, length):
+    """
+    Chromosomes of positions and the positions (slice or index array) on
+    each of them, for an array of chromosome names or a single name.
+    """
+    if isinstance(chroms, str):
+        return [(chroms, slice(None))]
+    chroms = numpy.asarray(chroms)
+    if length == 0:
+        return []
+    bounds = numpy.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+    if len(bounds) <= length // 64 + 16:
+        # Runs of positions on the same chromosome, as in VCF files
+        bounds = numpy.concatenate([[0], bounds, [length]])
+        return [(chroms[first], slice(first, last))
+                for first, last in zip(bounds[:-1], bounds[1:])]
+    names, inverse = numpy.unique(chroms, return_inverse=True)
+    order = numpy.argsort(inverse, kind='mergesort')
+    bounds = numpy.searchsorted(inverse[order], numpy.arange(len(names) + 1))
+    return [(name, order[bounds[k]:bounds[k + 1]])
+            for k, name in enumerate(names)]
+
 def bootstrap(data_dict, pop_ids, projections, mask_corners=True,
-              polarized=True, bed_filename=None, num_boots=100, save_dir=None):
+              polarized=True, bed_filename=None, num_boots=100, save_dir=None,
+              binary=False, processes=1):
     """
     Use a non-parametric bootstrap on SNP information contained in a dictionary
     to generate new data sets. The new data is created by sampling with
@@ -582,7 +1288,7 @@ def bootstrap(data_dict, pop_ids, projections, mask_corners=True,
     them to disk in a specified directory.
 
     data_dict : Dictionary containing properly formatted SNP information (i.e.
-                created using one of the make_data_dict methods). 
+                created using one of the make_data_dict methods), or SNPData.
 
     pop_ids, projections, 
     mask_corners, polarized : Arguments to be passed to Spectrum.from_data_dict
@@ -609,121 +1315,204 @@ def bootstrap(data_dict, pop_ids, projections, mask_corners=True,
     save_dir : If None, the SFS are returned as a list. Otherwise this should be
                a string specifying the name of a new directory under which all
                of the new SFS should be saved.
+
+    binary : If True, the SFS saved in save_dir are written in the binary
+             format, which Spectrum.from_directory memory-maps.
+
+    processes : Number of processes computing the spectra of the units.
+
+    The spectrum of each unit is computed once, and each new SFS is the sum
+    of the spectra of the units weighted by the number of times they are
+    drawn, so that all the SFS are computed by a single matrix product.
     """
-    # Read in information from BED file if present and store by chromosome
-    if bed_filename is not None:
-        bed_file = open(bed_filename)
-        bed_info_dict = {}
-        for linenum, line in enumerate(bed_file):
-            fields = line.split()
-            # Read in mandatory fields
-            chrom, start, end = fields[:3]
-            start = int(start)
-            end = int(end)
-            # Read label info if present, else assign unique label by line number
-            label = linenum
-            if len(fields)>=4: 
-                label = fields[3]
-            # Add information to the appropriate chromosome
-            if chrom not in bed_info_dict:
-                bed_info_dict[chrom] = []
-            bed_info_dict[chrom].append((start, end, label))
-        bed_file.close()
-        
-        # Sort entries by start position, for easier location of proper region
-        start_dict = {}
-        for chrom, bed_info in bed_info_dict.items():
-            bed_info.sort(key = lambda k: k[0])
-            start_dict[chrom] = [region[0] for region in bed_info]
-        # Dictionary will map region labels to the SNPs contained in that region
-        region_dict = {}
-        # Iterate through data_dict and add SNPs to proper region
-        for snp_id in data_dict:
-            chrom, pos = snp_id.split("_")
-            pos = int(pos)
-            # Quickly locate proper region in sorted list
-            loc = bisect.bisect_right(start_dict[chrom], pos) - 1
-            if loc >= 0 and bed_info_dict[chrom][loc][1] >= pos:
-                label = bed_info_dict[chrom][loc][2]
-                if label not in region_dict:
-                    region_dict[label] = []
-                region_dict[label].append(snp_id)
-    # Separate by chromosome if no BED file provided
-    else:
-        region_dict = {}
-        for snp_id in data_dict:
-            chrom, pos = snp_id.split("_")
-            if chrom not in region_dict:
-                region_dict[chrom] = []
-            region_dict[chrom].append(snp_id)
-
-    # Each entry of list represents single region, with a tuple 
-    # containing the IDs of all SNPs in the region.
-    sample_regions = [tuple(val) for key, val in region_dict.items()]
-    num_regions = len(sample_regions)
+    unit_spectra = _resampling_unit_spectra(data_dict, pop_ids, projections,
+                                            polarized, bed_filename, processes)
+    num_units = len(unit_spectra)
+
     if save_dir is None:
         new_sfs_list = []
     elif not os.path.exists(save_dir):
         os.makedirs(save_dir)
-    # Repeatedly resample regions to create new data sets
-    for bootnum in range(num_boots):
-        # Set up new SFS
-        npops = len(pop_ids)
-        new_sfs = numpy.zeros(numpy.asarray(projections) + 1)
-        # Make random selection of regions (with replacement)
-        choices = numpy.random.randint(0, num_regions, num_regions)
-        # For each selected region, add its SNP info to SFS
-        for choice in choices:
-            for snp_id in sample_regions[choice]:
-                snp_info = data_dict[snp_id]
-                # Skip SNPs that aren't biallelic.
-                if len(snp_info['segregating']) != 2:
-                    continue
-
-                allele1, allele2 = snp_info['segregating']
-                if not polarized:
-                    # If not polarizing, derived allele is arbitrary
-                    outgroup_allele = allele1
-                elif 'outgroup_allele' in snp_info\
-                     and snp_info['outgroup_allele'] != '-'\
-                     and snp_info['outgroup_allele'] in snp_info['segregating']:
-                    # Otherwise check that it is a useful outgroup
-                    outgroup_allele = snp_info['outgroup_allele']
-                else: 
-                    # If polarized and without good outgroup, skip SNP
-                    continue
-                
-                # Extract allele calls for each population.
-                allele1_calls = [snp_info['calls'][pop][0] for pop in pop_ids]
-                allele2_calls = [snp_info['calls'][pop][1] for pop in pop_ids]
-                successful_calls = [a1 + a2 for (a1, a2) in 
-                                    zip(allele1_calls, allele2_calls)]
-                derived_calls = allele2_calls if allele1 == outgroup_allele\
-                                              else allele1_calls
-                
-                # Slicing allows handling of arbitray population numbers
-                slices = [[numpy.newaxis] * npops for i in range(npops)]
-                for i in range(npops):
-                    slices[i][i] = slice(None, None, None)
-                
-                # Do projections for this SNP
-                pop_contribs = []
-                call_iter = zip(projections, successful_calls, derived_calls)
-                for pop_index, (p_to, p_from, hits) in enumerate(call_iter):
-                    contrib = Numerics._cached_projection(
-                                      p_to, p_from, hits)[slices[pop_index]]
-                    pop_contribs.append(contrib)
-                new_sfs += functools.reduce(operator.mul, pop_contribs)
-            
-        new_sfs = Spectrum_mod.Spectrum(new_sfs,
-                                                mask_corners=mask_corners,
-                                                pop_ids=pop_ids)
+    # Make random selection of units (with replacement). The number of
+    # times each unit is drawn is multinomial.
+    weights = numpy.array([numpy.bincount(
+                               numpy.random.randint(0, num_units, num_units),
+                               minlength=num_units)
+                           for bootnum in range(num_boots)], float)
+    all_sfs = weights.dot(unit_spectra).reshape([num_boots]
+                                                + [n + 1 for n in projections])
+    for bootnum, data in enumerate(all_sfs):
+        new_sfs = Spectrum_mod.Spectrum(data, mask_corners=mask_corners,
+                                        pop_ids=pop_ids)
         if not polarized:
-            new_sfs.fold()
+            new_sfs = new_sfs.fold()
         if save_dir is None:
             new_sfs_list.append(new_sfs)
         else:
             filename = "{}/SFS_{}".format(save_dir, bootnum)
-            new_sfs.to_file(filename)
+            new_sfs.to_file(filename, binary=binary)
     
     return new_sfs_list if save_dir is None else None
+
+def jackknife(data_dict, pop_ids, projections, mask_corners=True,
+              polarized=True, bed_filename=None, save_dir=None, binary=False,
+              processes=1, lazy=False):
+    """
+    Use a delete-one-block jackknife on SNP information contained in a
+    dictionary to generate new data sets. Each new data set contains all the
+    data but one of the independent units (chromosomes or regions of a BED
+    file) used by bootstrap, so there are as many new data sets as units.
+
+    This function either returns all the newly created SFS, or writes them to
+    disk in a specified directory. They can be used in place of bootstrap SFS
+    by the functions of the Godambe module, with jackknife=True.
+
+    data_dict, pop_ids, projections, mask_corners, polarized, bed_filename,
+    save_dir, binary, processes : See bootstrap.
+
+    lazy : If True (and save_dir is None), returns a generator of the SFS
+           instead of a list.
+
+    The spectrum of each unit is computed once, and each new SFS is the
+    spectrum of all the data minus the spectrum of one unit.
+    """
+    unit_spectra = _resampling_unit_spectra(data_dict, pop_ids, projections,
+                                            polarized, bed_filename, processes)
+    total = unit_spectra.sum(axis=0)
+    shape = [n + 1 for n in projections]
+
+    def new_sfs_iter():
+        for unit_fs in unit_spectra:
+            # Remove rounding errors in the entries of a single unit
+            data = numpy.maximum(total - unit_fs, 0).reshape(shape)
+            new_sfs = Spectrum_mod.Spectrum(data, mask_corners=mask_corners,
+                                            pop_ids=pop_ids)
+            if not polarized:
+                new_sfs = new_sfs.fold()
+            yield new_sfs
+
+    if save_dir is None:
+        return new_sfs_iter() if lazy else list(new_sfs_iter())
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    for unitnum, new_sfs in enumerate(new_sfs_iter()):
+        filename = "{}/SFS_{}".format(save_dir, unitnum)
+        new_sfs.to_file(filename, binary=binary)
+
+def _resampling_unit_spectra(data_dict, pop_ids, projections, polarized,
+                             bed_filename, processes):
+    """
+    Array (units x flattened spectrum) of the spectra of the resampling units
+    of bootstrap and jackknife.
+    """
+    # Chromosome and position of all the SNPs, and the biallelic ones
+    if isinstance(data_dict, SNPData):
+        snps = data_dict
+        chroms, positions = snps.chrom, snps.pos
+        biallelic = numpy.ones(len(snps), bool)
+    else:
+        chroms, positions = [], []
+        for snp_id in data_dict:
+            chrom, pos = snp_id.split("_")
+            chroms.append(chrom)
+            positions.append(int(pos))
+        biallelic = numpy.array([len(snp_info['segregating']) == 2
+                                 for snp_info in data_dict.values()], bool)
+        snps = SNPData.from_data_dict(data_dict, pop_ids)
+
+    # Unit of each SNP (-1 if it is in none), numbered in order of first
+    # appearance in the data.
+    units, num_units = _bootstrap_units(chroms, positions, bed_filename)
+    units = units[biallelic]
+
+    called, derived, snp_polarized = snps.configurations(pop_ids)
+    if polarized:
+        keep = snp_polarized
+    else:
+        # If not polarizing, derived allele is arbitrary
+        keep = numpy.ones(len(snps), bool)
+        derived = numpy.asarray(snps.calls)[:, snps._pop_indices(pop_ids), 1]
+    keep &= units >= 0
+    unit_spectra = _unit_spectra(units[keep], num_units, called[keep],
+                                 derived[keep], projections, processes)
+    return unit_spectra.reshape(num_units, -1)
+
+def _bootstrap_units(chroms, positions, bed_filename):
+    """
+    Resampling unit of each SNP for bootstrap: its chromosome or its group
+    of regions in the BED file (or -1 if it is not in any region).
+
+    Returns the array of units, numbered in order of first appearance, and
+    the number of units.
+    """
+    if bed_filename is not None:
+        index = IntervalIndex.from_bed(bed_filename)
+        # SNP positions are compared to the BED coordinates with both ends
+        # included
+        intervals = index.find(chroms, positions, closed=True)
+        labels = -numpy.ones(len(intervals), int)
+        labels[intervals >= 0] = index.groups[intervals[intervals >= 0]]
+    # Separate by chromosome if no BED file provided
+    else:
+        labels = numpy.unique(chroms, return_inverse=True)[1]
+    return _first_appearance(labels)
+
+def _first_appearance(labels):
+    """
+    Renumbers non-negative labels in order of first appearance (negative
+    labels become -1). Returns the new labels and their number.
+    """
+    labels = numpy.asarray(labels, dtype=int)
+    valid = labels >= 0
+    values, firsts = numpy.unique(labels[valid], return_index=True)
+    ranks = numpy.empty(len(values), int)
+    ranks[numpy.argsort(firsts)] = numpy.arange(len(values))
+    result = -numpy.ones(len(labels), int)
+    result[valid] = ranks[numpy.searchsorted(values, labels[valid])]
+    return result, len(values)
+
+def _unit_spectra(units, num_units, called, derived, projections, processes):
+    """
+    Array (units x spectrum) of the spectra of the SNPs of each unit.
+    """
+    npops = called.shape[1]
+    # Configurations of each unit, sorted by unit
+    keys, counts = _unique_rows(numpy.hstack([units[:, numpy.newaxis],
+                                              called, derived]))
+    tasks = [(keys[:, 1:npops + 1], keys[:, npops + 1:], counts,
+              projections, keys[:, 0], num_units)]
+    if processes == 1 or len(keys) == 0:
+        return _project_units(tasks[0])
+
+    # Split the configurations into groups of about the same size, made of
+    # whole units, so that each task computes the spectra of a range of
+    # units.
+    splits = numpy.linspace(0, len(keys), 4 * processes + 1)[1:-1].astype(int)
+    splits = numpy.unique(numpy.searchsorted(keys[:, 0], keys[splits, 0]))
+    tasks, firsts = [], []
+    for chunk in numpy.split(numpy.arange(len(keys)), splits):
+        if len(chunk) == 0:
+            continue
+        first = keys[chunk[0], 0]
+        firsts.append(first)
+        tasks.append((keys[chunk, 1:npops + 1], keys[chunk, npops + 1:],
+                      counts[chunk], projections, keys[chunk, 0] - first,
+                      keys[chunk[-1], 0] - first + 1))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_project_units, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    spectra = numpy.zeros([num_units] + [n + 1 for n in projections])
+    for first, result in zip(firsts, results):
+        spectra[first:first + len(result)] = result
+    return spectra
+
+def _project_units(args):
+    """
+    Spectra of units, for _unit_spectra (module level to be picklable).
+    """
+    called, derived, counts, projections, units, num_units = args
+    return Numerics._project_counts(called, derived, counts, projections,
+                                    units=units, num_units=num_units)
@@ -89,7 +89,6 @@ def trapz(yy, xx=None, dx=None, axis=-1):
 
     return numpy.sum(dx[sliceX] * (yy[slice1]+yy[slice2]) / 2.0, axis=axis)
 
-_projection_cache = {}
 def _lncomb(N, k):
     """
     Log of N choose k.
@@ -105,31 +104,122 @@ def _cached_projection(proj_to, proj_from, hits):
     proj_from: Numper of samples to project from.
     hits: Number of derived alleles projecting from.
     """
-    key = (proj_to, proj_from, hits)
+    return _cached_projection_matrix(proj_to, proj_from)[:, hits]
+
+_projection_matrix_cache = {}
+def _cached_projection_matrix(proj_to, proj_from):
+    """
+    Matrix of the projection from a different fs size: entry (i, hits) is
+    the probability of i derived alleles among proj_to samples drawn from
+    proj_from samples with hits derived alleles (hypergeometric).
+
+    proj_to: Numper of samples to project down to.
+    proj_from: Numper of samples to project from.
+    """
+    key = (proj_to, proj_from)
     try:
-        return _projection_cache[key]
+        return _projection_matrix_cache[key]
     except KeyError:
         pass
 
-    if numpy.isscalar(proj_to) and numpy.isscalar(proj_from)\
-       and proj_from < proj_to:
-        # Short-circuit calculation.
-        contrib = numpy.zeros(proj_to + 1)
-    else:
-        # We set numpy's error reporting so that it will ignore underflows, 
-        # because those just imply that contrib is 0.
-        previous_err_state = numpy.seterr(under='ignore', divide='raise',
-                                          over='raise', invalid='raise')
-        proj_hits = numpy.arange(proj_to + 1)
+    P = numpy.zeros((proj_to + 1, proj_from + 1))
+    if proj_from >= proj_to:
+        proj_hits = numpy.arange(proj_to + 1)[:, numpy.newaxis]
+        hits = numpy.arange(proj_from + 1)[numpy.newaxis, :]
+        # the nonzero entries: proj_hits <= hits <= proj_hits + proj_from - proj_to
+        band = (hits >= proj_hits) & (hits - proj_hits <= proj_from - proj_to)
+        proj_hits, hits = numpy.broadcast_arrays(proj_hits, hits)
+        proj_hits, hits = proj_hits[band], hits[band]
         # For large sample sizes, we need to do the calculation in logs, and it
         # is accurate enough for small sizes as well.
         lncontrib = _lncomb(proj_to, proj_hits)
         lncontrib += _lncomb(proj_from - proj_to, hits - proj_hits)
         lncontrib -= _lncomb(proj_from, hits)
-        contrib = numpy.exp(lncontrib)
-        numpy.seterr(**previous_err_state)
-    _projection_cache[key] = contrib
-    return contrib
+        # underflows just imply that contrib is 0
+        with numpy.errstate(under='ignore'):
+            P[band] = numpy.exp(lncontrib)
+    # the matrices are shared
+    P.flags.writeable = False
+    _projection_matrix_cache[key] = P
+    return P
+
+def _project_counts(calls, derived, counts, projections, chunk_size=2**22,
+                    units=None, num_units=None):
+    """
+    Sum of the projections of many SNP configurations.
+
+    calls: Array (configurations x pops) of the numbers of successful calls.
+    derived: Array (configurations x pops) of the numbers of derived calls.
+    counts: Number of SNPs of each configuration.
+    projections: Sample sizes to project down to for each population.
+    chunk_size: Maximal number of entries of the intermediate arrays.
+    units: Optional unit of each configuration (sorted integers lower than
+           num_units), to sum the projections of each unit separately.
+
+    Returns the array of the projected frequency spectrum, or the array
+    (num_units x spectrum shape) of the spectra of the units.
+    """
+    calls = numpy.asarray(calls, dtype=int).reshape(len(counts), -1)
+    derived = numpy.asarray(derived, dtype=int).reshape(len(counts), -1)
+    counts = numpy.asarray(counts, dtype=float)
+    projections = [int(p) for p in projections]
+    shape = [p + 1 for p in projections]
+    if units is not None:
+        return _project_counts_units(calls, derived, counts, projections,
+                                     chunk_size, numpy.asarray(units),
+                                     num_units)
+    fs = numpy.zeros(int(numpy.prod(shape[:-1])) * shape[-1])
+    fs = fs.reshape(-1, shape[-1])
+    # The spectrum is sum_c counts[c] * V_1[c] x ... x V_p[c], where V_k[c]
+    # is the projection vector of configuration c in pop k. We accumulate
+    # the outer products of the first p-1 pops for a chunk of configurations
+    # and contract it with V_p by a matrix product.
+    step = max(1, chunk_size // max(1, fs.shape[0]))
+    for start in range(0, len(counts), step):
+        sl = slice(start, start + step)
+        W = counts[sl, numpy.newaxis]
+        for k in range(len(projections) - 1):
+            V = _projection_vectors(projections[k], calls[sl, k], derived[sl, k])
+            W = (W[:, :, numpy.newaxis] * V[:, numpy.newaxis, :]).reshape(len(V), -1)
+        V = _projection_vectors(projections[-1], calls[sl, -1], derived[sl, -1])
+        fs += W.T.dot(V)
+    return fs.reshape(shape)
+
+def _project_counts_units(calls, derived, counts, projections, chunk_size,
+                          units, num_units):
+    """
+    Projections of SNP configurations summed by unit (see _project_counts).
+    """
+    shape = [p + 1 for p in projections]
+    fs = numpy.zeros((num_units, int(numpy.prod(shape))))
+    # Here the outer products are computed for all the pops, and the rows
+    # of each unit (contiguous, since units are sorted) are added up.
+    step = max(1, chunk_size // fs.shape[1])
+    for start in range(0, len(counts), step):
+        sl = slice(start, start + step)
+        W = counts[sl, numpy.newaxis]
+        for k in range(len(projections)):
+            V = _projection_vectors(projections[k], calls[sl, k],
+                                    derived[sl, k])
+            W = W[:, :, numpy.newaxis] * V[:, numpy.newaxis, :]
+            W = W.reshape(len(V), -1)
+        chunk_units = units[sl]
+        firsts = numpy.flatnonzero(numpy.diff(chunk_units)) + 1
+        firsts = numpy.concatenate([[0], firsts])
+        fs[chunk_units[firsts]] += numpy.add.reduceat(W, firsts, axis=0)
+    return fs.reshape([num_units] + shape)
+
+def _projection_vectors(proj_to, calls, derived):
+    """
+    Projection coefficients (one row per SNP) of SNPs with calls successful
+    calls and derived derived calls, projected down to proj_to samples.
+    """
+    res = numpy.zeros((len(calls), proj_to + 1))
+    for proj_from in numpy.unique(calls):
+        idx = numpy.nonzero(calls == proj_from)[0]
+        P = _cached_projection_matrix(proj_to, int(proj_from))
+        res[idx] = P[:, derived[idx]].T
+    return res
 
 def array_from_file(fid, return_comments=False):
     """
@@ -0,0 +1,170 @@
+"""
+Registry of the jackknife extrapolation matrices and of the base operators
+(drift, selection, migration) used by the integrators.
+
+These matrices only depend on the sample sizes, so they are computed once
+per process and kept in memory. Optionally, they are also stored on disk
+(one npz file per matrix), so that a fresh process, e.g. a worker of a
+parallel optimization, loads them instead of recomputing them:
+
+    moments.Operators.set_store('/path/to/operators')
+
+The matrices returned are shared between calls and must not be modified.
+The registry keeps the max_entries most recently used matrices; in a long
+running process going through many sample sizes, Operators.clear() releases
+all of them at once.
+
+The stored files carry the version of the builders (_version). Files
+written by another version are ignored, and rebuilt.
+"""
+import collections
+import os
+import numpy as np
+import scipy.sparse
+
+import Jackknife as jk
+import LinearSystem_1D as ls1
+import LinearSystem_2D as ls2
+
+# in memory registry: (name, dims...) -> matrix, least recently used first
+_registry = collections.OrderedDict()
+# maximal number of matrices kept in memory
+max_entries = 512
+# version of the builders, stored in the npz files: increase it whenever a
+# builder (or the jackknife, or LinearSystem_1D/2D) changes its results
+_version = 1
+# directory of the on-disk store (None if disabled)
+_store = None
+
+
+def calcJK13(n):
+    """
+    Order 3 jackknife coefficients for 1 jump (Phi_n -> Phi_(n+1)), as a
+    sparse (CSR) matrix.
+    """
+    return get('JK13', n)
+
+
+def calcJK23(n):
+    """
+    Order 3 jackknife coefficients for 2 jumps (Phi_n -> Phi_(n+2)), as a
+    sparse (CSR) matrix.
+    """
+    return get('JK23', n)
+
+
+# How to build each matrix from the dimensions (n+1) of its populations.
+# The 2D operators use the jackknife of the population they extrapolate.
+_builders = {
+    'JK13': lambda n: jk.calcJK13_sparse(n),
+    'JK23': lambda n: jk.calcJK23_sparse(n),
+    # 1 population
+    'D': lambda d: ls1.calcD(d),
+    'S': lambda d: ls1.calcS(d, calcJK13(d - 1)),
+    'S2': lambda d: ls1.calcS2(d, calcJK23(d - 1)),
+    # 2 populations
+    'D1': lambda d1, d2: ls2.calcD1(np.array([d1, d2])),
+    'D2': lambda d1, d2: ls2.calcD2(np.array([d1, d2])),
+    'S_1': lambda d1, d2: ls2.calcS_1(np.array([d1, d2]), calcJK13(d1 - 1)),
+    'S_2': lambda d1, d2: ls2.calcS_2(np.array([d1, d2]), calcJK13(d2 - 1)),
+    'S2_1': lambda d1, d2: ls2.calcS2_1(np.array([d1, d2]), calcJK23(d1 - 1)),
+    'S2_2': lambda d1, d2: ls2.calcS2_2(np.array([d1, d2]), calcJK23(d2 - 1)),
+    'M_1': lambda d1, d2: ls2.calcM_1(np.array([d1, d2]), calcJK13(d2 - 1)),
+    'M_2': lambda d1, d2: ls2.calcM_2(np.array([d1, d2]), calcJK13(d1 - 1)),
+}
+
+
+def get(name, *dims):
+    """
+    Returns the matrix name for the given dimensions, from the registry,
+    the on-disk store or computed (and then registered).
+
+    name: 'JK13' or 'JK23' (dims = n), 'D', 'S' or 'S2' (dims = n+1 for
+          one population), 'D1', 'D2', 'S_1', 'S_2', 'S2_1', 'S2_2', 'M_1'
+          or 'M_2' (dims = n1+1, n2+1 for two populations), named after the
+          functions of LinearSystem_1D and LinearSystem_2D.
+    """
+    if name not in _builders:
+        raise ValueError('Unknown operator: %s' % name)
+    key = (name,) + tuple(int(d) for d in dims)
+    try:
+        # reinsert to mark the matrix as the most recently used
+        value = _registry.pop(key)
+        _registry[key] = value
+        return value
+    except KeyError:
+        pass
+    value = None
+    if _store is not None:
+        value = _load(key)
+    if value is None:
+        value = _builders[name](*key[1:])
+        if _store is not None:
+            _save(key, value)
+    _registry[key] = value
+    while len(_registry) > max_entries:
+        _registry.popitem(last=False)
+    return value
+
+
+def set_store(path):
+    """
+    Sets the directory of the on-disk store (created if needed), or
+    disables it if path is None.
+    """
+    global _store
+    if path is not None and not os.path.isdir(path):
+        os.makedirs(path)
+    _store = path
+
+
+def clear():
+    """
+    Empties the in memory registry, releasing the memory of the matrices
+    (the on-disk store is kept).
+    """
+    _registry.clear()
+
+
+def _filename(key):
+    return os.path.join(_store, '_'.join(str(k) for k in key) + '.npz')
+
+
+def _load(key):
+    """
+    Stored matrix, or None if it is missing or was written by another
+    version of the builders.
+    """
+    fname = _filename(key)
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname) as data:
+        if 'version' not in data.files or int(data['version']) != _version:
+            return None
+        if 'dense' in data.files:
+            return data['dense']
+    return scipy.sparse.load_npz(fname)
+
+
+def _save(key, value):
+    fname = _filename(key)
+    # we write to a temporary file first so that processes sharing the
+    # store never read an incomplete file
+    tmp = '%s.%d.tmp.npz' % (fname[:-4], os.getpid())
+    if scipy.sparse.issparse(value):
+        # layout of scipy.sparse.save_npz (CSR and CSC), with the version
+        np.savez(tmp, version=_version, format=value.format.encode('ascii'),
+                 shape=value.shape, data=value.data, indices=value.indices,
+                 indptr=value.indptr)
+    else:
+        np.savez(tmp, version=_version, dense=value)
+    try:
+        os.rename(tmp, fname)
+    except OSError:
+        # the file exists (on Windows): either another process stored it
+        # first, or it was written by another version and is replaced
+        if _load(key) is None:
+            os.remove(fname)
+            os.rename(tmp, fname)
+        else:
+            os.remove(tmp)
@@ -5,8 +5,10 @@ import logging
 logging.basicConfig()
 logger = logging.getLogger('Spectrum_mod')
 import functools
+import json
 import operator
 import os
+import re
 import sys
 import numpy
 from numpy import newaxis as nuax
@@ -31,6 +33,18 @@ try:
 except ImportError: #if matplotlib is not present, do not import, and do not run plotting 
                     # functions
     plotting = False
+# Binary file format (see Spectrum.to_file)
+_BINARY_MAGIC = b'\x93MOMENTSFS'
+_BINARY_ALIGNMENT = 64
+
+def _binary_align(offset):
+    return -(-offset // _BINARY_ALIGNMENT) * _BINARY_ALIGNMENT
+
+_digits = re.compile(r'(\d+)')
+
+# Number of SNPs tallied at once when reading ms output
+_ms_chunk_size = 2**20
+
 class Spectrum(numpy.ma.masked_array):
     """
     Represents a frequency spectrum.
@@ -199,7 +213,8 @@ class Spectrum(numpy.ma.masked_array):
 
     # Make from_file a static method, so we can use it without an instance.
     @staticmethod
-    def from_file(fid, mask_corners=True, return_comments=False):
+    def from_file(fid, mask_corners=True, return_comments=False,
+                  mmap_mode='c'):
         """
         Read frequency spectrum from file.
 
@@ -209,15 +224,29 @@ class Spectrum(numpy.ma.masked_array):
         return_comments: If true, the return value is (fs, comments), where
                          comments is a list of strings containing the comments
                          from the file (without #'s).
-
-        See to_file method for details on the file format.
+        mmap_mode: For binary files, mode used to memory-map the data and the
+                   mask (see numpy.memmap). The default 'c' (copy-on-write)
+                   does not read the file until the entries are used, and
+                   changes to the spectrum are not written back to the file.
+                   If None, the data are read into memory.
+
+        See to_file method for details on the file formats. The format of the
+        file (text or binary) is detected automatically.
         """
         newfile = False
         # Try to read from fid. If we can't, assume it's something that we can
         # use to open a file.
         if not hasattr(fid, 'read'):
+            with open(fid, 'rb') as f:
+                binary = (f.read(len(_BINARY_MAGIC)) == _BINARY_MAGIC)
+            if binary:
+                return Spectrum._from_binary_file(fid, mask_corners,
+                                                  return_comments, mmap_mode)
             newfile = True
             fid = open(fid, 'r')
+        elif isinstance(fid.read(0), bytes):
+            return Spectrum._from_binary_file(fid, mask_corners,
+                                              return_comments, mmap_mode)
 
         line = fid.readline()
         # Strip out the comments
@@ -275,8 +304,132 @@ class Spectrum(numpy.ma.masked_array):
 
     fromfile = from_file
 
+    @staticmethod
+    def _from_binary_file(fid, mask_corners, return_comments, mmap_mode):
+        """
+        Read frequency spectrum from a binary file (see to_file).
+        """
+        newfile = False
+        if not hasattr(fid, 'read'):
+            newfile = True
+            fid = open(fid, 'rb')
+        try:
+            fid.fileno()
+            start = fid.tell()
+        except (AttributeError, IOError, OSError):
+            # In-memory files, pipes and sockets cannot be memory-mapped
+            start = None
+        try:
+            prefix = fid.read(len(_BINARY_MAGIC) + 4)
+            if prefix[:len(_BINARY_MAGIC)] != _BINARY_MAGIC:
+                raise ValueError('Not a binary frequency spectrum file.')
+            header_len = int(numpy.frombuffer(prefix[len(_BINARY_MAGIC):],
+                                              dtype='<u4')[0])
+            header = json.loads(fid.read(header_len).decode('utf-8'))
+            shape = tuple(header['shape'])
+            size = int(numpy.prod(shape))
+            mask_offset = len(prefix) + header_len
+            data_offset = _binary_align(mask_offset + size)
+            dtype = numpy.dtype(header['dtype'])
+            if mmap_mode is not None and start is not None:
+                mask = numpy.memmap(fid, dtype=numpy.bool_, mode=mmap_mode,
+                                    offset=start + mask_offset, shape=shape)
+                data = numpy.memmap(fid, dtype=dtype, mode=mmap_mode,
+                                    offset=start + data_offset, shape=shape)
+            else:
+                buf = fid.read(data_offset - mask_offset)
+                mask = numpy.frombuffer(buf, dtype=numpy.bool_, count=size)
+                buf = fid.read(size * dtype.itemsize)
+                data = numpy.frombuffer(buf, dtype=dtype, count=size)
+                mask = mask.reshape(shape).copy()
+                data = data.reshape(shape).copy()
+        finally:
+            if newfile:
+                fid.close()
+
+        if mask_corners and not mask.flags.writeable:
+            # Read-only map: the corners can only be masked in a copy
+            if mask.flat[0] and mask.flat[-1]:
+                mask_corners = False
+            else:
+                mask = numpy.array(mask)
+        pop_ids = header['pop_ids']
+        fs = Spectrum(data, mask, mask_corners, data_folded=header['folded'],
+                      pop_ids=pop_ids, dtype=dtype, copy=False)
+
+        if not return_comments:
+            return fs
+        else:
+            return fs, header['comments']
+
+    def _to_binary_file(self, fid, comment_lines):
+        """
+        Write frequency spectrum to a binary file (see to_file).
+        """
+        data = numpy.ascontiguousarray(self.data)
+        if data.dtype.byteorder == '>':
+            data = data.astype(data.dtype.newbyteorder('<'))
+        mask = numpy.ascontiguousarray(numpy.ma.getmaskarray(self))
+        pop_ids = None if self.pop_ids is None else list(self.pop_ids)
+        header = json.dumps({'shape': list(data.shape),
+                             'dtype': data.dtype.str,
+                             'folded': bool(self.folded),
+                             'pop_ids': pop_ids,
+                             'comments': [line.strip()
+                                          for line in comment_lines]})
+        header = header.encode('utf-8')
+        # Pad the header with spaces so that the mask starts on an aligned
+        # offset, then pad the mask so that the data does too.
+        prefix_len = len(_BINARY_MAGIC) + 4
+        header_len = _binary_align(prefix_len + len(header)) - prefix_len
+        header += b' ' * (header_len - len(header))
+        mask_offset = prefix_len + header_len
+        padding = _binary_align(mask_offset + mask.size) \
+                - (mask_offset + mask.size)
+
+        newfile = False
+        if not hasattr(fid, 'write'):
+            newfile = True
+            fid = open(fid, 'wb')
+        try:
+            fid.write(_BINARY_MAGIC)
+            fid.write(numpy.array(header_len, dtype='<u4').tobytes())
+            fid.write(header)
+            fid.write(mask.tobytes())
+            fid.write(b'\0' * padding)
+            fid.write(data.tobytes())
+        finally:
+            if newfile:
+                fid.close()
+
+    @staticmethod
+    def from_directory(dirname, prefix='', mask_corners=True, mmap_mode='c'):
+        """
+        Read all the frequency spectra of a directory.
+
+        dirname: Name of the directory.
+        prefix: Only the files whose name starts with prefix are read.
+        mask_corners, mmap_mode: See from_file.
+
+        The spectra are returned in a list, sorted by file name (with numbers
+        in the names compared as numbers, so SFS_2 comes before SFS_10).
+        Binary files are memory-mapped, so reading a directory of (e.g.
+        bootstrap) spectra does not copy their data.
+        """
+        def key(name):
+            return [(0, int(c), '') if c.isdigit() else (1, 0, c)
+                    for c in _digits.split(name)]
+        names = sorted([name for name in os.listdir(dirname)
+                        if name.startswith(prefix)
+                        and os.path.isfile(os.path.join(dirname, name))],
+                       key=key)
+        return [Spectrum.from_file(os.path.join(dirname, name),
+                                   mask_corners=mask_corners,
+                                   mmap_mode=mmap_mode)
+                for name in names]
+
     def to_file(self, fid, precision=16, comment_lines = [], 
-                foldmaskinfo=True):
+                foldmaskinfo=True, binary=False):
         """
         Write frequency spectrum to file.
     
@@ -287,6 +440,8 @@ class Spectrum(numpy.ma.masked_array):
                        of the output file.
         foldmaskinfo: If False, folding and mask and population label
                       information will not be saved. 
+        binary: If True, write the binary format described below (precision
+                and foldmaskinfo are then ignored).
 
         The file format is:
             # Any number of comment lines beginning with a '#'
@@ -301,7 +456,20 @@ class Spectrum(numpy.ma.masked_array):
               e.g.: fs[0,0,0] fs[0,0,1] fs[0,0,2] ... fs[0,1,0] fs[0,1,1] ...
             A single line giving the elements of the mask in the same order as
               the data line. '1' indicates masked, '0' indicates unmasked.
+
+        The binary format can be memory-mapped by from_file:
+            The magic string '\\x93MOMENTSFS'
+            The length of the header, as a little-endian 32 bits integer
+            The header, a JSON object with keys 'shape', 'dtype' (numpy type
+              string), 'folded', 'pop_ids' and 'comments', padded with spaces
+            The mask, one byte per entry (1 for masked), padded with zeros
+            The data, in the same order as in the text format
+          The mask and the data start at offsets multiple of 64 bytes.
         """
+        if binary:
+            self._to_binary_file(fid, comment_lines)
+            return
+
         # Open the file object.
         newfile = False
         if not hasattr(fid, 'write'):
@@ -389,42 +557,46 @@ class Spectrum(numpy.ma.masked_array):
         """
         Project along a single axis.
         """
-        # This gets a little tricky with fancy indexing to make it work
-        # for fs with arbitrary number of dimensions.
         if n > self.sample_sizes[axis]:
             raise ValueError('Cannot project to a sample size greater than '
                              'original. Called sizes were from %s to %s.' 
                              % (self.sample_sizes[axis], n))
 
-        newshape = list(self.shape)
-        newshape[axis] = n + 1
-        # Create a new empty fs that we'll fill in below.
-        pfs = Spectrum(numpy.zeros(newshape), mask_corners=False)
-
-        # Set up for our fancy indexes. These slices are currently like
-        # [:,:,...]
-        from_slice = [slice(None) for ii in range(self.Npop)]
-        to_slice = [slice(None) for ii in range(self.Npop)]
-        proj_slice = [nuax for ii in range(self.Npop)]
-
+        # The projection is a product by the (n+1) x (proj_from+1)
+        # hypergeometric matrix along the axis.
         proj_from = self.sample_sizes[axis]
-        # For each possible number of hits.
-        for hits in range(proj_from + 1):
-            # Adjust the slice in the array we're projecting from.
+        P = Numerics._cached_projection_matrix(n, proj_from)
+        # Non-finite values (in masked entries) only contribute to the
+        # entries they are projected to, so they are added separately below.
+        from_data = self.data
+        nonfinite = ~numpy.isfinite(from_data)
+        if nonfinite.any():
+            from_data = numpy.where(nonfinite, 0, from_data)
+        data = numpy.moveaxis(numpy.tensordot(P, from_data, axes=([1], [axis])),
+                              0, axis)
+
+        # An entry is masked if any of the entries it is projected from is.
+        # Usually only a few entries (the corners) are masked, so we only
+        # loop over the numbers of hits with masked or non-finite entries.
+        mask = numpy.zeros(data.shape, dtype=bool)
+        from_mask = numpy.ma.getmaskarray(self)
+        other_axes = tuple(ii for ii in range(self.ndim) if ii != axis)
+        from_slice = [slice(None)] * self.ndim
+        to_slice = [slice(None)] * self.ndim
+        proj_slice = [nuax] * self.ndim
+        for hits in numpy.nonzero((from_mask | nonfinite).any(axis=other_axes))[0]:
             from_slice[axis] = slice(hits, hits + 1)
             # These are the least and most possible hits we could have in the
             #  projected fs.
             least, most = max(n - (proj_from - hits), 0), min(hits, n)
             to_slice[axis] = slice(least, most + 1)
-            # The projection weights.
-            proj = Numerics._cached_projection(n, proj_from, hits)
             proj_slice[axis] = slice(least, most + 1)
-            # Do the multiplications
-            pfs.data[tuple(to_slice)] += self.data[tuple(from_slice)] * proj[tuple(proj_slice)]
-            pfs.mask[tuple(to_slice)] = numpy.logical_or(pfs.mask[tuple(to_slice)],
-                                                  self.mask[tuple(from_slice)])
-    
-        return pfs
+            mask[tuple(to_slice)] |= from_mask[tuple(from_slice)]
+            if nonfinite[tuple(from_slice)].any():
+                values = numpy.where(nonfinite[tuple(from_slice)],
+                                     self.data[tuple(from_slice)], 0)
+                data[tuple(to_slice)] += values * P[:, hits][tuple(proj_slice)]
+        return Spectrum(data, mask=mask, mask_corners=False)
 
     def marginalize(self, over, mask_corners=True):
         """
@@ -649,6 +821,79 @@ class Spectrum(numpy.ma.masked_array):
                         pop_ids = self.pop_ids)
         return samp
 
+    def sample_many(self, k, seed=None, nsamples=None, mask=None,
+                    only_nonmasked=False, lazy=False, chunk_size=100):
+        """
+        Generate k sampled fs from the current one, with vectorized draws.
+
+        k: Number of spectra to generate.
+        seed: Seed of the random draws (an integer or a numpy RandomState).
+              If None, numpy's global random state is used.
+        nsamples: If None, the spectra are Poisson-sampled, as by sample.
+                  Otherwise, each spectrum has nsamples SNPs drawn from a
+                  multinomial distribution, as by fixed_size_sample.
+        mask: Optional boolean array, of the shape of the fs. Its True
+              entries are not sampled: they are 0 and masked in the output.
+        only_nonmasked: For fixed-size samples, if True, only SNPs from
+                        non-masked entries will be resampled.
+        lazy: If False, return a masked array of shape (k,) + fs.shape, whose
+              mask is the same for all the spectra. If True, return a
+              generator of Spectrum objects.
+        chunk_size: With lazy=True, number of spectra drawn at once.
+
+        The spectra are the same with lazy=True and lazy=False for the same
+        seed, so the generator can be used when k spectra do not fit in
+        memory.
+        """
+        if seed is None:
+            rng = numpy.random
+        elif isinstance(seed, numpy.random.RandomState):
+            rng = seed
+        else:
+            rng = numpy.random.RandomState(seed)
+        if mask is None:
+            mask = numpy.zeros(self.shape, bool)
+        fs_mask = numpy.ma.getmaskarray(self)
+        data = self.data.ravel()
+
+        if nsamples is None:
+            # These are entries where the sampling has no meaning. Either the
+            # fs is 0 there or masked.
+            out_mask = numpy.logical_or(numpy.logical_or(self.data == 0, fs_mask),
+                                        mask)
+            bad_entries = out_mask.ravel()
+            means = data.copy()
+            means[bad_entries] = 1
+            def draw(n):
+                samp = rng.poisson(means, size=(n, len(means))).astype(float)
+                samp[:, bad_entries] = 0
+                return samp.reshape((n,) + self.shape)
+        else:
+            out_mask = numpy.logical_or(fs_mask, mask)
+            excluded = mask.ravel()
+            if only_nonmasked:
+                excluded = numpy.logical_or(excluded, fs_mask.ravel())
+            pvals = data.copy()
+            pvals[excluded] = 0
+            pvals /= pvals.sum()
+            def draw(n):
+                samp = rng.multinomial(int(nsamples), pvals, size=n)
+                return samp.astype(float).reshape((n,) + self.shape)
+
+        if not lazy:
+            return numpy.ma.masked_array(draw(k), mask=numpy.broadcast_to(
+                                    out_mask, (k,) + self.shape).copy())
+        return self._sample_generator(draw, k, chunk_size, out_mask)
+
+    def _sample_generator(self, draw, k, chunk_size, mask):
+        """
+        Generator of the spectra of sample_many, drawn in chunks.
+        """
+        for start in range(0, k, chunk_size):
+            for samp in draw(min(chunk_size, k - start)):
+                yield Spectrum(samp, mask=mask, mask_corners=False,
+                               data_folded=self.folded, pop_ids=self.pop_ids)
+
     @staticmethod
     def from_ms_file(fid, average=True, mask_corners=True, return_header=False,
                      pop_assignments=None, pop_ids=None, bootstrap_segments=1):
@@ -675,6 +920,11 @@ class Spectrum(numpy.ma.masked_array):
                             the data will be broken up into that many segments
                             based on SNP position. Instead of single FS, a list
                             of spectra will be returned, one for each segment.
+
+        The file is read one run at a time and the SNPs are tallied in chunks,
+        so memory does not grow with the number of runs, and fid can be a
+        pipe (e.g. the stdout of an ms subprocess, opened in text mode). To
+        get the spectra of the individual runs, see iter_ms_file.
         """
         newfile = False
         # Try to read from fid. If we can't, assume it's something that we can
@@ -683,12 +933,125 @@ class Spectrum(numpy.ma.masked_array):
             newfile = True
             fid = open(fid, 'r')
 
+        try:
+            command, seeds, pop_samples, total_samples \
+                    = Spectrum._ms_header(fid, pop_assignments)
+            fs_shape = numpy.asarray(pop_samples) + 1
+            size = int(numpy.prod(fs_shape))
+            # Where we should break our interval to create our bootstraps
+            breakpts = numpy.linspace(0, 1, bootstrap_segments+1)
+
+            # Flat indices (segment * size + entry) of the SNPs, tallied in
+            # chunks of _ms_chunk_size SNPs.
+            data = numpy.zeros(bootstrap_segments * size, numpy.int_)
+            chunk, chunk_len = [], 0
+            runs = 0
+            for positions, derived in Spectrum._ms_runs(fid, total_samples,
+                                                        pop_samples):
+                runs += 1
+                if derived.shape[1] == 0:
+                    continue
+                indices = numpy.ravel_multi_index(derived, fs_shape)
+                if bootstrap_segments > 1:
+                    # Read SNP positions for creating bootstrap segments
+                    positions = numpy.array(positions.split()[1:], float)
+                    # The indices that correspond to those breakpoints
+                    break_iis = numpy.searchsorted(positions, breakpts)
+                    # Correct for searchsorted behavior if last position is 1,
+                    # to ensure all SNPs are captured
+                    break_iis[-1] = len(positions)
+                    snps = numpy.arange(len(positions))
+                    segments = numpy.searchsorted(break_iis[1:], snps,
+                                                  side='right')
+                    keep = snps >= break_iis[0]
+                    indices = segments[keep] * size + indices[keep]
+                chunk.append(indices)
+                chunk_len += len(indices)
+                if chunk_len >= _ms_chunk_size:
+                    data += numpy.bincount(numpy.concatenate(chunk),
+                                           minlength=len(data))
+                    chunk, chunk_len = [], 0
+            if chunk:
+                data += numpy.bincount(numpy.concatenate(chunk),
+                                       minlength=len(data))
+        finally:
+            if newfile:
+                fid.close()
+
+        all_data = data.reshape((bootstrap_segments,) + tuple(fs_shape))
+        all_fs = [Spectrum(data, mask_corners=mask_corners, pop_ids=pop_ids)
+                  for data in all_data]
+        if average:
+            all_fs = [fs / runs for fs in all_fs]
+
+        # If we aren't setting up for bootstrapping, return fs, rather than a
+        # list of length 1. (This ensures backward compatibility.)
+        if bootstrap_segments == 1:
+            all_fs = all_fs[0]
+
+        if not return_header:
+            return all_fs
+        else:
+            return all_fs, (command,seeds)
+
+    @staticmethod
+    def iter_ms_file(fid, runs_per_fs=1, mask_corners=True,
+                     pop_assignments=None, pop_ids=None):
+        """
+        Iterate over the frequency spectra of the runs of a file of ms output.
+
+        fid: string with file name to read from or an open file object (or
+             pipe).
+        runs_per_fs: Number of consecutive runs summed in each of the yielded
+                     spectra (the last one sums the remaining runs).
+        mask_corners, pop_assignments, pop_ids: See from_ms_file.
+
+        The spectra are the counts of SNPs of the runs (not averaged). This
+        is a generator, reading the file as the spectra are requested, e.g.
+        for parametric bootstraps over a large number of simulations:
+
+            boots = [fs.fold() for fs in moments.Spectrum.iter_ms_file(ms_pipe)]
+        """
+        newfile = False
+        if not hasattr(fid, 'read'):
+            newfile = True
+            fid = open(fid, 'r')
+
+        try:
+            pop_samples, total_samples \
+                    = Spectrum._ms_header(fid, pop_assignments)[2:]
+            fs_shape = tuple(numpy.asarray(pop_samples) + 1)
+            chunk = []
+            for positions, derived in Spectrum._ms_runs(fid, total_samples,
+                                                        pop_samples):
+                chunk.append(numpy.ravel_multi_index(derived, fs_shape))
+                if len(chunk) == runs_per_fs:
+                    data = numpy.bincount(numpy.concatenate(chunk),
+                                          minlength=numpy.prod(fs_shape))
+                    yield Spectrum(data.reshape(fs_shape),
+                                   mask_corners=mask_corners, pop_ids=pop_ids)
+                    chunk = []
+            if chunk:
+                data = numpy.bincount(numpy.concatenate(chunk),
+                                      minlength=numpy.prod(fs_shape))
+                yield Spectrum(data.reshape(fs_shape),
+                               mask_corners=mask_corners, pop_ids=pop_ids)
+        finally:
+            if newfile:
+                fid.close()
+
+    @staticmethod
+    def _ms_header(fid, pop_assignments):
+        """
+        Read the commandline and seeds lines of ms output.
+
+        Returns (command, seeds, pop_samples, total_samples).
+        """
         # Parse the commandline
         command = line = fid.readline()
         command_terms = line.split()
         
         if command_terms[0].count('ms'):
-            runs = int(command_terms[2])
             try:
                 pop_flag = command_terms.index('-I')
                 num_pops = int(command_terms[pop_flag + 1])
@@ -702,134 +1065,54 @@ class Spectrum(numpy.ma.masked_array):
         
         total_samples = numpy.sum(pop_samples)
         if pop_assignments:
-            num_pops = len(pop_assignments)
-            pop_samples = pop_assignments
+            pop_samples = list(pop_assignments)
 
-        sample_indices = numpy.cumsum([0] + pop_samples)
-        bottom_l = sample_indices[:-1]
-        top_l = sample_indices[1:]
-        
-        seeds = line = fid.readline()
-        while not line.startswith('//'):
-            line = fid.readline()
-        
-        counts = numpy.zeros(len(pop_samples), numpy.int_)
-        fs_shape = numpy.asarray(pop_samples) + 1
-        dimension = len(counts)
-        
-        if dimension > 1:
-            bottom0 = bottom_l[0]
-            top0 = top_l[0]
-            bottom1 = bottom_l[1]
-            top1 = top_l[1]
-        if dimension > 2:
-            bottom2 = bottom_l[2]
-            top2 = top_l[2]
-        if dimension > 3:
-            bottom3 = bottom_l[3]
-            top3 = top_l[3]
-        if dimension > 4:
-            bottom4 = bottom_l[4]
-            top4 = top_l[4]
-        if dimension > 5:
-            bottom5 = bottom_l[5]
-            top5 = top_l[5]
-        
-        all_data = [numpy.zeros(fs_shape, numpy.int_)
-                    for boot_ii in range(bootstrap_segments)]
-        for run_ii in range(runs):
+        seeds = fid.readline()
+        return command, seeds, pop_samples, total_samples
+
+    @staticmethod
+    def _ms_runs(fid, total_samples, pop_samples):
+        """
+        Iterate over the runs of ms output (after the header).
+
+        Yields (positions, derived) for each run, where positions is the
+        'positions:' line and derived is an array with the number of derived
+        alleles of each SNP (columns) in each population (rows).
+        """
+        sample_indices = numpy.cumsum([0] + list(pop_samples))
+        line = fid.readline()
+        while line != '':
+            if not line.startswith('//'):
+                line = fid.readline()
+                continue
             line = fid.readline()
+            while line != '' and not line.startswith('segsites'):
+                line = fid.readline()
+            if line == '':
+                break
             segsites = int(line.split()[-1])
-            
             if segsites == 0:
-                # Special case, need to read 3 lines to stay synced.
-                for _ in range(3):
-                    line = fid.readline()
+                yield '', numpy.zeros((len(pop_samples), 0), numpy.int_)
+                line = fid.readline()
                 continue
             line = fid.readline()
-            while not line.startswith('positions'):
+            while line != '' and not line.startswith('positions'):
                 line = fid.readline()
+            if line == '':
+                break
+            positions = line
 
-            # Read SNP positions for creating bootstrap segments
-            positions = [float(_) for _ in line.split()[1:]]
-            # Where we should break our interval to create our bootstraps
-            breakpts = numpy.linspace(0, 1, bootstrap_segments+1)
-            # The indices that correspond to those breakpoints
-            break_iis = numpy.searchsorted(positions, breakpts)
-            # Correct for searchsorted behavior if last position is 1,
-            # to ensure all SNPs are captured
-            break_iis[-1] = len(positions)
-        
             # Read the chromosomes in
-            chromos = fid.read((segsites+1)*total_samples)
-        
-            # For each bootstrap segment, relevant SNPs run from start_ii:end_ii
-            for boot_ii, (start_ii, end_ii) \
-                    in enumerate(zip(break_iis[:-1], break_iis[1:])):
-                # Use the data array corresponding to this bootstrap segment
-                data = all_data[boot_ii]
-                for snp in range(start_ii, end_ii):
-                    # Slice to get all the entries that refer to a given SNP
-                    this_snp = chromos[snp::segsites+1]
-                    # Count SNPs per population, and record them.
-                    if dimension == 1:
-                        data[this_snumpy.count('1')] += 1
-                    elif dimension == 2:
-                        data[this_snp[bottom0:top0].count('1'), 
-                             this_snp[bottom1:top1].count('1')] += 1
-                    elif dimension == 3:
-                        data[this_snp[bottom0:top0].count('1'), 
-                             this_snp[bottom1:top1].count('1'),
-                             this_snp[bottom2:top2].count('1')] += 1
-                    elif dimension == 4:
-                        data[this_snp[bottom0:top0].count('1'), 
-                             this_snp[bottom1:top1].count('1'),
-                             this_snp[bottom2:top2].count('1'),
-                             this_snp[bottom3:top3].count('1')] += 1
-                    elif dimension == 5:
-                        data[this_snp[bottom0:top0].count('1'), 
-                             this_snp[bottom1:top1].count('1'),
-                             this_snp[bottom2:top2].count('1'),
-                             this_snp[bottom3:top3].count('1'),
-                             this_snp[bottom4:top4].count('1')] += 1
-                    elif dimension == 6:
-                        data[this_snp[bottom0:top0].count('1'), 
-                             this_snp[bottom1:top1].count('1'),
-                             this_snp[bottom2:top2].count('1'),
-                             this_snp[bottom3:top3].count('1'),
-                             this_snp[bottom4:top4].count('1'),
-                             this_snp[bottom5:top5].count('1')] += 1
-                    else:
-                        # This is noticably slower, so we special case the cases
-                        # above.
-                        for dim_ii in range(dimension):
-                            bottom = bottom_l[dim_ii]
-                            top = top_l[dim_ii]
-                            counts[dim_ii] = this_snp[bottom:top].count('1')
-                        data[tuple(counts)] += 1
-        
-            # Read to the next iteration
-            line = fid.readline()
+            chromos = ''.join([fid.readline().strip()
+                               for _ in range(total_samples)])
+            chromos = numpy.frombuffer(chromos.encode('ascii'), numpy.uint8)
+            chromos = chromos.reshape(total_samples, segsites) == ord('1')
+            derived = numpy.array([chromos[bottom:top].sum(axis=0)
+                                   for bottom, top in zip(sample_indices[:-1],
+                                                          sample_indices[1:])])
+            yield positions, derived
             line = fid.readline()
 
-        if newfile:
-            fid.close()
-
-        all_fs = [Spectrum(data, mask_corners=mask_corners, pop_ids=pop_ids)
-                  for data in all_data]
-        if average:
-            all_fs = [fs / runs for fs in all_fs]
-
-        # If we aren't setting up for bootstrapping, return fs, rather than a
-        # list of length 1. (This ensures backward compatibility.)
-        if bootstrap_segments == 1:
-            all_fs = all_fs[0]
-
-        if not return_header:
-            return all_fs
-        else:
-            return all_fs, (command,seeds)
-
     @staticmethod
     def from_sfscode_file(fid, sites='all', average=True, mask_corners=True, 
                           return_header=False, pop_ids=None):
@@ -1213,63 +1496,17 @@ class Spectrum(numpy.ma.masked_array):
         The 'calls' entry gives the successful calls in each population, in the
         order that the alleles are specified in 'segregating'.
         Non-diallelic polymorphisms are skipped.
+        data_dict can also be a Misc.SNPData object.
         """
-        Npops = len(pop_ids)
-        fs = numpy.zeros(numpy.asarray(projections) + 1)
-        for snp, snp_info in data_dict.items():
-            # Skip SNPs that aren't biallelic.
-            if len(snp_info['segregating']) != 2:
-                continue
-
-            allele1, allele2 = snp_info['segregating']
-            if not polarized:
-                # If we don't want to polarize, we can choose which allele is
-                # derived arbitrarily since we'll fold anyways.
-                outgroup_allele = allele1
-            elif 'outgroup_allele' in snp_info\
-               and snp_info['outgroup_allele'] != '-'\
-               and snp_info['outgroup_allele'] in snp_info['segregating']:
-                # Otherwise we need to check that it's a useful outgroup
-                outgroup_allele = snp_info['outgroup_allele']
-            else: 
-                # If we're polarized and we didn't have good outgroup info, skip
-                # this SNP.
-                continue
-    
-            # Extract the allele calls for each population.
-            allele1_calls = [snp_info['calls'][pop][0] for pop in pop_ids]
-            allele2_calls = [snp_info['calls'][pop][1] for pop in pop_ids]
-            # How many chromosomes did we call successfully in each population?
-            successful_calls = [a1 + a2 for (a1, a2) in zip(allele1_calls, allele2_calls)]
-    
-            # Which allele is derived (different from outgroup)?
-            if allele1 == outgroup_allele:
-                derived_calls = allele2_calls
-            elif allele2 == outgroup_allele:
-                derived_calls = allele1_calls
-    
-            # To handle arbitrary numbers of populations in the fs, we need
-            # to do some tricky slicing.
-            slices = [[numpy.newaxis] * len(pop_ids) for ii in range(Npops)]
-            for ii in range(len(pop_ids)):
-                slices[ii][ii] = slice(None,None,None)
-        
-            # Do the projection for this SNP.
-            pop_contribs = []
-            iter = zip(projections, successful_calls, derived_calls)
-            for pop_ii, (p_to, p_from, hits) in enumerate(iter):
-                contrib = Numerics._cached_projection(p_to,p_from,hits)[slices[pop_ii]]
-                pop_contribs.append(contrib)
-            fs += functools.reduce(operator.mul, pop_contribs)
-        fsout = Spectrum(fs, mask_corners=mask_corners, 
-                         pop_ids=pop_ids)
-        if polarized:
-            return fsout
-        else:
-            return fsout.fold()
+        # SNPs with the same calls are projected together (see
+        # Misc.count_data_dict and _from_count_dict).
+        count_dict = moments.Misc.count_data_dict(data_dict, pop_ids)
+        return Spectrum._from_count_dict(count_dict, projections, polarized,
+                                         pop_ids, mask_corners)
 
     @staticmethod
-    def _from_count_dict(count_dict, projections, polarized=True, pop_ids=None):
+    def _from_count_dict(count_dict, projections, polarized=True, pop_ids=None,
+                         mask_corners=True):
         """
         Frequency spectrum from data mapping SNP configurations to counts.
 
@@ -1279,28 +1516,17 @@ class Spectrum(numpy.ma.masked_array):
         polarized: If True, only include SNPs that count_dict marks as polarized. 
                    If False, include all SNPs and fold resulting Spectrum.
         pop_ids: Optional list of strings containing the population labels.
+        mask_corners: If True, the typical corners of the resulting fs will be
+                      masked
         """
-    
-        # create slices for projection calculation
-        slices = [[numpy.newaxis] * len(projections) for ii in range(len(projections))]
-        for ii in range(len(projections)):
-            slices[ii][ii] = slice(None, None, None)
-            
-        fs_total = moments.Spectrum(numpy.zeros(numpy.array(projections) + 1),
-                                 pop_ids=pop_ids)
-        for (called_by_pop, derived_by_pop, this_snp_polarized), count\
-                in count_dict.items():
-            if polarized and not this_snp_polarized:
-                continue
-            pop_contribs = []
-            iter = zip(projections, called_by_pop, derived_by_pop)
-            for pop_ii, (p_to, p_from, hits) in enumerate(iter):
-                contrib = Numerics._cached_projection(p_to, p_from,hits)[slices[pop_ii]]
-                pop_contribs.append(contrib)
-            fs_proj = functools.reduce(operator.mul, pop_contribs)
-            
-            # create slices for adding projected fs to overall fs
-            fs_total += count * fs_proj
+        configs = [(called, derived, count) for (called, derived, this_snp_polarized),
+                   count in count_dict.items() if this_snp_polarized or not polarized]
+        if configs:
+            called, derived, counts = zip(*configs)
+            fs = Numerics._project_counts(called, derived, counts, projections)
+        else:
+            fs = numpy.zeros(numpy.asarray(projections) + 1)
+        fs_total = Spectrum(fs, mask_corners=mask_corners, pop_ids=pop_ids)
         if polarized:
             return fs_total
         else:
@@ -1414,6 +1640,8 @@ class Spectrum(numpy.ma.masked_array):
         f.close()
     
         # Divide the data into classes based on ('context', 'outgroup_allele')
+        if isinstance(data_dict, moments.Misc.SNPData):
+            data_dict = data_dict.to_data_dict()
         by_context = Spectrum._data_by_tri(data_dict)
     
         fs = numpy.zeros(numpy.asarray(projections) + 1)
@@ -1540,7 +1768,9 @@ def %(method)s(self, other):
     # spectrum integration
     # We chose the most efficient solver for each case
     def integrate(self, Npop, tf, dt_fac=0.02, gamma=None, h=None, m=None, theta=1.0, 
-                    adapt_dt=False, finite_genome=False, theta_fd=None, theta_bd=None, frozen=[False]):
+                    adapt_dt=False, finite_genome=False, theta_fd=None, theta_bd=None, frozen=[False],
+                    rtol=None, atol=1e-8, method='cn', matrix_free=False, threads=1,
+                    dtype=numpy.float64, Npop_tol=None):
         """
         Method to simulate the spectrum's evolution for a given set of demographic parameters.
         Npop: Populations effective sizes.
@@ -1553,6 +1783,23 @@ def %(method)s(self, other):
         theta: theta parameter.
         adapt_dt: flag to allow dt correction avoiding negative entries.
         frozen: list of same length as number of pops, with True for frozen populations at the corresponding index.
+        rtol: if given, the time step is adapted to keep the estimated local error
+              below atol + rtol*|sfs| and dt_fac only sets the initial step.
+        atol: absolute tolerance used with rtol.
+        method: 'cn' for Crank-Nicolson time steps, 'expm' to compute the result
+                with the exponential of the operator (only for constant Npop,
+                gamma, h and m; dt_fac, rtol and atol are then ignored).
+        matrix_free: with migration, apply the operators along each axis instead of
+                     assembling sparse matrices over couples of pops (O(d) memory,
+                     for large sample sizes).
+        threads: number of threads sharing the slices of the spectrum during the
+                 linear solves (useful for 3 populations or more).
+        dtype: storage type of the spectrum and of the explicit operators during the
+               integration. numpy.float32 halves the memory traffic, the
+               factorizations and solves stay in float64.
+        Npop_tol: for a callable Npop, relative tolerance used to round the population
+                  sizes to log-spaced values, so that the factorizations of the linear
+                  systems are reused while N stays in the same bucket.
         """
         n = numpy.array(self.shape)-1
         
@@ -1582,15 +1829,17 @@ def %(method)s(self, other):
                 gamma = 0.0
             if h is None:
                 h = 0.5
-            if gamma == 0:
+            if gamma == 0 and rtol is None and method == 'cn':
                 self.data[:] = moments.Integration_nomig.integrate_neutral(self.data, Npop, tf, dt_fac, theta,
                                         finite_genome=finite_genome, theta_fd=theta_fd, theta_bd=theta_bd,
-                                        frozen=frozen)
+                                        frozen=frozen, threads=threads, dtype=dtype,
+                                        Npop_tol=Npop_tol)
             else:
                 #self.data[:] = integrate_1D(self.data, Npop, n, tf, dt_fac, dt_max, gamma, h, theta)
                 self.data[:] = moments.Integration_nomig.integrate_nomig(self.data, Npop, tf, dt_fac, gamma, h, theta,
                                         finite_genome=finite_genome, theta_fd=theta_fd, theta_bd=theta_bd,
-                                        frozen=frozen)
+                                        frozen=frozen, rtol=rtol, atol=atol, method=method,
+                                        threads=threads, dtype=dtype, Npop_tol=Npop_tol)
         else:
             if gamma is None:
                 gamma = numpy.zeros(len(n))
@@ -1600,18 +1849,22 @@ def %(method)s(self, other):
                 m = numpy.zeros([len(n), len(n)])
             if (m == 0).all(): 
                 # for more than 2 populations, the sparse solver seems to be faster than the tridiag...
-                if (numpy.array(gamma) == 0).all() and len(n)<3:
+                if (numpy.array(gamma) == 0).all() and len(n)<3 and rtol is None and method == 'cn':
                     self.data[:] = moments.Integration_nomig.integrate_neutral(self.data, Npop, tf, dt_fac, theta,
                                         finite_genome=finite_genome, theta_fd=theta_fd, theta_bd=theta_bd,
-                                        frozen=frozen)
+                                        frozen=frozen, threads=threads, dtype=dtype,
+                                        Npop_tol=Npop_tol)
                 else:
                     self.data[:] = moments.Integration_nomig.integrate_nomig(self.data, Npop, tf, dt_fac, gamma, h, theta,
                                         finite_genome=finite_genome, theta_fd=theta_fd, theta_bd=theta_bd,
-                                        frozen=frozen)
+                                        frozen=frozen, rtol=rtol, atol=atol, method=method,
+                                        threads=threads, dtype=dtype, Npop_tol=Npop_tol)
             else:
                 self.data[:] = moments.Integration.integrate_nD(self.data, Npop, tf, dt_fac, gamma, h, m, theta, adapt_dt, 
                                         finite_genome=finite_genome, theta_fd=theta_fd, theta_bd=theta_bd,
-                                        frozen=frozen)
+                                        frozen=frozen, rtol=rtol, atol=atol, method=method,
+                                        matrix_free=matrix_free, threads=threads, dtype=dtype,
+                                        Npop_tol=Npop_tol)
 
 # Allow spectrum objects to be pickled.
 # See http://effbot.org/librarybook/copy-reg.htm
@@ -89,4 +89,50 @@ cpdef numpy.ndarray[numpy.float64_t] solve(numpy.ndarray[numpy.float64_t] a, num
     for i in xrange(n-2, -1, -1):
         x[i] = (x[i] - c[i] * x[i + 1]) / d[i]
 
-    return x
\ No newline at end of file
+    return x
+
+
+cpdef numpy.ndarray[numpy.float64_t, ndim=2] solve_2D(double[:] a, double[:] d, double[:] c,
+                                                     double[:, :] b, out=None):
+    """Solves AX=B for X with factored tridigonal A having diagonals a, d, c
+
+    USAGE:
+        x = solve_2D( a, d, c, b )
+
+    INPUT:
+        a, d, c    - lists or NumPy arrays specifying the diagonals of the
+                     factored tridiagonal matrix A.  These are produced by
+                     factor().
+        b          - 2D array, each column being a right-hand-side vector
+        out        - optional preallocated 2D array for the solution
+
+    OUTPUT:
+        x          - 2D array, the columns are the solution vectors
+
+    NOTE:
+        The GIL is released during the solve so that several threads can
+        process different columns at the same time.
+    """
+    cdef int i, j
+    cdef int n = d.shape[0]
+    cdef int k = b.shape[1]
+    if out is None:
+        out = numpy.zeros((n, k))
+    cdef double[:, :] x = out
+
+    with nogil:
+        for j in range(k):
+            x[0, j] = b[0, j]
+
+        for i in range(1, n):
+            for j in range(k):
+                x[i, j] = b[i, j] - a[i - 1] * x[i - 1, j]
+
+        for j in range(k):
+            x[n - 1, j] = x[n - 1, j] / d[n - 1]
+
+        for i in range(n-2, -1, -1):
+            for j in range(k):
+                x[i, j] = (x[i, j] - c[i] * x[i + 1, j]) / d[i]
+
+    return numpy.asarray(out)
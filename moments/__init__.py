@@ -10,6 +10,7 @@ logging.basicConfig()
 
 from . import Demographics1D
 from . import Demographics2D
+from . import DFE
 from . import Godambe
 from . import Inference
 from . import Integration
@@ -20,6 +21,7 @@ import LinearSystem_2D
 from . import Manips
 from . import Misc
 from . import Numerics
+from . import Operators
 
 # Protect import of Plotting in case matplotlib not installed.
 try:
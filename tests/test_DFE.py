@@ -0,0 +1,77 @@
+import os
+import tempfile
+import unittest
+
+import numpy
+import scipy.integrate
+import moments
+import time
+
+
+def two_epoch_sel(params, ns, gamma):
+    nu, T = params
+    sts = moments.LinearSystem_1D.steady_state_1D(ns[0], gamma=gamma)
+    fs = moments.Spectrum(sts)
+    fs.integrate([nu], T, gamma=gamma)
+    return fs
+
+
+class DFETestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print("%s: %.3f seconds" % (self.id(), t))
+
+    def test_cache(self):
+        ns = [20]
+        params = [2., 0.1]
+        cache = moments.DFE.Cache(params, ns, two_epoch_sel, gamma_bounds=(1e-3, 50),
+                                  gamma_pts=60, additional_gammas=[10.])
+        self.assertEqual(cache.spectra.shape, (61, 21))
+        self.assertTrue(10. in cache.gammas)
+        # the weights integrate the density
+        w = cache.weights([0.3, 50.], moments.DFE.gamma_pdf)
+        self.assertTrue(abs(w.sum() - 1) < 1e-3)
+        # neutral sites only
+        fs = cache.integrate([0.3, 50.], moments.DFE.gamma_pdf, 10., neutral=1.)
+        self.assertTrue(numpy.ma.allclose(fs, 10 * two_epoch_sel(params, ns, 0)))
+        # weighted sum against a direct quadrature
+        sel_dist = moments.DFE.lognormal_pdf
+        fs = cache.integrate([1., 1.], sel_dist, 1.)
+        f = lambda g, i: (sel_dist(g, 1., 1.) * two_epoch_sel(params, ns, -g).data[i])
+        for i in [1, 10]:
+            ref = scipy.integrate.quad(f, 1e-3, 50, args=(i,), limit=200)[0]
+            self.assertTrue(abs(fs[i] / ref - 1) < 1e-2)
+        # mixtures are weighted sums
+        mix = moments.DFE.mixture_pdf([moments.DFE.gamma_pdf, moments.DFE.lognormal_pdf],
+                                      [2, 2])
+        fs_mix = cache.integrate([0.3, 0.2, 30., 1., 1.], mix, 1.)
+        fs_ref = 0.3 * cache.integrate([0.2, 30.], moments.DFE.gamma_pdf, 1.) \
+                 + 0.7 * fs
+        self.assertTrue(numpy.ma.allclose(fs_mix, fs_ref))
+
+    def test_file(self):
+        kw = {'gamma_bounds': (1e-2, 10.), 'gamma_pts': 10}
+        cache = moments.DFE.Cache([2., 0.1], [10], two_epoch_sel, processes=2,
+                                  dtype=numpy.float32, **kw)
+        cache_ref = moments.DFE.Cache([2., 0.1], [10], two_epoch_sel, **kw)
+        self.assertTrue(numpy.allclose(cache.spectra, cache_ref.spectra, rtol=1e-6))
+        fd, fname = tempfile.mkstemp(suffix='.npz')
+        os.close(fd)
+        try:
+            cache.to_file(fname)
+            cache2 = moments.DFE.Cache.from_file(fname)
+        finally:
+            os.remove(fname)
+        self.assertEqual(cache2.spectra.dtype, numpy.float32)
+        fs = cache.integrate([1., 1.], moments.DFE.lognormal_pdf, 5.)
+        fs2 = cache2.integrate([1., 1.], moments.DFE.lognormal_pdf, 5.)
+        self.assertTrue(numpy.ma.allclose(fs, fs2))
+        self.assertTrue(fs2.mask[0] and fs2.mask[-1])
+
+suite = unittest.TestLoader().loadTestsFromTestCase(DFETestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import os
+import unittest
+
+import numpy
+import moments
+import time
+
+class InferenceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print("%s: %.3f seconds" % (self.id(), t))
+
+    def test_ll_arrays(self):
+        """
+        The plain array fast path gives the same results as the masked
+        arrays.
+        """
+        numpy.random.seed(0)
+        model = moments.Spectrum(numpy.random.rand(8,10))
+        data = moments.Spectrum(numpy.random.poisson(100*model.data))
+        data.mask[1,1] = True
+        model.mask[2,3] = True
+        for data in [data, data.fold()]:
+            model_fold = model.fold() if data.folded else model
+            theta = moments.Inference.optimal_sfs_scaling(model, data)
+            model_m, data_m = moments.Numerics.intersect_masks(model_fold, data)
+            self.assertAlmostEqual(theta, data_m.sum()/model_m.sum())
+            ll = moments.Inference.ll_per_bin(theta*model, data).sum()
+            self.assertAlmostEqual(moments.Inference.ll_multinom(model, data),
+                                   ll)
+            self.assertAlmostEqual(moments.Inference.ll(theta*model, data), ll)
+
+        # Preallocated outputs
+        data = data.unfold()
+        model.mask[2,3] = False
+        out, work = numpy.empty(model.shape), numpy.empty(model.shape)
+        result, valid = moments.Inference._ll_multinom_per_bin_arrays(
+                model.data, model.mask, data.data, data.mask, out=out,
+                work=work)
+        self.assertTrue(result is out)
+        self.assertTrue(numpy.array_equal(valid, ~data.mask))
+        self.assertAlmostEqual(result.sum(),
+                               moments.Inference.ll_multinom(model, data))
+        # Entries with a negative model are not used
+        model.data[2,3] = -1
+        result, valid = moments.Inference._ll_per_bin_arrays(
+                model.data, model.mask, data.data, data.mask)
+        self.assertFalse(valid[2,3])
+        self.assertEqual(result[2,3], 0)
+
+    def test_godambe_jackknife(self):
+        """
+        Jackknife and bootstrap spectra of the same units give similar
+        Godambe uncertainties.
+        """
+        func = moments.Demographics1D.two_epoch
+        params = [0.5, 0.2]
+        model = 5000 * func(params, [20])
+        numpy.random.seed(0)
+        # Units of linked SNPs, with overdispersed counts
+        units = numpy.array([numpy.random.poisson(model.data / 40 *
+                                                  numpy.random.gamma(2., 0.5))
+                             for ii in range(40)], float)
+        data = moments.Spectrum(units.sum(axis=0))
+        all_boot = [moments.Spectrum(numpy.bincount(
+                        numpy.random.randint(0, 40, 40), minlength=40).dot(units))
+                    for ii in range(200)]
+        all_jack = [data - unit for unit in units]
+        # The uncertainties are evaluated at the best fit
+        params = moments.Inference.optimize_log(params, data, func, verbose=0)
+        uncerts_boot = moments.Godambe.GIM_uncert(func, all_boot, params, data)
+        uncerts_jack = moments.Godambe.GIM_uncert(func, all_jack, params, data,
+                                                  jackknife=True)
+        self.assertTrue(numpy.allclose(uncerts_jack, uncerts_boot, rtol=0.2))
+        # Unscaled jackknife spectra would give much smaller uncertainties
+        uncerts = moments.Godambe.GIM_uncert(func, all_jack, params, data)
+        self.assertTrue(numpy.all(uncerts < 0.5 * uncerts_jack))
+
+suite = unittest.TestLoader().loadTestsFromTestCase(InferenceTestCase)
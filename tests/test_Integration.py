@@ -0,0 +1,344 @@
+import os
+import unittest
+
+import numpy
+import scipy.sparse
+import moments
+import threading
+import time
+import sys
+sys.path[:0] = ['../moments/']
+
+import Jackknife as jk
+import LinearSystem_2D
+
+
+class IntegrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print("%s: %.3f seconds" % (self.id(), t))
+
+    def test_operator_cache(self):
+        n1, n2 = 10, 12
+        mig = numpy.array([[0, 2.], [1., 0]])
+        fs_ref = moments.Spectrum(numpy.zeros([n1+1, n2+1]))
+        fs_ref.integrate([1., 2.], 0.5, gamma=[1., -1.], m=mig)
+
+        cache = moments.Integration.enable_operator_cache()
+        try:
+            for ii in range(2):
+                fs = moments.Spectrum(numpy.zeros([n1+1, n2+1]))
+                fs.integrate([1., 2.], 0.5, gamma=[1., -1.], m=mig)
+                self.assertTrue(numpy.allclose(fs, fs_ref))
+            info = moments.Integration.operator_cache_info()
+            self.assertTrue(info['hits'] > 0)
+            self.assertEqual(info['hits'] + info['misses'], 2 * info['misses'])
+            self.assertTrue(0 < info['nbytes'] <= info['max_bytes'])
+        finally:
+            moments.Integration.disable_operator_cache()
+        self.assertTrue(moments.Integration.operator_cache_info() is None)
+
+    def test_operator_cache_nomig(self):
+        # models without migration go to integrate_neutral and integrate_nomig
+        for shape, kw in [([21], {}), ([11, 13], {}),
+                          ([11, 13], {'gamma': [1., -1.]})]:
+            nu = [2.] * len(shape)
+            fs_ref = moments.Spectrum(numpy.zeros(shape))
+            fs_ref.integrate(nu, 0.5, **kw)
+            moments.Integration.enable_operator_cache()
+            try:
+                for ii in range(2):
+                    fs = moments.Spectrum(numpy.zeros(shape))
+                    fs.integrate(nu, 0.5, **kw)
+                    self.assertTrue(numpy.allclose(fs, fs_ref))
+                info = moments.Integration.operator_cache_info()
+                self.assertTrue(info['hits'] > 0)
+                self.assertEqual(info['hits'] + info['misses'],
+                                 2 * info['misses'])
+            finally:
+                moments.Integration.disable_operator_cache()
+
+    def test_operator_cache_eviction(self):
+        cache = moments.Integration.OperatorCache(max_bytes=100)
+        cache.put('a', 1, 60)
+        cache.put('b', 2, 30)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3, 30)
+        # 'b' is the least recently used entry
+        self.assertTrue(cache.get('b') is None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.nbytes, 90)
+        # entries larger than the budget are not stored
+        cache.put('d', 4, 200)
+        self.assertTrue(cache.get('d') is None)
+
+    def test_blocks(self):
+        m = numpy.zeros((4, 4))
+        m[0, 2] = 1.
+        m[3, 2] = 0.5
+        blocks = moments.Integration._blocks(4, m)
+        # couples without migration are skipped
+        self.assertEqual(blocks, [(0, 2), (2, 3), (1,)])
+        w = moments.Integration._weights(4, blocks)
+        self.assertTrue(numpy.allclose(w, [1, 1, 0.5, 1]))
+
+    def test_nomig_equivalence(self):
+        n1, n2 = 10, 8
+        fs_nD = moments.Integration.integrate_nD(numpy.zeros([n1+1, n2+1]),
+                                                 [1., 2.], 0.3, gamma=[1., 0])
+        fs_nomig = moments.Integration_nomig.integrate_nomig(
+                       numpy.zeros([n1+1, n2+1]), [1., 2.], 0.3, gamma=[1., 0])
+        self.assertTrue(numpy.allclose(fs_nD, fs_nomig))
+
+    def test_6pops(self):
+        m = numpy.zeros((6, 6))
+        m[1, 2] = m[2, 1] = 1.
+        fs = moments.Spectrum(numpy.zeros([5] * 6))
+        fs.integrate([1., 1., 1., 2., 1., 1.], 0.1, m=m)
+        fs1 = moments.Spectrum(numpy.zeros(5))
+        fs1.integrate([1.], 0.1)
+        # the first population has no migration and evolves as in 1D
+        self.assertTrue(numpy.ma.allclose(fs.marginalize([1, 2, 3, 4, 5]), fs1,
+                                          rtol=1e-3))
+
+    def test_adaptive_dt(self):
+        nu = lambda t: [1 + t, 2.]
+        m = [[0, 2.], [2., 0]]
+        fs0 = moments.Spectrum(numpy.zeros([11, 11]))
+        fs_ref = fs0.copy()
+        fs_ref.integrate(nu, 0.5, dt_fac=0.001, m=m, gamma=[-1., 1.])
+        fs = fs0.copy()
+        fs.integrate(nu, 0.5, m=m, gamma=[-1., 1.], rtol=1e-4)
+        self.assertTrue(numpy.ma.allclose(fs, fs_ref, rtol=1e-3, atol=1e-4))
+        # no migration and neutral 1D cases
+        for shape, kw in [([11, 11], {}), ([21], {'gamma': -1.})]:
+            fs_ref = moments.Spectrum(numpy.zeros(shape))
+            fs_ref.integrate([2.] * len(shape), 0.5, dt_fac=0.001, **kw)
+            fs = moments.Spectrum(numpy.zeros(shape))
+            fs.integrate([2.] * len(shape), 0.5, rtol=1e-4, **kw)
+            self.assertTrue(numpy.ma.allclose(fs, fs_ref, rtol=1e-3, atol=1e-4))
+
+    def test_expm(self):
+        for shape, kw in [([31], {'gamma': 2.}),
+                          ([11, 11], {'gamma': [1., -1.], 'm': [[0, 1.], [3., 0]]}),
+                          ([7, 7, 7], {'m': [[0, 1., 0], [1., 0, 0], [0, 0, 0]]})]:
+            fs_ref = moments.Spectrum(numpy.zeros(shape))
+            fs_ref.integrate([2.] * len(shape), 0.5, dt_fac=0.001, **kw)
+            fs = moments.Spectrum(numpy.zeros(shape))
+            fs.integrate([2.] * len(shape), 0.5, method='expm', **kw)
+            self.assertTrue(numpy.ma.allclose(fs, fs_ref, rtol=1e-3, atol=1e-5))
+        fs_ref = moments.Spectrum(0.01 * numpy.ones(21), mask_corners=False)
+        fs = fs_ref.copy()
+        kw = {'finite_genome': True, 'theta_fd': 0.01, 'theta_bd': 0.02}
+        fs_ref.integrate([2.], 0.5, dt_fac=0.001, **kw)
+        fs.integrate([2.], 0.5, method='expm', **kw)
+        self.assertTrue(numpy.allclose(fs, fs_ref, rtol=1e-3))
+        # the exponential integrator needs constant parameters
+        fs = moments.Spectrum(numpy.zeros([11, 11]))
+        with self.assertRaises(ValueError):
+            fs.integrate(lambda t: [1 + t, 1.], 0.5, m=[[0, 1.], [1., 0]],
+                         method='expm')
+
+    def test_kron_migration(self):
+        dims = numpy.array([9, 12])
+        ljk = jk.calcJK13(int(dims[1] - 1))
+        A0, A1, W = moments.Integration._calcM_kron(dims[0], dims[1], ljk)
+        M = (scipy.sparse.kron(A0, scipy.sparse.identity(dims[1]))
+             + scipy.sparse.kron(A1, W))
+        Mref = LinearSystem_2D.calcM_1(dims, ljk)
+        self.assertTrue(numpy.allclose(M.todense(), Mref.todense()))
+
+    def test_matrix_free(self):
+        for shape, kw in [([21, 21], {'gamma': [1., -1.], 'h': [0.3, 0.6],
+                                      'm': [[0, 2.], [1., 0]]}),
+                          ([9, 9, 9], {'m': [[0, 1., 0], [2., 0, .5], [0, 1., 0]]})]:
+            nu = lambda t: [1 + t] + [2.] * (len(shape) - 1)
+            fs_ref = moments.Spectrum(numpy.zeros(shape))
+            fs_ref.integrate(nu, 0.5, dt_fac=0.001, **kw)
+            fs = moments.Spectrum(numpy.zeros(shape))
+            fs.integrate(nu, 0.5, matrix_free=True, **kw)
+            self.assertTrue(numpy.ma.allclose(fs, fs_ref, rtol=1e-3, atol=1e-4))
+
+    def test_threads(self):
+        m = numpy.ones((3, 3)) - numpy.eye(3)
+        for kw in [{'m': m}, {'gamma': [1., 0, -1.]}, {}]:
+            fs_ref = moments.Spectrum(numpy.zeros([9, 9, 9]))
+            fs_ref.integrate([1., 2., 3.], 0.2, **kw)
+            num_threads = threading.active_count()
+            fs = moments.Spectrum(numpy.zeros([9, 9, 9]))
+            fs.integrate([1., 2., 3.], 0.2, threads=3, **kw)
+            self.assertTrue(numpy.allclose(fs, fs_ref))
+            # the threads only live during the integration
+            self.assertEqual(threading.active_count(), num_threads)
+        # solvers with an out argument write into the preallocated result
+        outs = []
+        def solve(b, out=None):
+            outs.append(out is not None)
+            if out is None:
+                return 2 * b
+            out[:] = 2 * b
+            return out
+        for dtype in [numpy.float64, numpy.float32]:
+            del outs[:]
+            sfs = numpy.arange(60, dtype=dtype).reshape(3, 4, 5)
+            res = moments.Integration._apply_axes(sfs, solve, (1,), 2,
+                                                  out_arg=True)
+            self.assertEqual(res.dtype, dtype)
+            self.assertTrue(numpy.allclose(res, 2 * sfs))
+            self.assertEqual(outs, [dtype == numpy.float64] * 2)
+
+    def test_float32(self):
+        m = numpy.ones((3, 3)) - numpy.eye(3)
+        nu = lambda t: [1 + t, 2., 0.5]
+        fs64 = moments.Spectrum(numpy.zeros([13, 13, 13]))
+        fs64.integrate(nu, 0.5, m=m, gamma=[1., 0, -1.])
+        fs32 = moments.Spectrum(numpy.zeros([13, 13, 13]))
+        fs32.integrate(nu, 0.5, m=m, gamma=[1., 0, -1.], dtype=numpy.float32)
+        # the drift of the log-likelihood stays negligible
+        data = numpy.around(1000 * fs64)
+        ll64 = moments.Inference.ll_multinom(fs64, data)
+        ll32 = moments.Inference.ll_multinom(fs32, data)
+        self.assertTrue(abs(ll32 - ll64) < 1e-3)
+        self.assertTrue(numpy.ma.allclose(fs32, fs64, rtol=1e-4, atol=1e-7))
+        # 1D neutral spectra (tridiagonal solver)
+        ts = moments.Integration_nomig.ts
+        solve = ts.solve
+        dtypes = []
+        def solve32(a, d, c, b):
+            dtypes.append(b.dtype)
+            return solve(a, d, c, b)
+        for kw in [{}, {'finite_genome': True, 'theta_fd': 1., 'theta_bd': 2.}]:
+            fs64 = moments.Spectrum(numpy.zeros(21), mask_corners=not kw)
+            fs64.integrate(lambda t: [1 + t], 0.5, **kw)
+            fs32 = moments.Spectrum(numpy.zeros(21), mask_corners=not kw)
+            del dtypes[:]
+            ts.solve = solve32
+            try:
+                fs32.integrate(lambda t: [1 + t], 0.5, dtype=numpy.float32, **kw)
+            finally:
+                ts.solve = solve
+            # the spectrum stays in single precision between the solves
+            self.assertTrue(len(dtypes) > 1)
+            self.assertEqual(set(dtypes), set([numpy.dtype(numpy.float32)]))
+            self.assertTrue(numpy.ma.allclose(fs32, fs64, rtol=1e-4, atol=1e-7))
+        # the float64 results of the solvers are stored in single precision
+        sfs = numpy.ones((3, 4, 5), dtype=numpy.float32)
+        solve = lambda b: 2 * numpy.asarray(b, dtype=numpy.float64)
+        for threads in [1, 2]:
+            res = moments.Integration._apply_axes(sfs, solve, (0, 2), threads)
+            self.assertEqual(res.dtype, numpy.float32)
+            self.assertTrue(numpy.allclose(res, 2))
+
+    def test_Npop_tol(self):
+        nu = lambda t: [numpy.exp(2 * t), 2 * numpy.exp(-t)]
+        m = [[0, 1.], [1., 0]]
+        fs_ref = moments.Spectrum(numpy.zeros([11, 11]))
+        fs_ref.integrate(nu, 0.5, dt_fac=0.005, m=m)
+        moments.Integration.enable_operator_cache()
+        try:
+            fs = moments.Spectrum(numpy.zeros([11, 11]))
+            fs.integrate(nu, 0.5, dt_fac=0.005, m=m, Npop_tol=0.02)
+            # one factorization per bucket instead of one per time step
+            info = moments.Integration.operator_cache_info()
+            self.assertTrue(info['misses'] < 60)
+        finally:
+            moments.Integration.disable_operator_cache()
+        self.assertTrue(numpy.ma.allclose(fs, fs_ref, rtol=0, atol=1e-2 * fs_ref.max()))
+        # rounded sizes stay within the tolerance
+        N = numpy.exp(numpy.linspace(-3, 3, 1000))
+        Nq = moments.Integration._quantize_N(N, 0.02)
+        self.assertTrue(numpy.all(numpy.abs(Nq / N - 1) <= 0.02))
+        self.assertTrue(len(numpy.unique(Nq)) < 200)
+
+    def test_Npop_tol_neutral(self):
+        # neutral exponential growth goes to integrate_neutral
+        nu = lambda t: [numpy.exp(3 * t)]
+        fs_ref = moments.Spectrum(numpy.zeros(31))
+        fs_ref.integrate(nu, 0.5)
+        moments.Integration.enable_operator_cache()
+        try:
+            fs = moments.Spectrum(numpy.zeros(31))
+            fs.integrate(nu, 0.5, Npop_tol=0.05)
+            misses = moments.Integration.operator_cache_info()['misses']
+            moments.Integration.disable_operator_cache()
+            moments.Integration.enable_operator_cache()
+            fs_exact = moments.Spectrum(numpy.zeros(31))
+            fs_exact.integrate(nu, 0.5)
+            info = moments.Integration.operator_cache_info()
+            self.assertTrue(misses < info['misses'] / 2)
+        finally:
+            moments.Integration.disable_operator_cache()
+        self.assertFalse(numpy.allclose(fs, fs_ref, rtol=1e-6))
+        # sizes within 5% of the exact ones
+        self.assertTrue(numpy.ma.allclose(fs, fs_ref, rtol=0,
+                                          atol=5e-2 * fs_ref.max()))
+        # same rounding as integrate_nomig
+        fs_nomig = moments.Spectrum(numpy.zeros(31))
+        fs_nomig.integrate(nu, 0.5, gamma=1e-9, Npop_tol=0.05)
+        self.assertTrue(numpy.ma.allclose(fs, fs_nomig, rtol=1e-6))
+
+    def test_Npop_tol_buckets(self):
+        # a bottleneck and a recovery go through the same buckets twice, and
+        # each bucket is factorized once
+        nu = lambda t: [1 - 0.9 * numpy.sin(numpy.pi * t)]
+        moments.Integration.enable_operator_cache()
+        try:
+            fs_ref = moments.Spectrum(numpy.zeros(31))
+            fs_ref.integrate(nu, 1., gamma=-1., Npop_tol=0.05)
+            keys = moments.Integration.operator_cache_info()['misses']
+        finally:
+            moments.Integration.disable_operator_cache()
+        nomig_ops = moments.Integration_nomig._nomig_ops
+        calls = []
+        def counted_ops(*args):
+            calls.append(args)
+            return nomig_ops(*args)
+        moments.Integration_nomig._nomig_ops = counted_ops
+        try:
+            fs = moments.Spectrum(numpy.zeros(31))
+            fs.integrate(nu, 1., gamma=-1., Npop_tol=0.05)
+        finally:
+            moments.Integration_nomig._nomig_ops = nomig_ops
+        self.assertEqual(len(calls), keys)
+        self.assertTrue(numpy.allclose(fs, fs_ref))
+
+    def test_gamma_batch(self):
+        gammas = [-5., 0., 2.]
+        nu = lambda t: [1 + t, 2.]
+        m = numpy.array([[0, 1.], [2., 0]])
+        fs0 = moments.Spectrum(numpy.zeros([11, 13]))
+        res = moments.Integration.integrate_gamma_batch(fs0, nu, 0.2, gammas,
+                                                        dt_fac=0.01, m=m)
+        self.assertEqual(res.shape, (3, 11 * 13))
+        for i, g in enumerate(gammas):
+            fs = moments.Integration.integrate_nD(fs0, nu, 0.2, dt_fac=0.01,
+                                                  gamma=[g, g], m=m)
+            self.assertTrue(numpy.allclose(res[i], fs.data.ravel()))
+        # stack of initial spectra, one gamma per pop, threads
+        fs1 = moments.Spectrum(numpy.zeros(21))
+        fs1.integrate([1.], 0.1, gamma=-2.)
+        res = moments.Integration.integrate_gamma_batch(
+                  numpy.array([fs1.data] * 2), [2.], 0.1, [[-2.], [-4.]], threads=2)
+        for i, g in enumerate([-2., -4.]):
+            fs = fs1.copy()
+            fs.integrate([2.], 0.1, gamma=g)
+            self.assertTrue(numpy.allclose(res[i], fs.data, rtol=1e-3, atol=1e-5))
+        # frozen populations and Npop_tol, as in integrate_nD
+        nu = lambda t: [numpy.exp(2 * t), 2.]
+        for kw in [{'frozen': [False, True]}, {'Npop_tol': 0.05}]:
+            res = moments.Integration.integrate_gamma_batch(fs0, nu, 0.2, gammas,
+                                                            dt_fac=0.01, m=m, **kw)
+            for i, g in enumerate(gammas):
+                fs = moments.Integration.integrate_nD(fs0, nu, 0.2, dt_fac=0.01,
+                                                      gamma=[g, g], m=m, **kw)
+                self.assertTrue(numpy.allclose(res[i], fs.data.ravel()))
+
+suite = unittest.TestLoader().loadTestsFromTestCase(IntegrationTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -28,6 +28,27 @@ class JackknifeTestCase(unittest.TestCase):
         zz = numpy.dot(J, xx)
         self.assertTrue(numpy.allclose(zz, yy, atol=8e-04,))
 
+    def test_jk_sparse(self):
+        for n in [3, 4, 25]:
+            for dense, sparse, band in [
+                    (moments.Jackknife.calcJK13, moments.Jackknife.calcJK13_sparse,
+                     moments.Jackknife.calcJK13_band),
+                    (moments.Jackknife.calcJK23, moments.Jackknife.calcJK23_sparse,
+                     moments.Jackknife.calcJK23_band)]:
+                J = dense(n)
+                self.assertTrue(numpy.allclose(sparse(n).toarray(), J))
+                b = band(n)
+                self.assertEqual(b.shape, (J.shape[0], 3))
+                for ljk in [J, sparse(n), b]:
+                    self.assertTrue(numpy.allclose(moments.Jackknife.band(ljk), b))
+        # the matrix builders accept the three forms
+        d = 21
+        S = moments.LinearSystem_1D.calcS(d, moments.Jackknife.calcJK13(d - 1))
+        for ljk in [moments.Jackknife.calcJK13_sparse(d - 1),
+                    moments.Jackknife.calcJK13_band(d - 1)]:
+            Sb = moments.LinearSystem_1D.calcS(d, ljk)
+            self.assertTrue(numpy.allclose(Sb.todense(), S.todense()))
+
 suite = unittest.TestLoader().loadTestsFromTestCase(JackknifeTestCase)
 if __name__ == '__main__':
     unittest.main()
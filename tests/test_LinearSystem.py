@@ -1,6 +1,7 @@
 import unittest
 import numpy
 import moments
+import moments.LinearSystem
 import time
 import sys
 sys.path[:0] = ['../moments/']
@@ -83,8 +84,26 @@ class LinearSystemTestCase(unittest.TestCase):
                 steady = moments.LinearSystem_1D.steady_state_1D(n,gamma = gamma,h=h)
                 after = moments.Integration_nomig.integrate_nomig(steady,Npop=[1],tf=1,gamma=gamma,h=h)
         self.assertTrue(numpy.allclose(steady,after))
-        
-        
+
+    def test_matrices_nD(self):
+        """test the nD assembly against the 2D matrices"""
+        dims = numpy.array([9, 12])
+        ljk = [jk.calcJK13(int(dims[i]-1)) for i in range(len(dims))]
+        ljk2 = [jk.calcJK23(int(dims[i]-1)) for i in range(len(dims))]
+        D = moments.LinearSystem.calcD(dims)
+        self.assertTrue(numpy.allclose(D[0].todense(), LinearSystem_2D.calcD1(dims).todense()))
+        self.assertTrue(numpy.allclose(D[1].todense(), LinearSystem_2D.calcD2(dims).todense()))
+        S = moments.LinearSystem.calcS_jk3(dims, [1.0, 2.0], [0.5, 0.5])
+        Sref = 0.5*LinearSystem_2D.calcS_1(dims, ljk[0]) + LinearSystem_2D.calcS_2(dims, ljk[1])
+        self.assertTrue(numpy.allclose(S.todense(), Sref.todense()))
+        S2 = moments.LinearSystem.calcS2_jk3(dims, [1.0, 2.0], [0.2, 0.7])
+        S2ref = 0.6*LinearSystem_2D.calcS2_1(dims, ljk2[0]) - 0.8*LinearSystem_2D.calcS2_2(dims, ljk2[1])
+        self.assertTrue(numpy.allclose(S2.todense(), S2ref.todense()))
+        m = numpy.array([[0, 1.0], [3.0, 0]])
+        M = moments.LinearSystem.calcM_jk3(dims, m)
+        Mref = m[0,1]*LinearSystem_2D.calcM_1(dims, ljk[1]) + m[1,0]*LinearSystem_2D.calcM_2(dims, ljk[0])
+        self.assertTrue(numpy.allclose(M.todense(), Mref.todense()))
+
 
 suite = unittest.TestLoader().loadTestsFromTestCase(LinearSystemTestCase)
 if __name__ == '__main__':
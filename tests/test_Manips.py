@@ -143,5 +143,19 @@ class ManipsTestCase(unittest.TestCase):
         fs = moments.Spectrum(numpy.random.rand(11*7*9*5).reshape((7,11,9,5)))
         fs = moments.Manips.split_4D_to_5D_2(fs, 3, 7)
         self.assertTrue(numpy.all(fs.sample_sizes == [6, 3, 8, 4, 7]))
+    def test_split_array(self):
+        data = numpy.random.rand(5*9).reshape((5,9))
+        split = moments.Manips._split_array(data, 1, 5, 3)
+        self.assertEqual(split.shape, (5, 6, 4))
+        comb = scipy.special.comb
+        for i in range(6):
+            for j in range(4):
+                self.assertTrue(numpy.allclose(split[:, i, j], data[:, i + j]
+                                * comb(5, i) * comb(3, j) / comb(8, i + j)))
+        merged = moments.Manips._merge_array(data)
+        self.assertEqual(merged.shape, (13,))
+        self.assertTrue(numpy.allclose(merged[4], data[0,4] + data[1,3]
+                                       + data[2,2] + data[3,1] + data[4,0]))
+        self.assertTrue(numpy.allclose(merged.sum(), data.sum()))
 
 suite = unittest.TestLoader().loadTestsFromTestCase(ManipsTestCase)
@@ -0,0 +1,221 @@
+import gzip
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import zlib
+
+import numpy
+import moments
+import time
+
+vcf_lines = """##fileformat=VCFv4.2
+#CHROM	POS	ID	REF	ALT	QUAL	FILTER	INFO	FORMAT	s1	s2	s3	s4
+1	100	.	A	T	.	PASS	AA=A	GT	0|1	1|1	0|0	0|1
+1	200	.	C	G	.	PASS	AA=G	GT	0|0	0|1	1|1	1|1
+1	300	.	C	G	.	q10	AA=C	GT	0|0	0|1	1|1	1|1
+2	50	.	G	A	.	.	AA=.	GT	0|1	0|0	0|1	0|0
+2	70	.	G	AT	.	PASS	AA=G	GT	0|1	0|0	0|1	0|0
+2	90	.	T	C	.	PASS	AA=T	GT	0|1	./.	0|1	0|0
+"""
+popinfo_lines = "s1 P1\ns2 P1\ns3 P2\ns4 P2\n"
+
+
+class MiscTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+        self.tmpdir = tempfile.mkdtemp()
+        self.vcf = os.path.join(self.tmpdir, 'data.vcf')
+        self.popinfo = os.path.join(self.tmpdir, 'popinfo.txt')
+        with open(self.vcf, 'w') as f:
+            f.write(vcf_lines)
+        with open(self.popinfo, 'w') as f:
+            f.write(popinfo_lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+        t = time.time() - self.startTime
+        print("%s: %.3f seconds" % (self.id(), t))
+
+    def test_snp_data(self):
+        dd = moments.Misc.make_data_dict_vcf(self.vcf, self.popinfo)
+        snps = moments.Misc.make_snp_data_vcf(self.vcf, self.popinfo)
+        self.assertEqual(len(snps), 3)
+        self.assertEqual(snps.pop_ids, ['P1', 'P2'])
+        self.assertEqual(list(snps.chrom), ['1', '1', '2'])
+        self.assertEqual(list(snps.pos), [100, 200, 50])
+        self.assertEqual(snps.calls[1].tolist(), [[3, 1], [0, 4]])
+        # same information as the data dictionary
+        dd2 = snps.to_data_dict()
+        self.assertEqual(sorted(dd2), sorted(dd))
+        for snp_id in dd:
+            for key in ['segregating', 'outgroup_allele', 'context', 'calls']:
+                self.assertEqual(tuple(dd2[snp_id][key]) if key == 'segregating'
+                                 else dd2[snp_id][key],
+                                 tuple(dd[snp_id][key]) if key == 'segregating'
+                                 else dd[snp_id][key])
+        self.assertEqual(moments.Misc.count_data_dict(snps, ['P2', 'P1']),
+                         moments.Misc.count_data_dict(dd, ['P2', 'P1']))
+        for polarized in [True, False]:
+            fs = moments.Spectrum.from_data_dict(snps, ['P1', 'P2'], [3, 4],
+                                                 polarized=polarized)
+            fs_ref = moments.Spectrum.from_data_dict(dd, ['P1', 'P2'], [3, 4],
+                                                     polarized=polarized)
+            self.assertTrue(numpy.ma.allclose(fs, fs_ref))
+        # conversion from a data dictionary
+        snps2 = moments.Misc.SNPData.from_data_dict(dd)
+        self.assertEqual(sorted(snps2.pos.tolist()), [50, 100, 200])
+        # chromosome names with underscores
+        with open(self.vcf, 'w') as f:
+            f.write(vcf_lines.replace('\n2\t', '\nchrUn_gl000220\t'))
+        snps = moments.Misc.make_snp_data_vcf(self.vcf, self.popinfo)
+        self.assertEqual(list(snps.chrom), ['1', '1', 'chrUn_gl000220'])
+        self.assertEqual(list(snps.pos), [100, 200, 50])
+
+    def test_snp_data_empty(self):
+        with open(self.vcf, 'w') as f:
+            f.write(''.join(vcf_lines.splitlines(True)[:2]))
+        self.assertEqual(moments.Misc.make_data_dict_vcf(self.vcf, self.popinfo),
+                         {})
+        snps = moments.Misc.make_snp_data_vcf(self.vcf, self.popinfo)
+        self.assertEqual(len(snps), 0)
+        self.assertEqual(snps.pop_ids, ['P1', 'P2'])
+        self.assertEqual(snps.calls.shape, (0, 2, 2))
+        self.assertEqual(snps.to_data_dict(), {})
+        self.assertEqual(dict(moments.Misc.count_data_dict(snps, ['P1'])), {})
+
+    def test_snp_data_file(self):
+        snps = moments.Misc.make_snp_data_vcf(self.vcf, self.popinfo)
+        dirname = os.path.join(self.tmpdir, 'snps')
+        snps.save(dirname)
+        snps2 = moments.Misc.SNPData.load(dirname)
+        self.assertTrue(isinstance(snps2.calls, numpy.memmap))
+        self.assertEqual(snps2.pop_ids, snps.pop_ids)
+        for name in moments.Misc.SNPData._columns:
+            self.assertTrue(numpy.all(getattr(snps2, name) == getattr(snps, name)))
+        fs = moments.Spectrum.from_data_dict(snps2, ['P2'], [4])
+        self.assertTrue(numpy.ma.allclose(
+            fs, moments.Spectrum.from_data_dict(snps, ['P2'], [4])))
+    def test_count_data_vcf(self):
+        dd = moments.Misc.make_data_dict_vcf(self.vcf, self.popinfo)
+        # gzip, and bgzip with one line per block
+        gz = os.path.join(self.tmpdir, 'data.vcf.gz')
+        with gzip.open(gz, 'wb') as f:
+            f.write(vcf_lines.encode())
+        bgz = os.path.join(self.tmpdir, 'data.bgz.vcf.gz')
+        with open(bgz, 'wb') as f:
+            for line in vcf_lines.splitlines(True) + ['']:
+                f.write(bgzf_block(line.encode()))
+        self.assertEqual(moments.Misc._vcf_kind(gz), 'compressed')
+        self.assertEqual(moments.Misc._vcf_kind(bgz), 'bgzip')
+        for pop_ids in [['P1', 'P2'], ['P2']]:
+            counts = moments.Misc.count_data_dict(dd, pop_ids)
+            for filename in [self.vcf, gz, bgz]:
+                for chunk_size in [2**20, 40]:
+                    self.assertEqual(moments.Misc.count_data_vcf(
+                            filename, self.popinfo, pop_ids,
+                            chunk_size=chunk_size), counts)
+        self.assertEqual(moments.Misc.count_data_vcf(
+                self.vcf, self.popinfo, ['P1', 'P2'], chunk_size=40,
+                processes=2), moments.Misc.count_data_dict(dd, ['P1', 'P2']))
+        fs = moments.Misc.make_spectrum_vcf(bgz, self.popinfo, ['P1', 'P2'],
+                                            [3, 4], chunk_size=40)
+        self.assertTrue(numpy.ma.allclose(fs, moments.Spectrum.from_data_dict(
+                                          dd, ['P1', 'P2'], [3, 4])))
+
+    def test_bootstrap(self):
+        dd = moments.Misc.make_data_dict_vcf(self.vcf, self.popinfo)
+        bed = os.path.join(self.tmpdir, 'regions.bed')
+        with open(bed, 'w') as f:
+            f.write("1\t50\t150\tr1\n2\t40\t60\tr2\n1\t180\t250\tr2\n"
+                    "3\t0\t100\tr3\n")
+        regions = {None: [['1_100', '1_200'], ['2_50']],
+                   bed: [['1_100'], ['1_200', '2_50']]}
+        for polarized in [True, False]:
+            for bed_filename, units in regions.items():
+                unit_fs = [moments.Spectrum.from_data_dict(
+                               dict((snp_id, dd[snp_id]) for snp_id in unit),
+                               ['P1', 'P2'], [4, 3], polarized=polarized)
+                           for unit in units]
+                numpy.random.seed(1)
+                boots = moments.Misc.bootstrap(dd, ['P1', 'P2'], [4, 3],
+                                               polarized=polarized,
+                                               bed_filename=bed_filename,
+                                               num_boots=5)
+                numpy.random.seed(1)
+                for fs in boots:
+                    choices = numpy.random.randint(0, len(units), len(units))
+                    expected = sum(unit_fs[ii] for ii in choices)
+                    self.assertTrue(numpy.ma.allclose(fs, expected))
+                    self.assertEqual(fs.folded, not polarized)
+        snps = moments.Misc.SNPData.from_data_dict(dd)
+        numpy.random.seed(2)
+        boots = moments.Misc.bootstrap(dd, ['P1', 'P2'], [4, 3], num_boots=5)
+        save_dir = os.path.join(self.tmpdir, 'boots')
+        numpy.random.seed(2)
+        moments.Misc.bootstrap(snps, ['P1', 'P2'], [4, 3], num_boots=5,
+                               save_dir=save_dir, binary=True, processes=2)
+        saved = moments.Spectrum.from_directory(save_dir, prefix='SFS_')
+        self.assertEqual(len(saved), 5)
+        for fs, fs_saved in zip(boots, saved):
+            self.assertTrue(numpy.ma.allclose(fs, fs_saved))
+
+    def test_jackknife(self):
+        dd = moments.Misc.make_data_dict_vcf(self.vcf, self.popinfo)
+        for polarized in [True, False]:
+            jack = moments.Misc.jackknife(dd, ['P1', 'P2'], [4, 3],
+                                          polarized=polarized)
+            # one SFS per chromosome, without the SNPs of that chromosome
+            self.assertEqual(len(jack), 2)
+            for fs, unit in zip(jack, [['2_50'], ['1_100', '1_200']]):
+                expected = moments.Spectrum.from_data_dict(
+                    dict((snp_id, dd[snp_id]) for snp_id in unit),
+                    ['P1', 'P2'], [4, 3], polarized=polarized)
+                self.assertTrue(numpy.ma.allclose(fs, expected))
+        lazy = moments.Misc.jackknife(dd, ['P1', 'P2'], [4, 3], lazy=True)
+        self.assertFalse(isinstance(lazy, list))
+        save_dir = os.path.join(self.tmpdir, 'jack')
+        moments.Misc.jackknife(dd, ['P1', 'P2'], [4, 3], save_dir=save_dir,
+                               binary=True)
+        saved = moments.Spectrum.from_directory(save_dir)
+        for fs, fs_lazy, fs_saved in zip(jack, lazy, saved):
+            self.assertTrue(numpy.ma.allclose(fs_lazy, fs_saved))
+
+    def test_interval_index(self):
+        bed = os.path.join(self.tmpdir, 'regions.bed')
+        with open(bed, 'w') as f:
+            f.write("track name=test\n2\t10\t20\tg\n1\t50\t60\n"
+                    "1\t0\t100\tg\n1\t40\t55\n1\t200\t201\n")
+        index = moments.Misc.IntervalIndex.from_bed(bed)
+        self.assertEqual(len(index), 5)
+        self.assertEqual(index.labels, ['g', 2, 4, 5])
+        self.assertEqual(list(index.groups), [0, 1, 0, 2, 3])
+        chroms = ['1'] * 7 + ['2', '2', '3']
+        positions = [0, 45, 55, 60, 99, 100, 200, 10, 20, 10]
+        self.assertEqual(list(index.find(chroms, positions)),
+                         [2, 3, 1, 2, 2, -1, 4, 0, -1, -1])
+        self.assertEqual(list(index.find(chroms, positions, closed=True)),
+                         [2, 3, 1, 1, 2, 2, 4, 0, 0, -1])
+        self.assertEqual(list(index.contains(chroms, positions)),
+                         [True] * 5 + [False, True, True, False, False])
+        self.assertEqual(list(index.find('1', [30, 150])), [2, -1])
+        index = moments.Misc.IntervalIndex.from_bed(bed, min_length=11)
+        self.assertEqual(list(index.find(chroms, positions)),
+                         [0, 1, 0, 0, 0, -1, -1, -1, -1, -1])
+
+
+def bgzf_block(data):
+    """
+    A BGZF block of data (the empty block marks the end of file).
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    cdata = compressor.compress(data) + compressor.flush()
+    return b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' \
+        + struct.pack('<H', len(cdata) + 25) + cdata \
+        + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data))
+
+suite = unittest.TestLoader().loadTestsFromTestCase(MiscTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
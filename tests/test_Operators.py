@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import moments
+import time
+import sys
+sys.path[:0] = ['../moments/']
+
+import Jackknife as jk
+import LinearSystem_2D
+
+
+class OperatorsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.startTime = time.time()
+
+    def tearDown(self):
+        t = time.time() - self.startTime
+        print("%s: %.3f seconds" % (self.id(), t))
+
+    def test_registry(self):
+        dims = numpy.array([9, 12])
+        M1 = moments.Operators.get('M_1', dims[0], dims[1])
+        # the matrices are computed once
+        self.assertTrue(M1 is moments.Operators.get('M_1', 9, 12))
+        ljk = jk.calcJK13(int(dims[1] - 1))
+        Mref = LinearSystem_2D.calcM_1(dims, ljk)
+        self.assertTrue(numpy.allclose(M1.todense(), Mref.todense()))
+        self.assertTrue(numpy.allclose(moments.Operators.calcJK13(11).toarray(), ljk))
+        with self.assertRaises(ValueError):
+            moments.Operators.get('X', 9)
+
+    def test_max_entries(self):
+        max_entries = moments.Operators.max_entries
+        moments.Operators.clear()
+        try:
+            moments.Operators.max_entries = 2
+            D5 = moments.Operators.get('D', 5)
+            moments.Operators.get('D', 6)
+            # D5 becomes the most recently used, D6 is evicted
+            self.assertTrue(moments.Operators.get('D', 5) is D5)
+            moments.Operators.get('D', 7)
+            self.assertEqual(list(moments.Operators._registry),
+                             [('D', 5), ('D', 7)])
+        finally:
+            moments.Operators.max_entries = max_entries
+            moments.Operators.clear()
+
+    def test_store(self):
+        path = tempfile.mkdtemp()
+        try:
+            moments.Operators.set_store(path)
+            moments.Operators.clear()
+            S = moments.Operators.get('S_2', 7, 8)
+            jk23 = moments.Operators.calcJK23(6)
+            self.assertTrue(len(os.listdir(path)) > 0)
+            # a fresh registry loads the stored matrices
+            moments.Operators.clear()
+            S_disk = moments.Operators.get('S_2', 7, 8)
+            self.assertTrue(S_disk is not S)
+            self.assertTrue(numpy.allclose(S_disk.todense(), S.todense()))
+            self.assertTrue(numpy.allclose(moments.Operators.calcJK23(6).toarray(), jk23.toarray()))
+            # files of another version of the builders are rebuilt
+            fname = moments.Operators._filename(('S_2', 7, 8))
+            numpy.savez(fname, dense=numpy.zeros((2, 2)))
+            moments.Operators.clear()
+            S_new = moments.Operators.get('S_2', 7, 8)
+            self.assertTrue(numpy.allclose(S_new.todense(), S.todense()))
+            with numpy.load(fname) as data:
+                self.assertEqual(int(data['version']), moments.Operators._version)
+        finally:
+            moments.Operators.set_store(None)
+            moments.Operators.clear()
+            shutil.rmtree(path)
+
+suite = unittest.TestLoader().loadTestsFromTestCase(OperatorsTestCase)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -29,6 +29,35 @@ class ProjectionTestCase(unittest.TestCase):
         params_up = moments.Inference._project_params_up(0.3, fixed_params)
         self.assertTrue(numpy.allclose(params_up, [0.1,0.2,0.3]))
 
+    def test_projection_matrix(self):
+        P = moments.Numerics._cached_projection_matrix(5, 12)
+        self.assertEqual(P.shape, (6, 13))
+        # each column is a hypergeometric distribution
+        self.assertTrue(numpy.allclose(P.sum(axis=0), 1))
+        self.assertAlmostEqual(P[2, 4], 6. * 56 / 792)
+        self.assertTrue(P is moments.Numerics._cached_projection_matrix(5, 12))
+        self.assertTrue(numpy.allclose(moments.Numerics._cached_projection(5, 12, 4),
+                                       P[:, 4]))
+
+    def test_project_axis(self):
+        numpy.random.seed(0)
+        fs = moments.Spectrum(numpy.random.rand(13, 9, 7))
+        fs.mask[4, 2, 3] = True
+        pfs = fs.project([5, 8, 4])
+        # projecting a single entry
+        for (i, j, k) in [(0, 1, 1), (4, 2, 3), (12, 8, 6)]:
+            ref = numpy.multiply.outer(moments.Numerics._cached_projection(5, 12, i),
+                                       moments.Numerics._cached_projection(4, 6, k))
+            single = numpy.zeros(fs.shape)
+            single[i, j, k] = 1
+            proj = moments.Spectrum(single, mask_corners=False).project([5, 8, 4])
+            self.assertTrue(numpy.allclose(proj.data[:, j, :], ref))
+        # the entries computed from masked entries are masked
+        self.assertTrue(pfs.mask[0, 0, 0] and pfs.mask[-1, -1, -1])
+        self.assertTrue(pfs.mask[2, 2, 2] and not pfs.mask[2, 3, 2])
+        self.assertTrue(pfs.mask[0, 2, 3] and not pfs.mask[0, 2, 0])
+        self.assertTrue(numpy.allclose(pfs.data.sum(), fs.data.sum()))
+
 suite = unittest.TestLoader().loadTestsFromTestCase(ProjectionTestCase)
 if __name__ == '__main__':
     unittest.main()
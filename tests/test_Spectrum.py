@@ -1,4 +1,7 @@
+import io
 import os
+import shutil
+import tempfile
 import unittest
 
 import numpy
@@ -84,6 +87,131 @@ class SpectrumTestCase(unittest.TestCase):
         self.assert_(numpy.all(fsout.mask == fsin.mask))
         self.assertEqual(fsout.folded, fsin.folded)
 
+    def test_binary_file(self):
+        """
+        Saving and loading spectrum in the binary format.
+        """
+        comments = ['comment 1', 'comment 2']
+        filename = 'test.fsb'
+        data = numpy.random.rand(4,6)
+
+        fsin = moments.Spectrum(data, pop_ids=['A', 'B']).fold()
+        fsin.mask[0,1] = True
+        fsin.to_file(filename, comment_lines=comments, binary=True)
+
+        for mmap_mode in ['c', 'r', None]:
+            fsout,commentsout = moments.Spectrum.from_file(filename,
+                                    return_comments=True, mmap_mode=mmap_mode)
+            self.assert_(numpy.allclose(fsout.data, fsin.data))
+            self.assert_(numpy.all(fsout.mask == fsin.mask))
+            self.assertEqual(fsout.folded, fsin.folded)
+            self.assertEqual(fsout.pop_ids, fsin.pop_ids)
+            self.assertEqual(commentsout, comments)
+        # Memory-mapped data is not copied, and copy-on-write maps can be
+        # changed without changing the file.
+        fsout = moments.Spectrum.from_file(filename)
+        self.assertFalse(fsout.data.flags.owndata)
+        fsout *= 2
+        fsout.mask[0,2] = True
+        with open(filename, 'rb') as fid:
+            fsout = moments.Spectrum.from_file(fid, mmap_mode=None)
+        self.assert_(numpy.allclose(fsout.data, fsin.data))
+        self.assert_(numpy.all(fsout.mask == fsin.mask))
+        del fsout
+        os.remove(filename)
+
+    def test_from_directory(self):
+        """
+        Loading all the spectra of a directory.
+        """
+        dirname = tempfile.mkdtemp()
+        try:
+            spectra = [moments.Spectrum(numpy.random.rand(3,5))
+                       for ii in range(12)]
+            for ii,fs in enumerate(spectra):
+                fs.to_file(os.path.join(dirname, 'SFS_{}'.format(ii)),
+                           binary=(ii % 2 == 0))
+            loaded = moments.Spectrum.from_directory(dirname, prefix='SFS_')
+            self.assertEqual(len(loaded), len(spectra))
+            for fsin,fsout in zip(spectra, loaded):
+                self.assert_(numpy.allclose(fsout.data, fsin.data))
+                self.assert_(numpy.all(fsout.mask == fsin.mask))
+            del loaded
+        finally:
+            shutil.rmtree(dirname)
+
+    def test_from_ms_file(self):
+        """
+        Reading spectra from ms output.
+        """
+        ms_lines = ["ms 5 3 -t 1 -I 2 2 3", "1 2 3", "",
+                    "//", "segsites: 2", "positions: 0.1000 0.8000",
+                    "10", "11", "01", "00", "01", "",
+                    "//", "segsites: 0", "",
+                    "//", "segsites: 1", "positions: 0.5000",
+                    "1", "0", "1", "1", "1", ""]
+        ms_output = os.linesep.join(ms_lines)
+        expected = numpy.zeros((3,4))
+        expected[2,0] += 1
+        expected[1,2] += 1
+        expected[1,3] += 1
+
+        fs,(command,seeds) = moments.Spectrum.from_ms_file(
+                io.StringIO(ms_output), average=False, return_header=True)
+        self.assert_(numpy.allclose(fs.data, expected))
+        self.assertEqual(command.strip(), ms_lines[0])
+        fs = moments.Spectrum.from_ms_file(io.StringIO(ms_output))
+        self.assert_(numpy.allclose(fs.data, expected / 3))
+
+        # Bootstrap segments split the SNPs by position
+        segments = moments.Spectrum.from_ms_file(io.StringIO(ms_output),
+                                        average=False, bootstrap_segments=2)
+        self.assertEqual(segments[0].data[2,0], 1)
+        self.assertEqual(segments[1].data[1,2] + segments[1].data[1,3], 2)
+
+        # Samples assigned to a single population
+        fs = moments.Spectrum.from_ms_file(io.StringIO(ms_output),
+                                           average=False, pop_assignments=[5])
+        self.assert_(numpy.allclose(fs.data, [0, 0, 1, 1, 1, 0]))
+
+        # Spectra of the runs
+        runs = list(moments.Spectrum.iter_ms_file(io.StringIO(ms_output)))
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(runs[1].data.sum(), 0)
+        self.assert_(numpy.allclose(sum(runs).data, expected))
+        runs = list(moments.Spectrum.iter_ms_file(io.StringIO(ms_output),
+                                                  runs_per_fs=2))
+        self.assertEqual([fs.data.sum() for fs in runs], [2, 1])
+
+    def test_sample_many(self):
+        """
+        Vectorized Poisson and fixed-size sampling.
+        """
+        fs = moments.Spectrum(10 * numpy.random.rand(6,8), pop_ids=['A', 'B'])
+        fs.data[2,2] = 0
+        mask = numpy.zeros(fs.shape, bool)
+        mask[1,3] = True
+
+        samples = fs.sample_many(50, seed=7, mask=mask)
+        self.assertEqual(samples.shape, (50, 6, 8))
+        for entry in [(0,0), (-1,-1), (2,2), (1,3)]:
+            self.assert_(numpy.all(samples.mask[(slice(None),) + entry]))
+            self.assert_(numpy.all(samples.data[(slice(None),) + entry] == 0))
+        self.assertFalse(numpy.any(samples.mask[:,1,1]))
+        # Same draws from the generator, for the same seed
+        lazy = list(fs.sample_many(50, seed=7, mask=mask, lazy=True,
+                                   chunk_size=16))
+        self.assertEqual(len(lazy), 50)
+        for sample,fsout in zip(samples, lazy):
+            self.assert_(numpy.all(fsout.data == sample.data))
+            self.assert_(numpy.all(fsout.mask == sample.mask))
+            self.assertEqual(fsout.pop_ids, fs.pop_ids)
+
+        samples = fs.sample_many(20, seed=7, nsamples=100, mask=mask)
+        self.assert_(numpy.all(samples.data.sum(axis=(1,2)) == 100))
+        self.assert_(numpy.all(samples.data[:,1,3] == 0))
+        samples = fs.sample_many(20, seed=7, nsamples=100, only_nonmasked=True)
+        self.assert_(numpy.all(samples.data[:,0,0] == 0))
 
     def test_pickle(self):
         """
@@ -489,8 +617,33 @@ class SpectrumTestCase(unittest.TestCase):
         # Check equality
         self.assert_(numpy.all(pf1.mask == pf2.mask))
         self.assert_(numpy.allclose(pf1.data, pf2.data))
-        
-        
+
+    def test_from_data_dict(self):
+        # SNPs with the same calls are counted once, each SNP adds the
+        # product of the projections of its calls
+        dd = {'a': {'segregating': ['A', 'T'], 'outgroup_allele': 'A',
+                    'calls': {'P1': (6, 4), 'P2': (3, 5)}},
+              'b': {'segregating': ['A', 'T'], 'outgroup_allele': 'T',
+                    'calls': {'P1': (4, 6), 'P2': (5, 3)}},
+              'c': {'segregating': ['C', 'G'], 'outgroup_allele': 'C',
+                    'calls': {'P1': (8, 1), 'P2': (7, 0)}},
+              'd': {'segregating': ['C', 'G'], 'outgroup_allele': '-',
+                    'calls': {'P1': (2, 2), 'P2': (2, 2)}},
+              'e': {'segregating': ['A', 'C', 'G'],
+                    'calls': {'P1': (2, 2), 'P2': (2, 2)}}}
+        fs = moments.Spectrum.from_data_dict(dd, ['P1', 'P2'], [6, 4])
+        proj = moments.Numerics._cached_projection
+        ref = 2 * numpy.outer(proj(6, 10, 4), proj(4, 8, 5)) \
+              + numpy.outer(proj(6, 9, 1), proj(4, 7, 0))
+        self.assertTrue(numpy.allclose(fs.data, ref))
+        self.assertEqual(fs.pop_ids, ['P1', 'P2'])
+        self.assertTrue(fs.mask[0, 0] and fs.mask[-1, -1])
+        # unpolarized SNPs are included in the folded spectrum
+        fs = moments.Spectrum.from_data_dict(dd, ['P1', 'P2'], [6, 4],
+                                             polarized=False)
+        ref = moments.Spectrum(ref + numpy.outer(proj(6, 4, 2), proj(4, 4, 2)))
+        self.assertTrue(numpy.ma.allclose(fs, ref.fold()))
+
     def test_admix(self):
         # Test that projecting a multi-dimensional Spectrum succeeds
         ns = (25,8,6)